@@ -0,0 +1,473 @@
+"""Load-test harness for bot.py.
+
+Feeds synthetic Update objects through the real handler registry from
+bot.build_application() against an in-process fake Bot API, so no network is
+used. Reports throughput, p50/p99 handler latency and DB time per handler, and
+writes the results as JSON so runs can be compared for regressions.
+
+    python bench.py --updates 2000 --chats 20 --output bench_results.json
+    python bench.py --schema-rows 2000000   # v1 vs current schema query times
+"""
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import tempfile
+
+# bot.py's db object reads DB_NAME at import time (the schema is created later,
+# by init_db), so point it at a scratch file first
+_BENCH_DIR = tempfile.mkdtemp(prefix="bot-bench-")
+os.environ.setdefault("DB_NAME", os.path.join(_BENCH_DIR, "bench.db"))
+
+from telegram import Update
+from telegram.request import BaseRequest
+
+import bot
+
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+ADMIN_ID = 10
+
+
+class FakeTelegramRequest(BaseRequest):
+    """Answers every Bot API call locally with a canned, well-formed result."""
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.calls = {}
+        self._message_id = 0
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    def _message(self, chat_id, **extra):
+        self._message_id += 1
+        return {
+            "message_id": self._message_id,
+            "date": int(time.time()),
+            "chat": {"id": int(chat_id or 0), "type": "supergroup", "title": "Bench"},
+            "from": BOT_USER,
+            **extra,
+        }
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None,
+                         write_timeout=None, connect_timeout=None, pool_timeout=None):
+        endpoint = url.rsplit("/", 1)[-1]
+        self.calls[endpoint] = self.calls.get(endpoint, 0) + 1
+        params = request_data.parameters if request_data else {}
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        chat_id = params.get("chat_id")
+        if endpoint == "getMe":
+            result = BOT_USER
+        elif endpoint in ("sendMessage", "editMessageText"):
+            result = self._message(chat_id, text=params.get("text", ""))
+        elif endpoint == "sendPhoto":
+            photo = {"file_id": f"photo{self._message_id}", "file_unique_id": "u", "width": 256, "height": 256}
+            result = self._message(chat_id, photo=[photo])
+        elif endpoint == "sendPoll":
+            poll = {
+                "id": f"poll{self._message_id}", "question": params.get("question", ""),
+                "options": [{"text": "A", "voter_count": 0}, {"text": "B", "voter_count": 0}],
+                "total_voter_count": 0, "is_closed": False, "is_anonymous": False,
+                "type": "quiz", "allows_multiple_answers": False,
+            }
+            result = self._message(chat_id, poll=poll)
+        elif endpoint == "getChatAdministrators":
+            result = [{"status": "creator", "user": {"id": ADMIN_ID, "is_bot": False, "first_name": "Admin"},
+                       "is_anonymous": False}]
+        elif endpoint == "getChatMember":
+            result = {"status": "member", "user": {"id": int(params.get("user_id", 0)), "is_bot": False,
+                                                    "first_name": "User"}}
+        else:
+            result = True
+        return 200, json.dumps({"ok": True, "result": result}).encode()
+
+
+# --- Synthetic updates ---
+class UpdateFactory:
+    def __init__(self, app, chats: int, users: int, seed: int = 0):
+        self.app = app
+        self.chats = [-1000000000 - i for i in range(chats)]
+        self.users = [100 + i for i in range(users)]
+        self.random = random.Random(seed)
+        self.update_id = 0
+        self.polls = {}  # chat_id -> poll_id
+
+    def _user(self, user_id):
+        return {"id": user_id, "is_bot": False, "first_name": f"User{user_id}", "username": f"user{user_id}"}
+
+    def _update(self, payload):
+        self.update_id += 1
+        return Update.de_json({"update_id": self.update_id, **payload}, self.app.bot)
+
+    def message(self, chat_id, user_id, text):
+        entities = []
+        if text.startswith("/"):
+            entities.append({"type": "bot_command", "offset": 0, "length": len(text.split()[0])})
+        return self._update({"message": {
+            "message_id": self.update_id + 1,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "supergroup", "title": "Bench"},
+            "from": self._user(user_id),
+            "text": text,
+            "entities": entities,
+        }})
+
+    def poll_answer(self, poll_id, user_id):
+        return self._update({"poll_answer": {
+            "poll_id": poll_id, "user": self._user(user_id), "option_ids": [self.random.randint(0, 1)],
+        }})
+
+    def callback(self, chat_id, user_id, data):
+        return self._update({"callback_query": {
+            "id": str(self.update_id), "from": self._user(user_id), "chat_instance": "bench", "data": data,
+            "message": {"message_id": 1, "date": int(time.time()),
+                        "chat": {"id": chat_id, "type": "supergroup", "title": "Bench"}, "text": "x"},
+        }})
+
+    def make(self, kind: str):
+        """Return (handler label, chat key, update) for one synthetic update of ``kind``."""
+        chat_id = self.random.choice(self.chats)
+        user_id = self.random.choice(self.users)
+        if kind == "anti_spam":
+            text = self.random.choice([
+                "hello everyone, how is it going?",
+                "did anyone watch the match yesterday",
+                "earn money fast at bit.ly/xyz",
+                "check out my channel t.me/spamchannel",
+                "the meeting moved to thursday afternoon",
+            ])
+            return kind, chat_id, self.message(chat_id, user_id, text)
+        if kind == "get_faq":
+            return kind, chat_id, self.message(chat_id, user_id, f"/faq how do i {self.random.choice(FAQ_TOPICS)}")
+        if kind == "logo_command":
+            return kind, chat_id, self.message(chat_id, user_id, f"/logo brand{self.random.randint(0, 19)}")
+        if kind == "show_rules":
+            return kind, chat_id, self.message(chat_id, user_id, "/rules")
+        if kind == "handle_vote":
+            return kind, user_id, self.poll_answer(self.polls[chat_id], user_id)
+        if kind == "leaderboard_page":
+            return kind, chat_id, self.callback(chat_id, user_id, f"lb_{chat_id}_all_{self.random.randint(0, 2)}")
+        raise ValueError(kind)
+
+
+FAQ_TOPICS = ["reset my password", "join the voice chat", "report a user", "change my name",
+              "find the rules", "contact an admin", "enable notifications", "leave the group"]
+MIX = {"anti_spam": 60, "handle_vote": 15, "get_faq": 10, "show_rules": 5, "leaderboard_page": 5, "logo_command": 5}
+
+
+async def seed(factory: UpdateFactory, faqs_per_chat: int):
+    rows_faq, rows_settings, rows_games = [], [], []
+    for chat_id in factory.chats:
+        rows_settings.append((chat_id,))
+        for i in range(faqs_per_chat):
+            topic = FAQ_TOPICS[i % len(FAQ_TOPICS)]
+            rows_faq.append((chat_id, f"How do I {topic} ({i})", f"Answer {i}"))
+        poll_id = f"benchpoll{chat_id}"
+        factory.polls[chat_id] = poll_id
+        rows_games.append((poll_id, chat_id, "Bench question", 0, int(time.time())))
+    await bot.db.executemany("INSERT OR IGNORE INTO anti_spam_settings (group_id) VALUES (?)", rows_settings)
+    await bot.db.executemany("INSERT OR REPLACE INTO faqs VALUES (?, ?, ?)", rows_faq)
+    await bot.db.executemany(
+        """INSERT OR IGNORE INTO games (poll_id, chat_id, question, correct_option, created_at)
+        VALUES (?, ?, ?, ?, ?)""", rows_games
+    )
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100 * (len(ordered) - 1)))))
+    return ordered[index]
+
+
+async def run_benchmark(args) -> dict:
+    fake = FakeTelegramRequest(latency=args.api_latency / 1000)
+    app = bot.build_application(token="1:bench", request=fake)
+    factory = UpdateFactory(app, args.chats, args.users, seed=args.seed)
+    bot.init_db()
+    await seed(factory, args.faqs)
+
+    await app.initialize()
+    await bot.on_startup(app)
+
+    kinds = [kind for kind in MIX if kind in args.handlers]
+    weights = [MIX[kind] for kind in kinds]
+    workload = [factory.make(kind) for kind in factory.random.choices(kinds, weights, k=args.updates)]
+
+    # Updates for one chat run in order; chats run concurrently, as in webhook mode
+    by_chat = {}
+    for item in workload:
+        by_chat.setdefault(item[1], []).append(item)
+    samples = {kind: {"latency": [], "db": []} for kind in kinds}
+
+    async def run_chat(items):
+        for kind, _, update in items:
+            spent = [0.0]
+            token = bot.db.time_spent.set(spent)
+            start = time.perf_counter()
+            try:
+                await app.process_update(update)
+            finally:
+                samples[kind]["latency"].append(time.perf_counter() - start)
+                samples[kind]["db"].append(spent[0])
+                bot.db.time_spent.reset(token)
+
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def bounded(items):
+        async with semaphore:
+            await run_chat(items)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(bounded(items) for items in by_chat.values()))
+    await bot.vote_buffer.flush()
+    wall = time.perf_counter() - started
+
+    await bot.on_shutdown(app)
+    await app.shutdown()
+
+    handlers = {}
+    for kind, data in samples.items():
+        latencies = data["latency"]
+        if not latencies:
+            continue
+        handlers[kind] = {
+            "count": len(latencies),
+            "mean_ms": sum(latencies) / len(latencies) * 1000,
+            "p50_ms": percentile(latencies, 50) * 1000,
+            "p99_ms": percentile(latencies, 99) * 1000,
+            "max_ms": max(latencies) * 1000,
+            "db_mean_ms": sum(data["db"]) / len(data["db"]) * 1000,
+            "db_total_ms": sum(data["db"]) * 1000,
+        }
+    return {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "config": vars(args),
+        "updates": len(workload),
+        "wall_seconds": wall,
+        "throughput_per_sec": len(workload) / wall if wall else 0.0,
+        "handlers": handlers,
+        "db_queries": bot.db.query_stats(),
+        "api_calls": fake.calls,
+        "startup_seconds": bot.startup.phases,
+    }
+
+
+# --- Schema benchmark ---
+# The same lookups written against the version 1 schema (JSON participants,
+# ISO timestamps, no games indexes) and the current one.
+SCHEMA_QUERIES = {
+    "latest_game": (
+        "SELECT poll_id FROM games WHERE chat_id = ? ORDER BY created_at DESC LIMIT 1",
+        "SELECT poll_id FROM games WHERE chat_id = ? ORDER BY created_at DESC LIMIT 1",
+    ),
+    "chat_members": (
+        "SELECT participants FROM games WHERE chat_id = ?",
+        """SELECT DISTINCT p.user_id FROM games g
+        JOIN game_participants p ON p.poll_id = g.poll_id WHERE g.chat_id = ?""",
+    ),
+    "recent_games": (
+        "SELECT count(*) FROM games WHERE chat_id = ? AND created_at >= ?",
+        "SELECT count(*) FROM games WHERE chat_id = ? AND created_at >= ?",
+    ),
+}
+
+
+def _legacy_members(rows):
+    user_ids = []
+    for (participants,) in rows:
+        user_ids.extend(json.loads(participants)["ids"])
+    return list(dict.fromkeys(user_ids))
+
+
+def _legacy_track_group(conn, chat_id):
+    if conn.execute("SELECT 1 FROM tracked_groups WHERE group_id = ?", (chat_id,)).fetchone():
+        conn.execute("UPDATE tracked_groups SET title = ?, owner_id = ?, date_added = ? WHERE group_id = ?",
+                     ("Bench", ADMIN_ID, "2024-01-01T00:00:00", chat_id))
+    else:
+        conn.execute("INSERT INTO tracked_groups (group_id, title, owner_id, date_added) VALUES (?, ?, ?, ?)",
+                     (chat_id, "Bench", ADMIN_ID, "2024-01-01T00:00:00"))
+
+
+def _track_group(conn, chat_id):
+    conn.execute(
+        """INSERT INTO tracked_groups (group_id, title, owner_id, date_added) VALUES (?, ?, ?, ?)
+        ON CONFLICT(group_id) DO UPDATE SET title = excluded.title, owner_id = excluded.owner_id,
+            date_added = excluded.date_added""",
+        (chat_id, "Bench", ADMIN_ID, "2024-01-01T00:00:00"),
+    )
+
+
+def _fill_legacy(conn, rows: int, chats: int, users: int, rng: random.Random):
+    # Steady state: the retention window plus the one day housekeeping is about to prune
+    now = int(time.time())
+    span = (bot.GAME_RETENTION_DAYS + 1) * 86400
+
+    def games():
+        for i in range(rows):
+            ids = rng.sample(range(100, 100 + users), 3)
+            created = now - rng.randrange(span)
+            yield (
+                f"poll{i}", -1000000000 - rng.randrange(chats), "Bench question", rng.randrange(4),
+                json.dumps({"ids": ids, "names": [f"User{u}" for u in ids]}),
+                time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(created)), i, 1,
+            )
+
+    conn.execute("PRAGMA synchronous = OFF")
+    with conn:
+        conn.executemany(
+            """INSERT INTO games (poll_id, chat_id, question, correct_option, participants, created_at,
+            message_id, scored) VALUES (?, ?, ?, ?, ?, ?, ?, ?)""", games()
+        )
+        conn.executemany(
+            "INSERT INTO players (user_id, username, wins, games_played, last_played) VALUES (?, ?, ?, ?, ?)",
+            ((100 + u, f"user{u}", 0, 0, "2024-01-01T00:00:00") for u in range(users)),
+        )
+
+
+def _iso(epoch: int) -> str:
+    return time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(epoch))
+
+
+def _time_queries(conn, legacy: bool, chat_ids: list) -> dict:
+    results = {}
+    now = int(time.time())
+    week_ago = now - 7 * 86400
+    cutoff = now - bot.GAME_RETENTION_DAYS * 86400
+    for name, (legacy_sql, sql) in SCHEMA_QUERIES.items():
+        started = time.perf_counter()
+        for chat_id in chat_ids:
+            params = (chat_id, _iso(week_ago) if legacy else week_ago) if name == "recent_games" else (chat_id,)
+            rows = conn.execute(legacy_sql if legacy else sql, params).fetchall()
+            if name == "chat_members" and legacy:
+                _legacy_members(rows)
+        results[name] = (time.perf_counter() - started) / len(chat_ids) * 1000
+
+    track = _legacy_track_group if legacy else _track_group
+    started = time.perf_counter()
+    with conn:
+        for chat_id in chat_ids * 10:
+            track(conn, chat_id)
+    results["track_group"] = (time.perf_counter() - started) / (len(chat_ids) * 10) * 1000
+
+    # One housekeeping pass, rolled back so both runs see the same data
+    started = time.perf_counter()
+    conn.execute("BEGIN")
+    if legacy:
+        old_games = "SELECT poll_id FROM games WHERE created_at < ?"
+        conn.execute(f"DELETE FROM votes WHERE poll_id IN ({old_games})", (_iso(cutoff),))
+        conn.execute("DELETE FROM games WHERE created_at < ?", (_iso(cutoff),))
+    else:
+        bot._prune(conn, cutoff)
+    results["prune"] = (time.perf_counter() - started) * 1000
+    conn.rollback()
+    return results
+
+
+def run_schema_benchmark(args) -> dict:
+    """Compare the version 1 and current schemas at ``args.schema_rows`` games."""
+    rng = random.Random(args.seed)
+    legacy_path = os.path.join(_BENCH_DIR, "schema_legacy.db")
+    current_path = os.path.join(_BENCH_DIR, "schema_current.db")
+
+    legacy = bot.sqlite3.connect(legacy_path)
+    legacy.execute("PRAGMA journal_mode = WAL")
+    bot.apply_migrations(legacy, up_to=1)
+    started = time.perf_counter()
+    _fill_legacy(legacy, args.schema_rows, args.schema_chats, args.users, rng)
+    load_seconds = time.perf_counter() - started
+
+    current = bot.sqlite3.connect(current_path)
+    legacy.backup(current)
+    current.execute("PRAGMA journal_mode = WAL")
+    started = time.perf_counter()
+    bot.apply_migrations(current)
+    migrate_seconds = time.perf_counter() - started
+    current.execute("VACUUM")
+    current.execute("ANALYZE")
+    legacy.execute("ANALYZE")
+
+    chat_ids = [-1000000000 - rng.randrange(args.schema_chats) for _ in range(args.schema_queries)]
+    queries = {
+        "legacy": _time_queries(legacy, True, chat_ids),
+        "current": _time_queries(current, False, chat_ids),
+    }
+    sizes = {}
+    for name, conn in (("legacy", legacy), ("current", current)):
+        pages, page_size = conn.execute("PRAGMA page_count").fetchone()[0], conn.execute("PRAGMA page_size").fetchone()[0]
+        sizes[name] = pages * page_size
+        conn.close()
+    return {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "config": vars(args),
+        "rows": args.schema_rows,
+        "load_seconds": load_seconds,
+        "migrate_seconds": migrate_seconds,
+        "db_bytes": sizes,
+        "queries_ms": queries,
+    }
+
+
+def print_schema_report(results: dict):
+    print(f"{results['rows']} games: loaded in {results['load_seconds']:.1f}s, "
+          f"migrated in {results['migrate_seconds']:.1f}s")
+    sizes = results["db_bytes"]
+    print(f"database size: {sizes['legacy'] / 2**20:.1f} MiB -> {sizes['current'] / 2**20:.1f} MiB")
+    print(f"{'query':<16}{'v1 ms':>12}{'current ms':>12}{'speedup':>10}")
+    legacy, current = results["queries_ms"]["legacy"], results["queries_ms"]["current"]
+    for name in legacy:
+        speedup = legacy[name] / current[name] if current[name] else float("inf")
+        print(f"{name:<16}{legacy[name]:>12.3f}{current[name]:>12.3f}{speedup:>9.1f}x")
+
+
+def print_report(results: dict):
+    print(f"{results['updates']} updates in {results['wall_seconds']:.2f}s "
+          f"({results['throughput_per_sec']:.0f} updates/s)")
+    print("startup: " + ", ".join(f"{phase} {seconds:.2f}s" for phase, seconds in results["startup_seconds"].items()))
+    print(f"{'handler':<18}{'count':>7}{'p50 ms':>10}{'p99 ms':>10}{'max ms':>10}{'db ms':>10}")
+    for name, stats in sorted(results["handlers"].items()):
+        print(f"{name:<18}{stats['count']:>7}{stats['p50_ms']:>10.2f}{stats['p99_ms']:>10.2f}"
+              f"{stats['max_ms']:>10.2f}{stats['db_mean_ms']:>10.2f}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark bot.py handlers with synthetic updates")
+    parser.add_argument("--updates", type=int, default=2000, help="total synthetic updates")
+    parser.add_argument("--chats", type=int, default=20, help="distinct group chats")
+    parser.add_argument("--users", type=int, default=500, help="distinct users")
+    parser.add_argument("--faqs", type=int, default=200, help="FAQs seeded per chat")
+    parser.add_argument("--concurrency", type=int, default=bot.UPDATE_CONCURRENCY, help="chats processed in parallel")
+    parser.add_argument("--api-latency", type=float, default=0.0, help="simulated Bot API latency in ms")
+    parser.add_argument("--handlers", nargs="+", default=list(MIX), choices=list(MIX), help="handlers to exercise")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write JSON results to this file")
+    parser.add_argument("--schema-rows", type=int, default=0,
+                        help="instead of handlers, compare the v1 and current schemas at this many games")
+    parser.add_argument("--schema-chats", type=int, default=5000, help="distinct chats for --schema-rows")
+    parser.add_argument("--schema-queries", type=int, default=200, help="lookups timed per query for --schema-rows")
+    args = parser.parse_args(argv)
+
+    if args.schema_rows:
+        results = run_schema_benchmark(args)
+        print_schema_report(results)
+    else:
+        results = asyncio.run(run_benchmark(args))
+        print_report(results)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"Results written to {args.output}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -5,23 +5,125 @@ import time
 import random
 import json
 import io
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ChatPermissions, Poll
+import re
+import threading
+import zlib
+import multiprocessing
+import contextvars
+import heapq
+import bisect
+import hashlib
+import hmac
+import signal
+import itertools
+import csv
+import tempfile
+import unicodedata
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from queue import Full as QueueFull
+from telegram import Bot, Update, InlineKeyboardButton, InlineKeyboardMarkup, ChatPermissions, Poll, InputMediaPhoto
 from telegram.ext import (
     ApplicationBuilder,
     CommandHandler,
     MessageHandler,
     PollAnswerHandler,
     CallbackQueryHandler,
+    ChatMemberHandler,
+    TypeHandler,
+    ApplicationHandlerStop,
     filters,
     ContextTypes,
 )
-from datetime import datetime, timedelta
+from datetime import datetime
 from telegram.constants import ChatMemberStatus
-from PIL import Image, ImageDraw, ImageFont
+from telegram.error import RetryAfter, TelegramError, NetworkError
+from telegram.helpers import escape_markdown
+from telegram.request import BaseRequest, HTTPXRequest
+
+try:
+    import re._parser as sre_parse  # Python 3.11+
+except ImportError:
+    import sre_parse
 
 # --- Config ---
 TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
-DB_NAME = "group_bot.db"  # Make sure to use this consistently
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL")  # e.g. a local fake server for testing
+BOT_MODE = os.getenv("BOT_MODE", "polling")  # "polling" or "webhook"
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")  # public URL Telegram should POST updates to
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("PORT", "8443"))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+WEBHOOK_MAX_BODY = int(os.getenv("WEBHOOK_MAX_BODY", str(1024 * 1024)))  # bytes; larger requests get 413
+WEBHOOK_MAX_PENDING = int(os.getenv("WEBHOOK_MAX_PENDING", "10000"))  # queued updates before answering 503
+UPDATE_CONCURRENCY = int(os.getenv("UPDATE_CONCURRENCY", "32"))
+METRICS_LISTEN = os.getenv("METRICS_LISTEN", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))  # 0 disables the /metrics endpoint
+SHARD_COUNT = int(os.getenv("SHARD_COUNT", "1"))  # >1 runs a front dispatcher plus N worker processes
+SHARD_ID = 0  # set in each worker process
+SHARD_QUEUE_SIZE = 10000  # updates buffered per worker before the front holds them back
+DB_NAME = os.getenv("DB_NAME", "group_bot.db")  # Make sure to use this consistently
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "4"))
+SETTINGS_CACHE_SIZE = int(os.getenv("SETTINGS_CACHE_SIZE", "10000"))
+ADMIN_CACHE_TTL = int(os.getenv("ADMIN_CACHE_TTL", "300"))  # seconds
+ADMIN_CACHE_SIZE = int(os.getenv("ADMIN_CACHE_SIZE", "50000"))
+FLOOD_MUTE_SECONDS = int(os.getenv("FLOOD_MUTE_SECONDS", "600"))
+FLOOD_IDLE_SECONDS = 300  # forget users/fingerprints idle this long
+FLOOD_FINGERPRINTS_PER_CHAT = 512
+BULK_CONCURRENCY = int(os.getenv("BULK_CONCURRENCY", "8"))
+BULK_RATE_PER_CHAT = float(os.getenv("BULK_RATE_PER_CHAT", "15"))  # actions per second
+BULK_CHUNK_SIZE = 200  # targets per persisted batch
+BULK_MAX_RETRIES = 5
+BULK_PROGRESS_INTERVAL = 3.0  # seconds between status message edits
+MODERATION_MAX_TARGETS = 200  # users one /ban, /kick, /mute or /unmute may name
+OUTBOUND_GLOBAL_RATE = float(os.getenv("OUTBOUND_GLOBAL_RATE", "25"))  # messages per second
+OUTBOUND_CHAT_RATE = float(os.getenv("OUTBOUND_CHAT_RATE", "0.33"))  # ~20 per minute per group
+OUTBOUND_WORKERS = int(os.getenv("OUTBOUND_WORKERS", "4"))
+NOTICE_COALESCE_SECONDS = float(os.getenv("NOTICE_COALESCE_SECONDS", "5"))
+FAQ_INDEX_CACHE_SIZE = int(os.getenv("FAQ_INDEX_CACHE_SIZE", "1000"))  # chats kept in memory
+FAQ_MATCH_THRESHOLD = 0.6  # answer directly at or above this score
+FAQ_SUGGEST_THRESHOLD = 0.2
+FAQ_AUTOREPLY_THRESHOLD = 0.75
+LOGO_SIZES = tuple(int(size) for size in os.getenv("LOGO_SIZES", "128,256,512").split(","))
+LOGO_DEFAULT_SIZE = 256 if 256 in LOGO_SIZES else LOGO_SIZES[0]
+LOGO_CACHE_SIZE = int(os.getenv("LOGO_CACHE_SIZE", "512"))
+LOGO_WORKERS = int(os.getenv("LOGO_WORKERS", "2"))
+VOTE_FLUSH_INTERVAL = float(os.getenv("VOTE_FLUSH_INTERVAL", "2"))  # seconds
+VOTE_FLUSH_SIZE = int(os.getenv("VOTE_FLUSH_SIZE", "500"))  # buffered votes that force a flush
+LEADERBOARD_PAGE_SIZE = 10
+LEADERBOARD_MAX_PAGES = 100  # /leaderboard <page> jumps (offset paging) stop here
+LEADERBOARD_CACHE_SCOPES = int(os.getenv("LEADERBOARD_CACHE_SCOPES", "1000"))  # chats with cached pages
+WCG_GAME_SECONDS = int(os.getenv("WCG_GAME_SECONDS", "600"))  # polls auto-close after this
+GAME_RETENTION_DAYS = int(os.getenv("GAME_RETENTION_DAYS", "30"))
+HOUSEKEEPING_INTERVAL = 24 * 60 * 60  # seconds
+SCHEDULER_CONCURRENCY = 8
+JOIN_RAID_LIMIT = int(os.getenv("JOIN_RAID_LIMIT", "10"))  # joins within the window that start raid mode
+JOIN_RAID_WINDOW = float(os.getenv("JOIN_RAID_WINDOW", "10"))  # seconds
+JOIN_RAID_QUIET_SECONDS = float(os.getenv("JOIN_RAID_QUIET_SECONDS", "60"))  # raid ends after this long without joins
+JOIN_RAID_MAX_MUTE_SECONDS = 6 * 60 * 60  # Telegram lifts raid mutes by itself after this, even if the lift job never runs
+JOIN_BATCH_SECONDS = 1.0  # newcomers are restricted and welcomed in batches this far apart
+NEW_MEMBER_MUTE_SECONDS = int(os.getenv("NEW_MEMBER_MUTE_SECONDS", "300"))  # used by the mute_new_members feature
+USER_DIRECTORY_SIZE = int(os.getenv("USER_DIRECTORY_SIZE", "100000"))  # (chat, user) entries kept in memory
+USER_DIRECTORY_FLUSH_INTERVAL = 5.0  # seconds
+USER_DIRECTORY_TOUCH_SECONDS = 3600  # re-save an unchanged user at most this often
+USER_DIRECTORY_RETENTION_DAYS = int(os.getenv("USER_DIRECTORY_RETENTION_DAYS", "180"))
+ANALYTICS_FLUSH_INTERVAL = 60.0  # seconds between rollup writes
+ANALYTICS_RETENTION_DAYS = int(os.getenv("ANALYTICS_RETENTION_DAYS", "90"))
+STATS_DEFAULT_DAYS = 7
+WARNING_TTL_DAYS = int(os.getenv("WARNING_TTL_DAYS", "30"))  # warnings stop counting after this
+WARN_MUTE_SECONDS = int(os.getenv("WARN_MUTE_SECONDS", "3600"))  # escalation mute length
+WARN_FLUSH_INTERVAL = float(os.getenv("WARN_FLUSH_INTERVAL", "2"))  # seconds
+WARN_FLUSH_SIZE = 200  # pending ledger writes that force a flush
+WARN_CACHE_CHATS = int(os.getenv("WARN_CACHE_CHATS", "10000"))  # chats whose warnings stay in memory
+AUDIT_FLUSH_INTERVAL = 2.0  # seconds
+AUDIT_FLUSH_SIZE = 500  # pending audit entries that force a flush
+AUDIT_PAGE_SIZE = 15
+SPAM_RULES_PER_GROUP = 200
+SPAM_RULE_MAX_LENGTH = 200
+SPAM_REGEX_BUDGET_MS = float(os.getenv("SPAM_REGEX_BUDGET_MS", "25"))  # slower regex rules are rejected or switched off
+SPAM_REGEX_PROBE_TIMEOUT = 2.0  # seconds of matching before a regex probe process is killed
+SPAM_REGEX_PROBE_STARTUP = 30.0  # seconds a freshly spawned probe process may take to start
 SPAM_TRIGGERS = [
     "http://", "https://", "t.me/", ".com",
     "badword", "spam", "advertise",
@@ -48,32 +150,145 @@ HELP_MESSAGE = """
 /help - Show this message
 /rules - Show group rules
 /games - Show available games
-/faq <question> - Get an answer
+/faq <question> - Get an answer (fuzzy match)
 
 ⚡ *Admin Commands*:
 /setrules <text> - Set group rules
 /addfaq <question> | <answer> - Add FAQ
-/ban <user_id> - Ban a user
-/kick <user_id> - Kick a user
-/mute <user_id> [duration] - Mute a user
-/unmute <user_id> - Unmute a user
-/warn <user_id> - Warn a user
+/faqauto - Toggle automatic FAQ answers
+/ban <users> [reason] - Ban users (or reply to a message)
+/kick <users> [reason] - Kick users
+/mute <users> [30m|2h|1d] [reason] - Mute users
+/unmute <users> - Unmute users
+  <users>: IDs, @usernames or ID ranges like 100-120
+/warn <user_id> [reason] - Warn a user (or reply to their message)
+/warnings <user_id> - List a user's active warnings
+/unwarn <user_id> - Clear a user's warnings
+/warnconfig <mute|ban> [max] - What happens at the warning limit
 /userinfo @username - Get user information
-/antispam - Toggle anti-spam system
+/antispam [delete|ban|warn] - Toggle anti-spam, or choose what it does to spammers
+/antiflood <delete|mute|ban> [messages] [seconds] - Configure flood control
+/spamrule <list|add|regex|remove|test|dryrun> - Manage this group's spam rules
 /kickall - Kick all non-admin members (with confirmation)
+/auditlog [user] - Browse moderation history
+/auditexport [csv|json] [user] - Download moderation history
+/stats [days] - Group activity: top posters, busiest hours, spam ratio
+/slowest [n] - Show the slowest handlers
 
 *Game Commands*:
 /truthordare - Start game
 /meme - Share memes
 /joke  - Tell jokes
 /wcg
+/wcg_leaderboard [global] [week|month] [page] - Leaderboard
+/logo [size] [#color] [--all] <text> - Generate a logo
 """
 
-# --- Database Setup ---
-def init_db():
-    conn = sqlite3.connect(DB_NAME)  # FIXED: Use DB_NAME once
-    cursor = conn.cursor()
+# --- Database Layer ---
+class Database:
+    """Shared SQLite access for all handlers.
+
+    Each executor thread keeps one long-lived WAL connection, so sqlite3's
+    per-connection statement cache reuses prepared statements across calls.
+    Queries never run on the event loop; the executor size bounds concurrency.
+    """
+
+    def __init__(self, path: str, pool_size: int = 4):
+        self.path = path
+        self.pool_size = pool_size
+        self._executor = None
+        self._local = threading.local()
+        self._connections = []
+        self._lock = threading.Lock()
+        self.stats = {}  # label -> [count, total_seconds, max_seconds]
+        # Set to a one-item list to accumulate DB wall time for the current task
+        self.time_spent = contextvars.ContextVar("db_time_spent", default=None)
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, check_same_thread=False, cached_statements=256)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA busy_timeout=5000")
+            self._local.conn = conn
+            with self._lock:
+                self._connections.append(conn)
+        return conn
+
+    def _record(self, label: str, elapsed: float):
+        with self._lock:
+            entry = self.stats.setdefault(label, [0, 0.0, 0.0])
+            entry[0] += 1
+            entry[1] += elapsed
+            entry[2] = max(entry[2], elapsed)
+
+    def _timed(self, label: str, fn):
+        start = time.perf_counter()
+        try:
+            conn = self._connect()
+            with conn:  # commit on success, rollback on error
+                return fn(conn)
+        finally:
+            self._record(label, time.perf_counter() - start)
+
+    async def run(self, fn, label: str = "transaction"):
+        """Run ``fn(conn)`` in a single transaction on the DB executor."""
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.pool_size, thread_name_prefix="db")
+        loop = asyncio.get_running_loop()
+        start = time.perf_counter()
+        try:
+            return await loop.run_in_executor(self._executor, self._timed, label, fn)
+        finally:
+            spent = self.time_spent.get()
+            if spent is not None:
+                spent[0] += time.perf_counter() - start
+
+    async def fetchone(self, sql: str, params=(), label: str = None):
+        return await self.run(lambda conn: conn.execute(sql, params).fetchone(), label or _sql_label(sql))
+
+    async def fetchall(self, sql: str, params=(), label: str = None):
+        return await self.run(lambda conn: conn.execute(sql, params).fetchall(), label or _sql_label(sql))
+
+    async def execute(self, sql: str, params=(), label: str = None) -> int:
+        return await self.run(lambda conn: conn.execute(sql, params).rowcount, label or _sql_label(sql))
+
+    async def executemany(self, sql: str, seq, label: str = None) -> int:
+        seq = list(seq)
+        return await self.run(lambda conn: conn.executemany(sql, seq).rowcount, label or _sql_label(sql))
+
+    def query_stats(self) -> dict:
+        """Per-query latency counters: count, total/avg/max milliseconds."""
+        with self._lock:
+            return {
+                label: {
+                    "count": count,
+                    "total_ms": total * 1000,
+                    "avg_ms": total * 1000 / count if count else 0.0,
+                    "max_ms": worst * 1000,
+                }
+                for label, (count, total, worst) in self.stats.items()
+            }
 
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+        with self._lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections.clear()
+        self._local = threading.local()
+
+def _sql_label(sql: str) -> str:
+    return " ".join(sql.split())[:80]
+
+db = Database(DB_NAME, DB_POOL_SIZE)
+
+# --- Database Setup ---
+def _migrate_base(cursor):
+    """Version 1: the original schema, brought up to date for older databases."""
     cursor.execute("""
         CREATE TABLE IF NOT EXISTS tracked_groups (
             group_id INTEGER PRIMARY KEY,
@@ -108,10 +323,72 @@ def init_db():
             group_id INTEGER PRIMARY KEY,
             is_active BOOLEAN DEFAULT 1,
             ban_instead_of_delete BOOLEAN DEFAULT 1,
-            max_warnings INTEGER DEFAULT 3
+            max_warnings INTEGER DEFAULT 3,
+            flood_action TEXT DEFAULT 'delete',
+            flood_limit INTEGER DEFAULT 10,
+            flood_window INTEGER DEFAULT 5,
+            duplicate_limit INTEGER DEFAULT 5
+        )
+    """)
+
+    # Older databases predate the flood-control columns
+    columns = {row[1] for row in cursor.execute("PRAGMA table_info(anti_spam_settings)")}
+    for column, definition in [
+        ("flood_action", "TEXT DEFAULT 'delete'"),
+        ("flood_limit", "INTEGER DEFAULT 10"),
+        ("flood_window", "INTEGER DEFAULT 5"),
+        ("duplicate_limit", "INTEGER DEFAULT 5"),
+    ]:
+        if column not in columns:
+            cursor.execute(f"ALTER TABLE anti_spam_settings ADD COLUMN {column} {definition}")
+
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS spam_triggers (
+            chat_id INTEGER,
+            trigger TEXT NOT NULL,
+            PRIMARY KEY (chat_id, trigger)
+        )
+    """)
+
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS bulk_jobs (
+            job_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            chat_id INTEGER NOT NULL,
+            action TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            created_by INTEGER,
+            status_message_id INTEGER,
+            total INTEGER DEFAULT 0,
+            done_count INTEGER DEFAULT 0,
+            failed_count INTEGER DEFAULT 0,
+            created_at TEXT
+        )
+    """)
+
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS bulk_job_targets (
+            job_id INTEGER,
+            user_id INTEGER,
+            status TEXT NOT NULL DEFAULT 'pending',
+            PRIMARY KEY (job_id, user_id)
+        )
+    """)
+
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS scheduled_jobs (
+            job_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            run_at REAL NOT NULL,
+            kind TEXT NOT NULL,
+            payload TEXT,
+            created_at TEXT,
+            shard INTEGER DEFAULT 0
         )
     """)
 
+    columns = {row[1] for row in cursor.execute("PRAGMA table_info(scheduled_jobs)")}
+    if "shard" not in columns:
+        cursor.execute("ALTER TABLE scheduled_jobs ADD COLUMN shard INTEGER DEFAULT 0")
+
     cursor.execute("""
         CREATE TABLE IF NOT EXISTS group_rules (
             chat_id INTEGER PRIMARY KEY,
@@ -120,11 +397,13 @@ def init_db():
     """)
 
     cursor.execute("""
-        INSERT OR IGNORE INTO group_features (group_id, feature, is_active)
-        VALUES 
+        INSERT INTO group_features (group_id, feature, is_active)
+        VALUES
             (0, 'welcome_message', 1),
             (0, 'anti_spam', 1),
-            (0, 'mute_new_members', 0)
+            (0, 'mute_new_members', 0),
+            (0, 'faq_autoreply', 0)
+        ON CONFLICT DO NOTHING
     """)
 
     cursor.execute("""
@@ -144,775 +423,4767 @@ def init_db():
             question TEXT,
             correct_option INTEGER,
             participants TEXT,
-            created_at TEXT
+            created_at TEXT,
+            message_id INTEGER,
+            scored BOOLEAN DEFAULT 0
         )
     """)
-    conn.commit()
-    conn.close()
-
-init_db()
 
-def track_new_group(chat_id: int, title: str, owner_id: int):
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
+    columns = {row[1] for row in cursor.execute("PRAGMA table_info(games)")}
+    for column, definition in [("message_id", "INTEGER"), ("scored", "BOOLEAN DEFAULT 0")]:
+        if column not in columns:
+            cursor.execute(f"ALTER TABLE games ADD COLUMN {column} {definition}")
 
-    try:
-        cursor.execute("SELECT 1 FROM tracked_groups WHERE group_id = ?", (chat_id,))
-        exists = cursor.fetchone()
+    # One row per chosen option, so winners are a plain indexed lookup
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS votes (
+            poll_id TEXT,
+            user_id INTEGER,
+            option_id INTEGER,
+            voted_at TEXT,
+            PRIMARY KEY (poll_id, user_id, option_id)
+        )
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_votes_option ON votes (poll_id, option_id)")
 
-        if exists:
-            cursor.execute("""
-                UPDATE tracked_groups 
-                SET title = ?, owner_id = ?, date_added = ?
-                WHERE group_id = ?
-            """, (title, owner_id, datetime.now().isoformat(), chat_id))
-        else:
-            cursor.execute("""
-                INSERT INTO tracked_groups 
-                (group_id, title, owner_id, date_added) 
-                VALUES (?, ?, ?, ?)
-            """, (chat_id, title, owner_id, datetime.now().isoformat()))
+    # Leaderboard counters per chat (0 = global) and period ('all', 'w2024-05', 'm2024-02')
+    has_stats = cursor.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'player_stats'"
+    ).fetchone()
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS player_stats (
+            chat_id INTEGER,
+            user_id INTEGER,
+            period TEXT,
+            wins INTEGER DEFAULT 0,
+            games_played INTEGER DEFAULT 0,
+            PRIMARY KEY (chat_id, period, user_id)
+        )
+    """)
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_player_stats_rank
+        ON player_stats (chat_id, period, wins DESC, games_played)
+    """)
+    if not has_stats:
+        cursor.execute("""
+            INSERT INTO player_stats (chat_id, user_id, period, wins, games_played)
+            SELECT 0, user_id, 'all', wins, games_played FROM players
+        """)
 
-            # Insert default features from group_id = 0 template
-            cursor.execute("""
-                INSERT INTO group_features (group_id, feature, is_active)
-                SELECT ?, feature, is_active FROM group_features WHERE group_id = 0
-            """, (chat_id,))
 
-        conn.commit()
-    except sqlite3.Error as e:
-        print(f"Database error in track_new_group: {e}")
-    finally:
-        conn.close()
+def _migrate_compact_games(cursor):
+    """Version 2: epoch timestamps, participants in their own table, indexes.
 
-def get_group_features(group_id: int) -> dict:
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
+    games.participants was a JSON blob that had to be parsed in Python, and the
+    ISO created_at strings made every per-chat lookup a full scan and sort.
+    """
+    cursor.execute("""
+        CREATE TABLE games_v2 (
+            poll_id TEXT PRIMARY KEY,
+            chat_id INTEGER NOT NULL,
+            question TEXT,
+            correct_option INTEGER,
+            created_at INTEGER NOT NULL,
+            message_id INTEGER,
+            scored BOOLEAN DEFAULT 0
+        )
+    """)
+    # created_at was a naive local isoformat(); 'utc' converts it to a real epoch
     cursor.execute("""
-        SELECT feature, is_active FROM group_features WHERE group_id = ?
-    """, (group_id,))
-    features = {row[0]: bool(row[1]) for row in cursor.fetchall()}
-    conn.close()
-    return features
+        INSERT INTO games_v2 (poll_id, chat_id, question, correct_option, created_at, message_id, scored)
+        SELECT poll_id, COALESCE(chat_id, 0), question, correct_option,
+               COALESCE(CAST(strftime('%s', created_at, 'utc') AS INTEGER), 0),
+               message_id, COALESCE(scored, 0)
+        FROM games
+    """)
 
-# --- Helper Functions ---
-async def is_group_admin(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id: int = None) -> bool:
-    if not update.effective_chat:
-        return False
+    cursor.execute("""
+        CREATE TABLE game_participants (
+            poll_id TEXT,
+            user_id INTEGER,
+            name TEXT,
+            PRIMARY KEY (poll_id, user_id)
+        ) WITHOUT ROWID
+    """)
+    cursor.execute("""
+        INSERT OR IGNORE INTO game_participants (poll_id, user_id, name)
+        SELECT g.poll_id, ids.value, json_extract(g.participants, '$.names[' || ids.key || ']')
+        FROM games g, json_each(g.participants, '$.ids') ids
+        WHERE json_valid(g.participants)
+    """)
 
-    user_id = user_id or update.effective_user.id
-    try:
-        member = await context.bot.get_chat_member(update.effective_chat.id, user_id)
-        return member.status in ["administrator", "creator"]
-    except Exception:
-        return False
+    cursor.execute("DROP TABLE games")
+    cursor.execute("ALTER TABLE games_v2 RENAME TO games")
+    # Covers "latest game in this chat" without touching the table
+    cursor.execute("CREATE INDEX idx_games_chat_created ON games (chat_id, created_at, poll_id)")
+    cursor.execute("CREATE INDEX idx_games_created ON games (created_at)")
 
-async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if update.effective_chat.type != "private":
-        track_new_group(
-            update.effective_chat.id,
-            update.effective_chat.title,
-            update.effective_user.id
+    cursor.execute("""
+        CREATE TABLE players_v2 (
+            user_id INTEGER PRIMARY KEY,
+            username TEXT,
+            wins INTEGER DEFAULT 0,
+            games_played INTEGER DEFAULT 0,
+            last_played INTEGER
         )
+    """)
+    cursor.execute("""
+        INSERT INTO players_v2 (user_id, username, wins, games_played, last_played)
+        SELECT user_id, username, wins, games_played, CAST(strftime('%s', last_played, 'utc') AS INTEGER)
+        FROM players
+    """)
+    cursor.execute("DROP TABLE players")
+    cursor.execute("ALTER TABLE players_v2 RENAME TO players")
 
-    welcome_msg = """
-    👋 *Hi, I'm your Group Helper Bot!*
-
-    *Main Commands:*
-    /help - Show all commands
-    /rules - Group rules
-    /games - Fun games
-
-    Need help?"""
+    cursor.execute("""
+        CREATE TABLE votes_v2 (
+            poll_id TEXT,
+            user_id INTEGER,
+            option_id INTEGER,
+            voted_at INTEGER,
+            PRIMARY KEY (poll_id, user_id, option_id)
+        ) WITHOUT ROWID
+    """)
+    cursor.execute("""
+        INSERT INTO votes_v2 (poll_id, user_id, option_id, voted_at)
+        SELECT poll_id, user_id, option_id, CAST(strftime('%s', voted_at, 'utc') AS INTEGER)
+        FROM votes
+    """)
+    cursor.execute("DROP TABLE votes")
+    cursor.execute("ALTER TABLE votes_v2 RENAME TO votes")
+    cursor.execute("CREATE INDEX idx_votes_option ON votes (poll_id, option_id)")
 
-    keyboard = [
-        [InlineKeyboardButton("➕ Add to Group",
-                            url="https://t.me/grphelper_bot?startgroup=true")],
-        [InlineKeyboardButton("🆘 Support", url="https://t.me/dax_channel01")]
-    ]
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_bulk_jobs_status
+        ON bulk_jobs (status, created_at)
+    """)
 
-    try:
-        await update.message.reply_text(
-            welcome_msg,
-            parse_mode="Markdown",
-            reply_markup=InlineKeyboardMarkup(keyboard),
-            disable_web_page_preview=True
+def _migrate_spam_rules(cursor):
+    """Version 3: typed per-group spam rules (keyword or regex) and a dry-run flag."""
+    cursor.execute("""
+        CREATE TABLE spam_triggers_v3 (
+            rule_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            chat_id INTEGER NOT NULL,
+            kind TEXT NOT NULL DEFAULT 'keyword',
+            trigger TEXT NOT NULL,
+            created_by INTEGER,
+            created_at INTEGER,
+            UNIQUE (chat_id, kind, trigger)
         )
-    except Exception as e:
-        print(f"Error sending start message: {e}")
-        await update.message.reply_text(
-            "👋 Hi! I'm your Group Helper Bot!\nUse /help for commands.",
-            reply_markup=InlineKeyboardMarkup(keyboard)
+    """)
+    cursor.execute("""
+        INSERT INTO spam_triggers_v3 (chat_id, kind, trigger)
+        SELECT chat_id, 'keyword', trigger FROM spam_triggers
+    """)
+    cursor.execute("DROP TABLE spam_triggers")
+    cursor.execute("ALTER TABLE spam_triggers_v3 RENAME TO spam_triggers")
+    cursor.execute("ALTER TABLE anti_spam_settings ADD COLUMN dry_run BOOLEAN DEFAULT 0")
+
+def _migrate_warnings(cursor):
+    """Version 4: the warnings ledger and escalation settings."""
+    cursor.execute("""
+        CREATE TABLE warnings (
+            warning_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            chat_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            reason TEXT,
+            issued_by INTEGER,
+            created_at INTEGER NOT NULL,
+            expires_at INTEGER NOT NULL
         )
+    """)
+    cursor.execute("CREATE INDEX idx_warnings_user ON warnings (chat_id, user_id, expires_at)")
+    cursor.execute("CREATE INDEX idx_warnings_expiry ON warnings (expires_at)")
+    cursor.execute("ALTER TABLE anti_spam_settings ADD COLUMN warn_action TEXT DEFAULT 'mute'")
+    cursor.execute("ALTER TABLE anti_spam_settings ADD COLUMN warn_on_spam BOOLEAN DEFAULT 0")
 
-# HELP_MESSAGE already defined above
+def _migrate_user_directory(cursor):
+    """Version 5: users seen per chat, for resolving @mentions locally."""
+    cursor.execute("""
+        CREATE TABLE chat_users (
+            chat_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            username TEXT,
+            full_name TEXT,
+            last_seen INTEGER NOT NULL,
+            PRIMARY KEY (chat_id, user_id)
+        ) WITHOUT ROWID
+    """)
+    cursor.execute("CREATE INDEX idx_chat_users_username ON chat_users (chat_id, username)")
+    cursor.execute("CREATE INDEX idx_chat_users_seen ON chat_users (last_seen)")
 
-async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await update.message.reply_text(HELP_MESSAGE, parse_mode="Markdown")
+def _migrate_audit_log(cursor):
+    """Version 6: append-only moderation audit log."""
+    # entry_id is the rowid, so both indexes end in it and serve keyset paging
+    cursor.execute("""
+        CREATE TABLE audit_log (
+            entry_id INTEGER PRIMARY KEY,
+            chat_id INTEGER NOT NULL,
+            action TEXT NOT NULL,
+            target_id INTEGER,
+            actor_id INTEGER,
+            reason TEXT,
+            created_at INTEGER NOT NULL
+        )
+    """)
+    cursor.execute("CREATE INDEX idx_audit_chat ON audit_log (chat_id)")
+    cursor.execute("CREATE INDEX idx_audit_target ON audit_log (chat_id, target_id)")
+    for event in ("UPDATE", "DELETE"):
+        cursor.execute(f"""
+            CREATE TRIGGER audit_log_no_{event.lower()} BEFORE {event} ON audit_log
+            BEGIN SELECT RAISE(ABORT, 'audit_log is append-only'); END
+        """)
 
-# --- Merged button_handler to fix duplicate ---
-async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    query = update.callback_query
+def _migrate_activity_rollups(cursor):
+    """Version 7: hourly per-chat and daily per-user activity rollups."""
+    cursor.execute("""
+        CREATE TABLE activity_hourly (
+            chat_id INTEGER NOT NULL,
+            hour INTEGER NOT NULL,
+            messages INTEGER NOT NULL DEFAULT 0,
+            spam INTEGER NOT NULL DEFAULT 0,
+            joins INTEGER NOT NULL DEFAULT 0,
+            leaves INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (chat_id, hour)
+        ) WITHOUT ROWID
+    """)
+    cursor.execute("""
+        CREATE TABLE user_activity_daily (
+            chat_id INTEGER NOT NULL,
+            day INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            messages INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (chat_id, day, user_id)
+        ) WITHOUT ROWID
+    """)
+    cursor.execute("CREATE INDEX idx_activity_hourly_hour ON activity_hourly (hour)")
+    cursor.execute("CREATE INDEX idx_user_activity_day ON user_activity_daily (day)")
 
-    try:
-        await query.answer()
+def _migrate_timed_mutes(cursor):
+    """Version 8: the expiring mute a scheduled unmute may still lift, per user."""
+    cursor.execute("""
+        CREATE TABLE timed_mutes (
+            chat_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            lift_tag TEXT NOT NULL,
+            PRIMARY KEY (chat_id, user_id)
+        ) WITHOUT ROWID
+    """)
 
-        if query.data == "help_commands":
-            await query.edit_message_text(
-                HELP_MESSAGE,
-                parse_mode="Markdown"
-            )
+def _migrate_leaderboard_keyset(cursor):
+    """Version 9: end the rank index with user_id so keyset paging can seek on it."""
+    cursor.execute("DROP INDEX IF EXISTS idx_player_stats_rank")
+    cursor.execute("""
+        CREATE INDEX idx_player_stats_rank
+        ON player_stats (chat_id, period, wins DESC, games_played, user_id)
+    """)
 
-        elif query.data == "show_games":
-            await show_games_menu(update, context)
+# Append new steps here; each runs once, in order, and bumps PRAGMA user_version
+MIGRATIONS = [
+    (1, _migrate_base),
+    (2, _migrate_compact_games),
+    (3, _migrate_spam_rules),
+    (4, _migrate_warnings),
+    (5, _migrate_user_directory),
+    (6, _migrate_audit_log),
+    (7, _migrate_activity_rollups),
+    (8, _migrate_timed_mutes),
+    (9, _migrate_leaderboard_keyset),
+]
+SCHEMA_VERSION = MIGRATIONS[-1][0]
 
-        elif query.data == "back_to_main":
-            await start(update, context)
+def apply_migrations(conn, up_to: int = SCHEMA_VERSION) -> int:
+    """Run pending migrations, each in its own transaction. Returns the new version.
 
-        elif query.data.startswith("toggle_"):
-            await toggle_feature(update, context)
+    The version is re-read under the write lock, so processes starting
+    together (e.g. shard workers) apply each step exactly once.
+    """
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    for target, migrate in MIGRATIONS:
+        if version < target <= up_to:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                version = conn.execute("PRAGMA user_version").fetchone()[0]
+                if version < target:
+                    migrate(conn.cursor())
+                    conn.execute(f"PRAGMA user_version = {target}")
+                    version = target
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+    return version
 
-        else:
-            await query.edit_message_text("❌ Unknown command")
+_schema_checked = False
 
-    except Exception as e:
-        await query.answer("⚠️ Error: Please try again")
-        print(f"Button handler error: {e}")
+def init_db():
+    """Bring the database up to SCHEMA_VERSION.
 
-async def toggle_feature(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Handle feature toggle callbacks"""
+    Reading user_version is all a restart costs once the schema is current,
+    and later calls in the same process return immediately.
+    """
+    global _schema_checked
+    if _schema_checked:
+        return
+    conn = sqlite3.connect(DB_NAME, timeout=60)  # FIXED: Use DB_NAME once
+    try:
+        if conn.execute("PRAGMA user_version").fetchone()[0] < SCHEMA_VERSION:
+            conn.execute("PRAGMA journal_mode=WAL")
+            apply_migrations(conn)
+    finally:
+        conn.close()
+    _schema_checked = True
+    startup.mark("schema_ready")
 
-    query = update.callback_query
-    await query.answer()
+async def track_new_group(chat_id: int, title: str, owner_id: int):
+    def _track(conn):
+        cursor = conn.cursor()
+        cursor.execute("""
+            INSERT INTO tracked_groups (group_id, title, owner_id, date_added)
+            VALUES (?, ?, ?, ?)
+            ON CONFLICT(group_id) DO UPDATE SET
+                title = excluded.title,
+                owner_id = excluded.owner_id,
+                date_added = excluded.date_added
+        """, (chat_id, title, owner_id, datetime.now().isoformat()))
 
-    if not await is_group_admin(update, context):
-        await query.edit_message_text("🚫 Admin only!")
-        return
+        # Copy default features from the group_id = 0 template, keeping existing choices
+        cursor.execute("""
+            INSERT INTO group_features (group_id, feature, is_active)
+            SELECT ?, feature, is_active FROM group_features WHERE group_id = 0
+            ON CONFLICT(group_id, feature) DO NOTHING
+        """, (chat_id,))
 
-    # FIXED: Updated parsing format - expected "toggle_<feature>_<groupid>"
-    parts = query.data.split("_", 2)
-    if len(parts) != 3:
-        await query.edit_message_text("❌ Invalid toggle command format.")
-        return
+        return {feature: bool(active) for feature, active in cursor.execute(
+            "SELECT feature, is_active FROM group_features WHERE group_id = ?", (chat_id,)
+        )}
 
-    _, feature, group_id_str = parts
     try:
-        group_id = int(group_id_str)
-    except ValueError:
-        await query.edit_message_text("❌ Invalid group ID.")
-        return
+        features = await db.run(_track, label="track_new_group")
+        settings_cache.update(chat_id, features=features)
+    except sqlite3.Error as e:
+        print(f"Database error in track_new_group: {e}")
 
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
+async def get_group_features(group_id: int) -> dict:
+    return (await settings_cache.get(group_id))["features"]
 
-    cursor.execute("""
-        UPDATE group_features
-        SET is_active = NOT is_active
-        WHERE group_id = ? AND feature = ?
-    """, (group_id, feature))
-    conn.commit()
-    conn.close()
+# --- Group Settings Cache ---
+ANTI_SPAM_COLUMNS = (
+    "is_active, ban_instead_of_delete, max_warnings, "
+    "flood_action, flood_limit, flood_window, duplicate_limit, dry_run, "
+    "warn_action, warn_on_spam"
+)
 
-    # Refresh menu after toggling
-    await button_handler(update, context)
+def _anti_spam_row(row) -> dict:
+    return {
+        "is_active": bool(row[0]),
+        "ban_instead_of_delete": bool(row[1]),
+        "max_warnings": row[2],
+        "flood_action": row[3],
+        "flood_limit": row[4],
+        "flood_window": row[5],
+        "duplicate_limit": row[6],
+        "dry_run": bool(row[7]),
+        "warn_action": row[8],
+        "warn_on_spam": bool(row[9]),
+    }
 
-async def games_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    keyboard = [
-        [InlineKeyboardButton("Truth or Dare", callback_data="game_truthordare")],
-        [InlineKeyboardButton("Meme Battle", callback_data="game_memebattle")],
-        [InlineKeyboardButton("Back", callback_data="back_to_main")]
-    ]
+def _load_spam_rules(conn, group_id: int) -> tuple:
+    """The group's (rule_id, kind, trigger) rows in the order they were added."""
+    return tuple(conn.execute(
+        "SELECT rule_id, kind, trigger FROM spam_triggers WHERE chat_id = ? ORDER BY rule_id", (group_id,)
+    ))
 
-    await update.message.reply_text(
-        "🎮 *Available Games*\nSelect one:",
-        parse_mode="Markdown",
-        reply_markup=InlineKeyboardMarkup(keyboard)
-    )
+def _load_group_settings(conn, group_id: int) -> dict:
+    row = conn.execute(
+        f"SELECT {ANTI_SPAM_COLUMNS} FROM anti_spam_settings WHERE group_id = ?", (group_id,)
+    ).fetchone()
+    features = conn.execute(
+        "SELECT feature, is_active FROM group_features WHERE group_id = ?", (group_id,)
+    ).fetchall()
+    rules = conn.execute(
+        "SELECT rules_text FROM group_rules WHERE chat_id = ?", (group_id,)
+    ).fetchone()
+    return {
+        "anti_spam": _anti_spam_row(row) if row else None,
+        "features": {feature: bool(active) for feature, active in features},
+        "rules": rules[0] if rules else None,
+        "triggers": _load_spam_rules(conn, group_id),
+        "matcher": None,  # compiled lazily by get_spam_matcher
+    }
 
-async def show_games_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    query = update.callback_query
-    await query.answer()
+class GroupSettingsCache:
+    """LRU cache of anti-spam settings, feature flags and rules per group.
 
-    game_keyboard = [
-        [InlineKeyboardButton("Truth or Dare", switch_inline_query_current_chat="/truthordare ")],
-        [InlineKeyboardButton("Meme Battle", switch_inline_query_current_chat="/meme ")],
-        [InlineKeyboardButton("Joke Contest", switch_inline_query_current_chat="/joke ")],
-        [InlineKeyboardButton("🔙 Back", callback_data="back_to_main")]
-    ]
+    Writers update the database first and then push the new values here, so
+    a warm cache never needs a database round trip.
+    """
 
-    await query.edit_message_text(
-        text="🎮 *Select a Game*\n\nYou'll need to tag someone to play!",
-        parse_mode="Markdown",
-        reply_markup=InlineKeyboardMarkup(game_keyboard)
-    )
+    def __init__(self, maxsize: int = 10000):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._writes = 0  # bumped on every write; guards against stale loads
 
-async def truth_or_dare(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if len(context.args) < 1:
-        await update.message.reply_text("Please tag someone: /truthordare @username")
-        return
+    async def get(self, group_id: int) -> dict:
+        entry = self._entries.get(group_id)
+        if entry is not None:
+            self._entries.move_to_end(group_id)
+            return entry
 
-    questions = [
-        "Truth: What's your most embarrassing moment?",
-        "Dare: Send a voice message singing for 30 seconds!"
-    ]
-    await update.message.reply_text(random.choice(questions))
+        writes = self._writes
+        entry = await db.run(lambda conn: _load_group_settings(conn, group_id), label="load_group_settings")
+        if group_id in self._entries:
+            return self._entries[group_id]
+        if writes == self._writes:
+            self._entries[group_id] = entry
+            if len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return entry
 
-async def start_wcg(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not context.args:
-        await update.message.reply_text("Usage: /wcg @user1 @user2")
-        return
+    def update(self, group_id: int, **fields):
+        self._writes += 1
+        entry = self._entries.get(group_id)
+        if entry is not None:
+            entry.update(fields)
+            if "triggers" in fields:
+                entry["matcher"] = None  # recompiled on next use
 
-    participants = {
-        "ids": [update.effective_user.id],
-        "names": [update.effective_user.first_name]
-    }
+    def set_feature(self, group_id: int, feature: str, is_active: bool):
+        self._writes += 1
+        entry = self._entries.get(group_id)
+        if entry is not None:
+            entry["features"][feature] = is_active
 
-    for entity in update.message.entities:
-        if entity.type == "mention":
-            mention_text = update.message.text[entity.offset:entity.offset+entity.length]
+    def invalidate(self, group_id: int):
+        self._writes += 1
+        self._entries.pop(group_id, None)
 
-            try:
-                # Note: This may fail if username is not accessible; common limitation.
-                member = await context.bot.get_chat_member(
-                    update.effective_chat.id,
-                    mention_text[1:]  # Remove @ symbol
-                )
-                participants["ids"].append(member.user.id)
-                participants["names"].append(member.user.first_name)
-            except Exception as e:
-                print(f"Error processing mention {mention_text}: {e}")
-                continue
+settings_cache = GroupSettingsCache(SETTINGS_CACHE_SIZE)
 
-    if len(participants["ids"]) < 2:
-        await update.message.reply_text(
-            "❌ Need at least 2 players! Make sure you mentioned valid users.\n"
-            "Example: /wcg @username1 @username2"
-        )
-        return
+# --- Spam Matcher ---
+# Look-alike characters commonly used to dodge keyword filters
+HOMOGLYPHS = str.maketrans({
+    "а": "a", "е": "e", "о": "o", "р": "p", "с": "c", "у": "y", "х": "x",
+    "м": "m", "к": "k", "н": "h", "т": "t", "в": "b",
+    "і": "i", "ј": "j", "ѕ": "s", "ԁ": "d", "ԛ": "q", "ԝ": "w", "һ": "h",
+    "ο": "o", "α": "a", "ε": "e", "ι": "i", "κ": "k", "ν": "v", "ρ": "p",
+    "τ": "t", "υ": "u", "χ": "x", "ѵ": "v", "ɡ": "g", "ı": "i",
+    "\u200b": None, "\u200c": None, "\u200d": None, "\u2060": None, "\ufeff": None,
+})
 
-    question = random.choice(QUESTIONS)
-    poll = await context.bot.send_poll(
-        chat_id=update.effective_chat.id,
-        question=question["question"],
-        options=question["options"],
+def normalize_text(text: str) -> str:
+    """Case-fold, NFKC-normalize and map homoglyphs to their ASCII look-alikes."""
+    return unicodedata.normalize("NFKC", text).casefold().translate(HOMOGLYPHS)
+
+class SpamMatcher:
+    """Aho-Corasick automaton that finds every trigger in one pass over the text."""
+
+    def __init__(self, triggers):
+        originals = {}
+        for trigger in triggers:
+            key = normalize_text(trigger)
+            if key.strip():
+                originals.setdefault(key, trigger)
+        self.triggers = tuple(originals.values())
+
+        goto, fail, out = [{}], [0], [()]
+        for index, pattern in enumerate(originals):
+            state = 0
+            for ch in pattern:
+                nxt = goto[state].get(ch)
+                if nxt is None:
+                    nxt = len(goto)
+                    goto.append({})
+                    fail.append(0)
+                    out.append(())
+                    goto[state][ch] = nxt
+                state = nxt
+            out[state] += (index,)
+
+        queue = deque(goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for ch, nxt in goto[state].items():
+                queue.append(nxt)
+                link = fail[state]
+                while link and ch not in goto[link]:
+                    link = fail[link]
+                fail[nxt] = goto[link].get(ch, 0)
+                out[nxt] += out[fail[nxt]]
+
+        self._goto, self._fail, self._out = goto, fail, out
+
+    def find_all(self, text: str, normalized: bool = False) -> list:
+        goto, fail, out = self._goto, self._fail, self._out
+        state = 0
+        found = set()
+        for ch in text if normalized else normalize_text(text):
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            if out[state]:
+                found.update(out[state])
+        return [self.triggers[index] for index in sorted(found)]
+
+_REPEAT_OPS = (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT)
+_BACKREF_OPS = (sre_parse.GROUPREF, sre_parse.GROUPREF_EXISTS)
+
+def _regex_hazard(items, repeated: bool = False):
+    """Find constructs that can backtrack exponentially in a parsed pattern."""
+    for op, av in items:
+        if op in _REPEAT_OPS:
+            low, high, sub = av
+            if repeated and low != high:
+                return "Nested quantifiers such as (a+)+ can backtrack catastrophically."
+            children = [sub]
+            repeated_inside = repeated or high > 1
+        elif op in _BACKREF_OPS:
+            return "Backreferences are not allowed."
+        elif op == sre_parse.SUBPATTERN:
+            children, repeated_inside = [av[-1]], repeated
+        elif op == sre_parse.BRANCH:
+            children, repeated_inside = av[1], repeated
+        elif op in (sre_parse.ASSERT, sre_parse.ASSERT_NOT):
+            children, repeated_inside = [av[1]], repeated
+        else:
+            continue
+        for child in children:
+            problem = _regex_hazard(child, repeated_inside)
+            if problem:
+                return problem
+    return None
+
+def validate_spam_regex(pattern: str):
+    """Return why ``pattern`` can't join a group's combined regex, or None if it can."""
+    if len(pattern) > SPAM_RULE_MAX_LENGTH:
+        return f"Patterns are limited to {SPAM_RULE_MAX_LENGTH} characters."
+    try:
+        parsed = sre_parse.parse(pattern, re.IGNORECASE)
+        re.compile(f"(?:{pattern})", re.IGNORECASE)  # must still compile as one alternative
+    except re.error as e:
+        return f"Invalid regex: {e}"
+    state = getattr(parsed, "state", None) or parsed.pattern
+    if state.groupdict:
+        return "Named groups are not allowed."
+    return _regex_hazard(parsed)
+
+def _regex_probes(pattern: str) -> list:
+    """Message-sized near misses: runs of the pattern's own characters ending in a mismatch."""
+    seeds = {"a", "1", " ", "a1", "a ", ".a"}
+    chars = sorted({ch for ch in pattern if ch.isalnum() or ch in " .-_@/:"})
+    seeds.update(chars[:8])
+    if chars:
+        seeds.add("".join(chars))
+    return [seed * (4096 // len(seed)) + "\u2603" for seed in sorted(seeds)]
+
+def _probe_regex(pattern: str, sender):
+    compiled = re.compile(pattern, re.IGNORECASE)
+    sender.send(None)  # started; the parent's timeout covers matching only
+    worst = 0.0
+    for probe in _regex_probes(pattern):
+        start = time.perf_counter()
+        compiled.search(probe)
+        worst = max(worst, time.perf_counter() - start)
+    sender.send(worst)
+    sender.close()
+
+async def probe_spam_regex(pattern: str):
+    """Worst search time over the probes, measured in a child process that is
+    killed after SPAM_REGEX_PROBE_TIMEOUT; returns None if it never finished."""
+    # Never fork: this process runs DB executor threads whose locks a child could inherit held
+    ctx = multiprocessing.get_context("spawn")
+    receiver, sender = ctx.Pipe(duplex=False)
+    process = ctx.Process(target=_probe_regex, args=(pattern, sender), daemon=True)
+    process.start()
+    sender.close()
+    loop = asyncio.get_running_loop()
+    try:
+        if not await loop.run_in_executor(None, receiver.poll, SPAM_REGEX_PROBE_STARTUP):
+            return None
+        receiver.recv()
+        if await loop.run_in_executor(None, receiver.poll, SPAM_REGEX_PROBE_TIMEOUT):
+            return receiver.recv()
+        return None
+    except EOFError:
+        return None
+    finally:
+        if process.is_alive():
+            process.kill()
+        await loop.run_in_executor(None, process.join)
+        receiver.close()
+
+class SpamRuleSet:
+    """A group's spam rules compiled once: the built-in and custom keywords in
+    one automaton, and every regex rule joined into one alternation.
+
+    Regex matching switches itself off for the group, until its rules next
+    change, if a message ever takes longer than SPAM_REGEX_BUDGET_MS. Matching
+    runs on the event loop, so the budget only takes effect after a slow
+    match has already blocked it once; validate_spam_regex and
+    probe_spam_regex are what keep such patterns out in the first place.
+    """
+
+    def __init__(self, rules=()):
+        self.rules = tuple(rules)
+        keywords = {trigger: None for trigger in SPAM_TRIGGERS}  # built-ins have no rule id
+        regexes = []
+        for rule_id, kind, trigger in self.rules:
+            if kind == "regex":
+                regexes.append((rule_id, trigger))
+            else:
+                keywords.setdefault(trigger, rule_id)
+        self._keyword_ids = keywords
+        self.keywords = SpamMatcher(keywords)
+
+        self._regex_rules = {f"r{index}": rule for index, rule in enumerate(regexes)}
+        self.regex = re.compile(
+            "|".join(f"(?P<{name}>{pattern})" for name, (_, pattern) in self._regex_rules.items()),
+            re.IGNORECASE
+        ) if regexes else None
+        self.regex_disabled = False
+        self.slow_match_ms = None
+
+    def check(self, text: str):
+        """Return (rule, seconds): the first rule that fired as (rule_id, kind, trigger), or None."""
+        start = time.perf_counter()
+        normalized = normalize_text(text)
+        found = self.keywords.find_all(normalized, normalized=True)
+        if found:
+            return (self._keyword_ids.get(found[0]), "keyword", found[0]), time.perf_counter() - start
+        if self.regex is None or self.regex_disabled:
+            return None, time.perf_counter() - start
+
+        regex_start = time.perf_counter()
+        match = self.regex.search(normalized)
+        regex_seconds = time.perf_counter() - regex_start
+        if regex_seconds * 1000 > SPAM_REGEX_BUDGET_MS:
+            self.regex_disabled = True
+            self.slow_match_ms = regex_seconds * 1000
+        rule = None
+        if match:
+            rule_id, pattern = self._regex_rules[match.lastgroup]
+            rule = (rule_id, "regex", pattern)
+        return rule, time.perf_counter() - start
+
+_global_matcher = None
+
+def get_spam_matcher(settings: dict) -> SpamRuleSet:
+    """Return the compiled rule set for a cached group entry, building it on first use."""
+    global _global_matcher
+    matcher = settings.get("matcher")
+    if matcher is None:
+        if settings["triggers"]:
+            matcher = SpamRuleSet(settings["triggers"])
+        else:
+            if _global_matcher is None:
+                _global_matcher = SpamRuleSet()
+            matcher = _global_matcher
+        settings["matcher"] = matcher
+    return matcher
+
+def markdown_mention(user) -> str:
+    """A Markdown mention whose name can't break the surrounding message's markup."""
+    return f"[{escape_markdown(user.full_name)}](tg://user?id={user.id})"
+
+def describe_spam_rule(rule) -> str:
+    rule_id, kind, trigger = rule
+    trigger = trigger.replace("`", "'")
+    return f"#{rule_id} {kind} `{trigger}`" if rule_id else f"built-in keyword `{trigger}`"
+
+# --- Admin Cache ---
+class AdminCache:
+    """TTL cache of admin status per (chat, user).
+
+    A prefetched admin list answers lookups for every user in the chat, so a
+    single get_chat_administrators call covers a whole moderation storm.
+    """
+
+    def __init__(self, ttl: float = 300, maxsize: int = 50000):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._members = OrderedDict()  # (chat_id, user_id) -> (is_admin, expires_at)
+        self._chats = {}  # chat_id -> (frozenset of admin ids, expires_at)
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, chat_id: int, user_id: int):
+        now = time.monotonic()
+        admins = self._chats.get(chat_id)
+        if admins and admins[1] > now:
+            self.hits += 1
+            return user_id in admins[0]
+        entry = self._members.get((chat_id, user_id))
+        if entry and entry[1] > now:
+            self.hits += 1
+            return entry[0]
+        self.misses += 1
+        return None
+
+    def set(self, chat_id: int, user_id: int, is_admin: bool):
+        key = (chat_id, user_id)
+        self._members[key] = (is_admin, time.monotonic() + self.ttl)
+        self._members.move_to_end(key)
+        while len(self._members) > self.maxsize:
+            self._members.popitem(last=False)
+
+    def set_admins(self, chat_id: int, admin_ids):
+        self._chats[chat_id] = (frozenset(admin_ids), time.monotonic() + self.ttl)
+        if len(self._chats) > self.maxsize:
+            now = time.monotonic()
+            self._chats = {chat: entry for chat, entry in self._chats.items() if entry[1] > now}
+
+    def invalidate(self, chat_id: int, user_id: int = None):
+        self._chats.pop(chat_id, None)
+        if user_id is not None:
+            self._members.pop((chat_id, user_id), None)
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "entries": len(self._members),
+            "chats": len(self._chats),
+        }
+
+admin_cache = AdminCache(ADMIN_CACHE_TTL, ADMIN_CACHE_SIZE)
+
+async def prefetch_admins(bot, chat_id: int) -> frozenset:
+    """Load the chat's full admin list into the cache with one API call."""
+    admins = await bot.get_chat_administrators(chat_id)
+    admin_ids = frozenset(member.user.id for member in admins)
+    admin_cache.set_admins(chat_id, admin_ids)
+    return admin_ids
+
+async def on_chat_member_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    change = update.chat_member or update.my_chat_member
+    if not change:
+        return
+
+    was_admin = change.old_chat_member.status in ["administrator", "creator"]
+    is_admin = change.new_chat_member.status in ["administrator", "creator"]
+    if was_admin != is_admin:
+        admin_cache.invalidate(change.chat.id)
+    admin_cache.set(change.chat.id, change.new_chat_member.user.id, is_admin)
+
+# --- User Directory ---
+_CHAT_USER_UPSERT = """
+    INSERT INTO chat_users (chat_id, user_id, username, full_name, last_seen) VALUES (?, ?, ?, ?, ?)
+    ON CONFLICT(chat_id, user_id) DO UPDATE SET
+        username = excluded.username,
+        full_name = excluded.full_name,
+        last_seen = MAX(last_seen, excluded.last_seen)
+"""
+
+class UserDirectory:
+    """Users seen in each chat, so @mentions resolve without Bot API calls.
+
+    An LRU of (chat, user) entries with a per-chat username index sits in
+    front of the chat_users table. Sightings are upserted in batches, and a
+    user seen again within ``touch_seconds`` under the same names costs
+    nothing.
+    """
+
+    def __init__(self, maxsize: int = 100000, flush_interval: float = 5.0, touch_seconds: float = 3600):
+        self.maxsize = maxsize
+        self.flush_interval = flush_interval
+        self.touch_seconds = touch_seconds
+        self._entries = OrderedDict()  # (chat_id, user_id) -> (username, full_name, last_seen)
+        self._usernames = {}  # (chat_id, lowercase username) -> user_id
+        self._dirty = {}  # (chat_id, user_id) -> (username, full_name, last_seen)
+        self._lock = asyncio.Lock()
+        self._task = None
+        self.flushed = 0
+
+    def observe(self, chat_id: int, user):
+        username = user.username.lower() if user.username else None
+        self._remember(chat_id, user.id, username, user.full_name, int(time.time()), persist=True)
+
+    def _remember(self, chat_id: int, user_id: int, username, full_name, seen: int, persist: bool = False):
+        key = (chat_id, user_id)
+        old = self._entries.get(key)
+        if old is not None:
+            self._entries.move_to_end(key)
+            if old[:2] == (username, full_name) and seen - old[2] < self.touch_seconds:
+                return
+            if old[0] and old[0] != username and self._usernames.get((chat_id, old[0])) == user_id:
+                del self._usernames[(chat_id, old[0])]
+
+        entry = (username, full_name, seen)
+        self._entries[key] = entry
+        if username:
+            self._usernames[(chat_id, username)] = user_id
+        if persist:
+            self._dirty[key] = entry
+            if self._task is None:
+                self.start()
+        while len(self._entries) > self.maxsize:
+            (old_chat, old_user), (old_name, _, _) = self._entries.popitem(last=False)
+            if old_name and self._usernames.get((old_chat, old_name)) == old_user:
+                del self._usernames[(old_chat, old_name)]
+
+    async def resolve(self, chat_id: int, username: str):
+        """(user_id, username, full_name) for an @username seen in this chat, or None."""
+        username = username.lstrip("@").lower()
+        user_id = self._usernames.get((chat_id, username))
+        if user_id is not None:
+            entry = self._entries[(chat_id, user_id)]
+            return user_id, entry[0], entry[1]
+
+        row = await db.fetchone(
+            """SELECT user_id, username, full_name, last_seen FROM chat_users
+            WHERE chat_id = ? AND username = ? ORDER BY last_seen DESC LIMIT 1""",
+            (chat_id, username)
+        )
+        if row is None:
+            return None
+        current = self._entries.get((chat_id, row[0]))
+        if current is not None and current[0] != username:
+            return None  # renamed since that row was written
+        self._remember(chat_id, *row)
+        return row[:3]
+
+    async def get(self, chat_id: int, user_id: int):
+        """(user_id, username, full_name) for a user seen in this chat, or None."""
+        entry = self._entries.get((chat_id, user_id))
+        if entry is not None:
+            return user_id, entry[0], entry[1]
+        row = await db.fetchone(
+            "SELECT user_id, username, full_name, last_seen FROM chat_users WHERE chat_id = ? AND user_id = ?",
+            (chat_id, user_id)
+        )
+        if row is None:
+            return None
+        self._remember(chat_id, *row)
+        return row[:3]
+
+    async def flush(self) -> int:
+        async with self._lock:
+            if not self._dirty:
+                return 0
+            batch, self._dirty = self._dirty, {}
+            rows = [(chat_id, user_id, *entry) for (chat_id, user_id), entry in batch.items()]
+            try:
+                await db.executemany(_CHAT_USER_UPSERT, rows)
+            except sqlite3.Error as e:
+                print(f"User directory flush error: {e}")
+                for key, entry in batch.items():
+                    self._dirty.setdefault(key, entry)
+                return 0
+            self.flushed += len(rows)
+            return len(rows)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self.flush()
+
+user_directory = UserDirectory(USER_DIRECTORY_SIZE, USER_DIRECTORY_FLUSH_INTERVAL, USER_DIRECTORY_TOUCH_SECONDS)
+
+async def record_users(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Feed the user directory from every group update (poll voters are added when votes flush)."""
+    chat = update.effective_chat
+    if not chat or chat.type == "private":
+        return
+    user = update.effective_user
+    if user and not user.is_bot:
+        user_directory.observe(chat.id, user)
+    message = update.effective_message
+    if message:
+        for member in message.new_chat_members or ():
+            if not member.is_bot:
+                user_directory.observe(chat.id, member)
+        replied = message.reply_to_message
+        if replied and replied.from_user and not replied.from_user.is_bot:
+            user_directory.observe(chat.id, replied.from_user)
+
+async def resolve_user_id(chat_id: int, token: str):
+    """User ID from a numeric ID or an @username seen in this chat; None if unknown."""
+    if token.lstrip("-").isdigit():
+        return int(token)
+    if token.startswith("@"):
+        found = await user_directory.resolve(chat_id, token)
+        return found[0] if found else None
+    return None
+
+async def command_target(update: Update, context: ContextTypes.DEFAULT_TYPE, args: list = None):
+    """(user_id, remaining args) from a replied-to message, a text mention, an
+    ID or an @username leading the arguments (``context.args`` unless given);
+    user_id is None if unresolved."""
+    args = list(context.args or [] if args is None else args)
+    message = update.message
+    if message.reply_to_message and message.reply_to_message.from_user:
+        return message.reply_to_message.from_user.id, args
+    for entity in message.entities:
+        if entity.type == "text_mention" and entity.user:
+            words = len(message.text[entity.offset:entity.offset + entity.length].split())
+            return entity.user.id, args[words:]
+    if args:
+        return await resolve_user_id(update.effective_chat.id, args[0]), args[1:]
+    return None, []
+
+# --- Rate Limiting ---
+class RateLimiter:
+    """Spaces out calls per key to at most ``rate`` per second."""
+
+    def __init__(self, rate: float):
+        self.interval = 1.0 / rate
+        self._next_slot = {}
+
+    def reserve(self, key) -> float:
+        """Claim the key's next slot; returns how many seconds away it is."""
+        now = asyncio.get_running_loop().time()
+        slot = max(now, self._next_slot.get(key, 0.0))
+        self._next_slot[key] = slot + self.interval
+        if len(self._next_slot) > 10000:
+            self._next_slot = {k: t for k, t in self._next_slot.items() if t > now}
+        return slot - now
+
+    async def wait(self, key):
+        delay = self.reserve(key)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def pause(self, key, seconds: float):
+        """Push the key's next slot back, e.g. after a RetryAfter from Telegram."""
+        now = asyncio.get_running_loop().time()
+        self._next_slot[key] = max(self._next_slot.get(key, 0.0), now + seconds)
+
+moderation_limiter = RateLimiter(BULK_RATE_PER_CHAT)
+
+MUTED_PERMISSIONS = ChatPermissions(
+    can_send_messages=False,
+    can_send_media_messages=False,
+    can_send_other_messages=False,
+    can_add_web_page_previews=False
+)
+UNMUTED_PERMISSIONS = ChatPermissions(
+    can_send_messages=True,
+    can_send_media_messages=True,
+    can_send_other_messages=True,
+    can_add_web_page_previews=True
+)
+
+# --- Outbound Queue ---
+PRIORITY_MODERATION = 0
+PRIORITY_NORMAL = 1
+PRIORITY_CHATTER = 2
+
+class OutboundQueue:
+    """Central send queue with global and per-chat rate limits.
+
+    Each chat has its own queue, and a chat is handed to the workers only
+    once its rate-limit slot has come up, so a busy chat never ties up a
+    worker while other chats wait. Lower priority numbers go first, so
+    moderation notices overtake game and joke chatter. Repeated notices for
+    a chat are merged into one summary.
+    """
+
+    def __init__(self, global_rate: float, chat_rate: float, workers: int = 4,
+                 coalesce_seconds: float = 5.0, max_retries: int = 3):
+        self._global = RateLimiter(global_rate)
+        self._chat = RateLimiter(chat_rate)
+        self.workers = workers
+        self.coalesce_seconds = coalesce_seconds
+        self.max_retries = max_retries
+        self._ready = None  # (priority, token, chat_id, item) for chats whose slot is free
+        self._pending = {}  # chat_id -> heap of queued items
+        self._scheduled = {}  # chat_id -> [priority, token, waiting for its slot]
+        self._inflight = set()  # chats with a send in progress
+        self._tasks = []
+        self._bot = None
+        self._seq = itertools.count()
+        self._notices = {}  # (chat_id, title) -> list of notice lines
+        self.sent = 0
+        self.failed = 0
+        self.coalesced = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def start(self, bot):
+        self._bot = bot
+        self._ready = asyncio.PriorityQueue()
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def submit(self, method: str, priority: int = PRIORITY_NORMAL, **kwargs) -> asyncio.Future:
+        """Queue ``bot.<method>(**kwargs)``; the returned future resolves to its result.
+
+        A keyword given as a zero-argument callable is called before every
+        attempt, so an upload can hand over a freshly rewound file on retry.
+        """
+        if self._ready is None:
+            raise RuntimeError("Outbound queue is not running")
+        future = asyncio.get_running_loop().create_future()
+        item = (priority, next(self._seq), time.monotonic(), method, kwargs, future, 0)
+        self._enqueue(item)
+        return future
+
+    def send(self, chat_id: int, text: str, priority: int = PRIORITY_NORMAL, **kwargs) -> asyncio.Future:
+        return self.submit("send_message", priority, chat_id=chat_id, text=text, **kwargs)
+
+    def post(self, chat_id: int, text: str, priority: int = PRIORITY_NORMAL, **kwargs) -> asyncio.Future:
+        """Like send, for callers that must not wait out the chat's rate limit."""
+        return self.forget(self.send(chat_id, text, priority, **kwargs))
+
+    @staticmethod
+    def forget(future: asyncio.Future) -> asyncio.Future:
+        future.add_done_callback(lambda f: f.cancelled() or f.exception())  # errors are logged by the worker
+        return future
+
+    def _enqueue(self, item):
+        chat_id = item[4].get("chat_id")
+        if chat_id is None:
+            self._ready.put_nowait((item[0], item[1], None, item))
+            return
+        heapq.heappush(self._pending.setdefault(chat_id, []), item)
+        self._schedule(chat_id)
+
+    def _schedule(self, chat_id):
+        """Make sure the chat's head item will reach a worker once its slot is free."""
+        if chat_id in self._inflight or not self._pending.get(chat_id):
+            return  # rescheduled when the current send finishes
+        priority = self._pending[chat_id][0][0]
+        state = self._scheduled.get(chat_id)
+        if state is None:
+            token = next(self._seq)
+            delay = self._chat.reserve(chat_id)
+            self._scheduled[chat_id] = [priority, token, delay > 0]
+            if delay > 0:
+                asyncio.get_running_loop().call_later(delay, self._release, chat_id, token)
+            else:
+                self._ready.put_nowait((priority, token, chat_id, None))
+        elif not state[2] and priority < state[0]:
+            # Already ready at a lower priority: re-enter at the new one, the old entry goes stale
+            state[0], state[1] = priority, next(self._seq)
+            self._ready.put_nowait((priority, state[1], chat_id, None))
+
+    def _release(self, chat_id, token):
+        state = self._scheduled.get(chat_id)
+        if state is None or state[1] != token or self._ready is None:
+            return
+        state[0], state[2] = self._pending[chat_id][0][0], False
+        self._ready.put_nowait((state[0], token, chat_id, None))
+
+    def notify(self, chat_id: int, title: str, line: str):
+        """Queue a moderation notice, merging those sent within the coalesce window."""
+        key = (chat_id, title)
+        lines = self._notices.get(key)
+        if lines is not None:
+            lines.append(line)
+            self.coalesced += 1
+            return
+        self._notices[key] = [line]
+        asyncio.get_running_loop().call_later(self.coalesce_seconds, self._flush_notices, key)
+
+    def _flush_notices(self, key):
+        lines = self._notices.pop(key, [])
+        if not lines or self._ready is None:
+            return
+        chat_id, title = key
+        if len(lines) == 1:
+            text = f"{title}\n{lines[0]}"
+        else:
+            shown = lines[:10]
+            text = f"{title} ({len(lines)} actions in {self.coalesce_seconds:g}s)\n\n" + "\n\n".join(shown)
+            if len(lines) > len(shown):
+                text += f"\n\n…and {len(lines) - len(shown)} more"
+        self.post(chat_id, text, PRIORITY_MODERATION, parse_mode="Markdown")
+
+    def _take(self, chat_id, token):
+        """Pop a ready chat's head item, or None if the ready entry is stale."""
+        state = self._scheduled.get(chat_id)
+        if state is None or state[1] != token:
+            return None
+        del self._scheduled[chat_id]
+        self._inflight.add(chat_id)
+        return heapq.heappop(self._pending[chat_id])
+
+    def _finish(self, chat_id):
+        self._inflight.discard(chat_id)
+        if self._pending.get(chat_id):
+            self._schedule(chat_id)
+        else:
+            self._pending.pop(chat_id, None)
+
+    async def _worker(self):
+        while True:
+            _, token, chat_id, item = await self._ready.get()
+            if item is None:
+                item = self._take(chat_id, token)
+                if item is None:
+                    continue
+            try:
+                await self._deliver(item)
+            finally:
+                if chat_id is not None:
+                    self._finish(chat_id)
+
+    async def _deliver(self, item):
+        priority, seq, queued_at, method, kwargs, future, attempt = item
+        chat_id = kwargs.get("chat_id")
+        try:
+            await self._global.wait(None)
+            if future.cancelled():
+                return
+            waited = time.monotonic() - queued_at
+            try:
+                result = await getattr(self._bot, method)(
+                    **{key: value() if callable(value) else value for key, value in kwargs.items()}
+                )
+            except RetryAfter as e:
+                if attempt + 1 < self.max_retries:
+                    retry = (priority, seq, queued_at, method, kwargs, future, attempt + 1)
+                    if chat_id is None:
+                        asyncio.get_running_loop().call_later(
+                            e.retry_after, self._ready.put_nowait, (priority, seq, None, retry)
+                        )
+                    else:
+                        # Back at the head of its chat; _finish reschedules after the pause
+                        self._chat.pause(chat_id, e.retry_after)
+                        heapq.heappush(self._pending.setdefault(chat_id, []), retry)
+                    return
+                raise
+            self.sent += 1
+            self.wait_total += waited
+            self.wait_max = max(self.wait_max, waited)
+            if not future.done():
+                future.set_result(result)
+        except asyncio.CancelledError:
+            if not future.done():
+                future.cancel()
+            raise
+        except Exception as e:
+            self.failed += 1
+            print(f"Outbound {method} error: {e}")
+            if not future.done():
+                future.set_exception(e)
+
+    def stats(self) -> dict:
+        return {
+            "depth": sum(len(items) for items in self._pending.values()) + (self._ready.qsize() if self._ready else 0),
+            "pending_notices": sum(len(lines) for lines in self._notices.values()),
+            "sent": self.sent,
+            "failed": self.failed,
+            "coalesced": self.coalesced,
+            "avg_wait_ms": self.wait_total * 1000 / self.sent if self.sent else 0.0,
+            "max_wait_ms": self.wait_max * 1000,
+        }
+
+outbound = OutboundQueue(OUTBOUND_GLOBAL_RATE, OUTBOUND_CHAT_RATE, OUTBOUND_WORKERS, NOTICE_COALESCE_SECONDS)
+
+# --- Helper Functions ---
+async def is_group_admin(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id: int = None) -> bool:
+    if not update.effective_chat:
+        return False
+
+    chat_id = update.effective_chat.id
+    user_id = user_id or update.effective_user.id
+    cached = admin_cache.get(chat_id, user_id)
+    if cached is not None:
+        return cached
+
+    if update.effective_chat.type != "private":
+        try:
+            return user_id in await prefetch_admins(context.bot, chat_id)
+        except Exception as e:
+            print(f"Admin prefetch error: {e}")
+
+    try:
+        member = await context.bot.get_chat_member(chat_id, user_id)
+        is_admin = member.status in ["administrator", "creator"]
+    except Exception:
+        return False
+    admin_cache.set(chat_id, user_id, is_admin)
+    return is_admin
+
+async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_chat.type != "private":
+        await track_new_group(
+            update.effective_chat.id,
+            update.effective_chat.title,
+            update.effective_user.id
+        )
+
+    welcome_msg = """
+    👋 *Hi, I'm your Group Helper Bot!*
+
+    *Main Commands:*
+    /help - Show all commands
+    /rules - Group rules
+    /games - Fun games
+
+    Need help?"""
+
+    keyboard = [
+        [InlineKeyboardButton("➕ Add to Group",
+                            url="https://t.me/grphelper_bot?startgroup=true")],
+        [InlineKeyboardButton("🆘 Support", url="https://t.me/dax_channel01")]
+    ]
+
+    try:
+        await update.message.reply_text(
+            welcome_msg,
+            parse_mode="Markdown",
+            reply_markup=InlineKeyboardMarkup(keyboard),
+            disable_web_page_preview=True
+        )
+    except Exception as e:
+        print(f"Error sending start message: {e}")
+        await update.message.reply_text(
+            "👋 Hi! I'm your Group Helper Bot!\nUse /help for commands.",
+            reply_markup=InlineKeyboardMarkup(keyboard)
+        )
+
+# HELP_MESSAGE already defined above
+
+async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await update.message.reply_text(HELP_MESSAGE, parse_mode="Markdown")
+
+# --- Merged button_handler to fix duplicate ---
+async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+
+    try:
+        await query.answer()
+
+        if query.data == "help_commands":
+            await query.edit_message_text(
+                HELP_MESSAGE,
+                parse_mode="Markdown"
+            )
+
+        elif query.data == "show_games":
+            await show_games_menu(update, context)
+
+        elif query.data == "back_to_main":
+            await start(update, context)
+
+        elif query.data.startswith("toggle_"):
+            await toggle_feature(update, context)
+
+        elif query.data.startswith("bulk_"):
+            await handle_bulk_callback(update, context)
+
+        elif query.data.startswith("lb_"):
+            await leaderboard_page(update, context)
+
+        elif query.data.startswith("audit_"):
+            await audit_log_page(update, context)
+
+        else:
+            await query.edit_message_text("❌ Unknown command")
+
+    except Exception as e:
+        await query.answer("⚠️ Error: Please try again")
+        print(f"Button handler error: {e}")
+
+async def toggle_feature(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handle feature toggle callbacks"""
+
+    query = update.callback_query
+    await query.answer()
+
+    if not await is_group_admin(update, context):
+        await query.edit_message_text("🚫 Admin only!")
+        return
+
+    # FIXED: Updated parsing format - expected "toggle_<feature>_<groupid>"
+    parts = query.data.split("_", 2)
+    if len(parts) != 3:
+        await query.edit_message_text("❌ Invalid toggle command format.")
+        return
+
+    _, feature, group_id_str = parts
+    try:
+        group_id = int(group_id_str)
+    except ValueError:
+        await query.edit_message_text("❌ Invalid group ID.")
+        return
+    # The admin check above was for this chat, and only its shard's caches see the write
+    if group_id != update.effective_chat.id:
+        await query.edit_message_text("❌ This menu belongs to another group.")
+        return
+
+    def _toggle(conn):
+        conn.execute("""
+            UPDATE group_features
+            SET is_active = NOT is_active
+            WHERE group_id = ? AND feature = ?
+        """, (group_id, feature))
+        return conn.execute(
+            "SELECT is_active FROM group_features WHERE group_id = ? AND feature = ?",
+            (group_id, feature)
+        ).fetchone()
+
+    row = await db.run(_toggle, label="toggle_feature")
+    if row:
+        settings_cache.set_feature(group_id, feature, bool(row[0]))
+
+    # Refresh menu after toggling
+    await button_handler(update, context)
+
+async def games_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    keyboard = [
+        [InlineKeyboardButton("Truth or Dare", callback_data="game_truthordare")],
+        [InlineKeyboardButton("Meme Battle", callback_data="game_memebattle")],
+        [InlineKeyboardButton("Back", callback_data="back_to_main")]
+    ]
+
+    await update.message.reply_text(
+        "🎮 *Available Games*\nSelect one:",
+        parse_mode="Markdown",
+        reply_markup=InlineKeyboardMarkup(keyboard)
+    )
+
+async def show_games_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+
+    game_keyboard = [
+        [InlineKeyboardButton("Truth or Dare", switch_inline_query_current_chat="/truthordare ")],
+        [InlineKeyboardButton("Meme Battle", switch_inline_query_current_chat="/meme ")],
+        [InlineKeyboardButton("Joke Contest", switch_inline_query_current_chat="/joke ")],
+        [InlineKeyboardButton("🔙 Back", callback_data="back_to_main")]
+    ]
+
+    await query.edit_message_text(
+        text="🎮 *Select a Game*\n\nYou'll need to tag someone to play!",
+        parse_mode="Markdown",
+        reply_markup=InlineKeyboardMarkup(game_keyboard)
+    )
+
+async def truth_or_dare(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if len(context.args) < 1:
+        await update.message.reply_text("Please tag someone: /truthordare @username")
+        return
+
+    questions = [
+        "Truth: What's your most embarrassing moment?",
+        "Dare: Send a voice message singing for 30 seconds!"
+    ]
+    outbound.post(
+        update.effective_chat.id,
+        random.choice(questions),
+        PRIORITY_CHATTER,
+        reply_to_message_id=update.message.message_id
+    )
+
+async def start_wcg(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not context.args:
+        await update.message.reply_text("Usage: /wcg @user1 @user2")
+        return
+
+    participants = {
+        "ids": [update.effective_user.id],
+        "names": [update.effective_user.first_name]
+    }
+
+    # The Bot API cannot look members up by username, so @mentions resolve
+    # through the users this bot has seen in the chat
+    for entity in update.message.entities:
+        found = None
+        if entity.type == "text_mention" and entity.user:
+            found = (entity.user.id, entity.user.username, entity.user.first_name)
+        elif entity.type == "mention":
+            mention_text = update.message.text[entity.offset:entity.offset+entity.length]
+            found = await user_directory.resolve(update.effective_chat.id, mention_text)
+        if found and found[0] not in participants["ids"]:
+            participants["ids"].append(found[0])
+            participants["names"].append((found[2] or found[1] or str(found[0])).split(" ")[0])
+
+    if len(participants["ids"]) < 2:
+        await update.message.reply_text(
+            "❌ Need at least 2 players! Mentioned users must have been active in this group.\n"
+            "Example: /wcg @username1 @username2"
+        )
+        return
+
+    # The poll waits its turn in the chat's send queue; it is recorded once
+    # sent, without holding up this handler
+    context.application.create_task(_send_game(update.effective_chat.id, participants))
+
+async def _send_game(chat_id: int, participants: dict):
+    question = random.choice(QUESTIONS)
+    poll = await outbound.submit(
+        "send_poll",
+        PRIORITY_CHATTER,
+        chat_id=chat_id,
+        question=question["question"],
+        options=question["options"],
         is_anonymous=False,
         allows_multiple_answers=False,
         correct_option_id=question["correct"],
         explanation="See results with /wcg_results"
     )
 
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute(
-        """INSERT INTO games VALUES (?, ?, ?, ?, ?, ?)""",
-        (
-            poll.poll.id,
-            update.effective_chat.id,
-            question["question"],
-            question["correct"],
-            json.dumps(participants),
-            datetime.now().isoformat()
-        )
-    )
-    conn.commit()
-    conn.close()
+    def _record(conn):
+        conn.execute(
+            """INSERT INTO games
+            (poll_id, chat_id, question, correct_option, created_at, message_id)
+            VALUES (?, ?, ?, ?, ?, ?)""",
+            (
+                poll.poll.id,
+                chat_id,
+                question["question"],
+                question["correct"],
+                int(time.time()),
+                poll.message_id
+            )
+        )
+        conn.executemany(
+            "INSERT OR IGNORE INTO game_participants (poll_id, user_id, name) VALUES (?, ?, ?)",
+            [(poll.poll.id, user_id, name) for user_id, name in zip(participants["ids"], participants["names"])]
+        )
+
+    await db.run(_record, label="record_game")
+    await scheduler.schedule(
+        "close_game", time.time() + WCG_GAME_SECONDS,
+        {"chat_id": chat_id, "poll_id": poll.poll.id}
+    )
+
+# --- Vote Tracking ---
+def _store_votes(conn, batch: dict) -> int:
+    """Write buffered votes for known games in one transaction."""
+    poll_ids = list({poll_id for poll_id, _ in batch})
+    known, existing = {}, set()
+    for i in range(0, len(poll_ids), 500):
+        chunk = poll_ids[i:i + 500]
+        marks = ",".join("?" * len(chunk))
+        known.update(conn.execute(
+            f"SELECT poll_id, chat_id FROM games WHERE poll_id IN ({marks})", chunk
+        ))
+        existing.update(conn.execute(
+            f"SELECT DISTINCT poll_id, user_id FROM votes WHERE poll_id IN ({marks})", chunk
+        ))
+
+    batch = {key: vote for key, vote in batch.items() if key[0] in known}
+    conn.executemany("DELETE FROM votes WHERE poll_id = ? AND user_id = ?", list(batch))
+    conn.executemany(
+        "INSERT INTO votes (poll_id, user_id, option_id, voted_at) VALUES (?, ?, ?, ?)",
+        [
+            (poll_id, user_id, option_id, voted_at)
+            for (poll_id, user_id), (option_ids, _, voted_at, *_) in batch.items()
+            for option_id in option_ids
+        ]
+    )
+
+    # A player's first answer in a poll counts as a game played
+    played = {}
+    per_chat = {}
+    for (poll_id, user_id), (option_ids, username, voted_at, *_) in batch.items():
+        if option_ids and (poll_id, user_id) not in existing:
+            _, count, _ = played.get(user_id, (None, 0, None))
+            played[user_id] = (username, count + 1, voted_at)
+            key = (known[poll_id], user_id)
+            per_chat[key] = per_chat.get(key, 0) + 1
+    conn.executemany(
+        """INSERT INTO players (user_id, username, games_played, last_played)
+        VALUES (?, ?, ?, ?)
+        ON CONFLICT(user_id) DO UPDATE SET
+            username = excluded.username,
+            games_played = games_played + excluded.games_played,
+            last_played = excluded.last_played""",
+        [(user_id, username, count, voted_at) for user_id, (username, count, voted_at) in played.items()]
+    )
+    conn.executemany(
+        """INSERT INTO player_stats (chat_id, user_id, period, games_played) VALUES (?, ?, ?, ?)
+        ON CONFLICT(chat_id, period, user_id) DO UPDATE SET
+            games_played = games_played + excluded.games_played""",
+        [
+            (scope, user_id, period, count)
+            for (chat_id, user_id), count in per_chat.items()
+            for scope in (chat_id, 0)
+            for period in leaderboard_periods()
+        ]
+    )
+    # Voters join the user directory of the game's chat
+    conn.executemany(_CHAT_USER_UPSERT, [
+        (known[poll_id], user_id, handle, full_name, voted_at)
+        for (poll_id, user_id), (_, _, voted_at, handle, full_name) in batch.items()
+    ])
+    return len(batch), {chat_id for chat_id, _ in per_chat}
+
+class VoteBuffer:
+    """Collects PollAnswer updates in memory and flushes them in batches.
+
+    Only the latest answer per (poll, user) is kept, so vote changes and
+    retractions between flushes cost nothing.
+    """
+
+    def __init__(self, flush_interval: float = 2.0, flush_size: int = 500):
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+        self._votes = {}  # (poll_id, user_id) -> (option_ids, username, voted_at, handle, full_name)
+        self._lock = asyncio.Lock()
+        self._task = None
+        self.flushed = 0
+
+    def add(self, poll_answer):
+        user = poll_answer.user
+        self._votes[(poll_answer.poll_id, user.id)] = (
+            tuple(poll_answer.option_ids),
+            user.username or str(user.id),
+            int(time.time()),
+            user.username.lower() if user.username else None,
+            user.full_name,
+        )
+        if self._task is None:
+            self.start()  # chats that never play a game never run the flush loop
+        if len(self._votes) >= self.flush_size:
+            asyncio.get_running_loop().create_task(self.flush())
+
+    async def flush(self) -> int:
+        async with self._lock:
+            if not self._votes:
+                return 0
+            batch, self._votes = self._votes, {}
+            try:
+                stored, chats = await db.run(lambda conn: _store_votes(conn, batch), label="flush_votes")
+            except sqlite3.Error as e:
+                print(f"Vote flush error: {e}")
+                # Keep the batch unless a newer answer arrived meanwhile
+                for key, vote in batch.items():
+                    self._votes.setdefault(key, vote)
+                return 0
+            self.flushed += stored
+            for chat_id in chats:
+                leaderboard_cache.invalidate(chat_id)
+            return stored
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self.flush()
+
+vote_buffer = VoteBuffer(VOTE_FLUSH_INTERVAL, VOTE_FLUSH_SIZE)
+
+def _score_game(conn, poll_id: str, correct_option: int) -> list:
+    """Credit winners once per game and return their usernames."""
+    first_scoring = conn.execute(
+        "UPDATE games SET scored = 1 WHERE poll_id = ? AND NOT scored", (poll_id,)
+    ).rowcount
+    if first_scoring:
+        conn.execute(
+            """UPDATE players SET wins = wins + 1
+            WHERE user_id IN (SELECT user_id FROM votes WHERE poll_id = ? AND option_id = ?)""",
+            (poll_id, correct_option)
+        )
+        chat_id = conn.execute("SELECT chat_id FROM games WHERE poll_id = ?", (poll_id,)).fetchone()[0]
+        for scope in (chat_id, 0):
+            for period in leaderboard_periods():
+                conn.execute(
+                    """INSERT INTO player_stats (chat_id, user_id, period, wins)
+                    SELECT ?, user_id, ?, 1 FROM votes WHERE poll_id = ? AND option_id = ?
+                    ON CONFLICT(chat_id, period, user_id) DO UPDATE SET wins = wins + 1""",
+                    (scope, period, poll_id, correct_option)
+                )
+    return [row[0] for row in conn.execute(
+        """SELECT p.username FROM votes v JOIN players p ON p.user_id = v.user_id
+        WHERE v.poll_id = ? AND v.option_id = ?""",
+        (poll_id, correct_option)
+    )]
+
+async def handle_vote(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    vote_buffer.add(update.poll_answer)
+
+async def finish_game(bot, poll_id: str):
+    """Close a game's poll, score it and return the results message."""
+    game = await db.fetchone(
+        "SELECT chat_id, question, correct_option, message_id FROM games WHERE poll_id = ?",
+        (poll_id,)
+    )
+    if not game:
+        return None
+    chat_id, question, correct_option, message_id = game
+
+    # Close the poll first so no votes arrive after scoring
+    options = next((q["options"] for q in QUESTIONS if q["question"] == question), None)
+    if message_id:
+        try:
+            poll = await bot.stop_poll(chat_id, message_id)
+            options = [option.text for option in poll.options]
+        except TelegramError as e:
+            print(f"stop_poll error: {e}")
+
+    await vote_buffer.flush()
+    winners = await db.run(lambda conn: _score_game(conn, poll_id, correct_option), label="score_game")
+    leaderboard_cache.invalidate(chat_id)
+
+    answer = options[correct_option] if options else f"Option {correct_option + 1}"
+    winner_names = ", ".join(escape_markdown(name) for name in winners) if winners else "Nobody this time!"
+    return (
+        f"🏆 *WCG Results* 🏆\n\n"
+        f"Question: {question}\n"
+        f"Correct answer: {answer}\n\n"
+        f"Winners: {winner_names}"
+    )
+
+async def show_results(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    game = await db.fetchone(
+        """SELECT poll_id FROM games 
+        WHERE chat_id = ? 
+        ORDER BY created_at DESC LIMIT 1""",
+        (update.effective_chat.id,)
+    )
+
+    if not game:
+        await update.message.reply_text("No recent game found!")
+        return
+
+    result_msg = await finish_game(context.bot, game[0])
+    await update.message.reply_text(result_msg, parse_mode="Markdown")
+
+# --- Logo Rendering ---
+def render_logo(description: str, size: int, color: str) -> bytes:
+    """Draw a logo and return it PNG-encoded. Runs in the logo process pool."""
+    # Pillow is only needed by /logo, so it is imported by the pool workers
+    from PIL import Image, ImageDraw, ImageFont
+
+    img = Image.new("RGBA", (size, size), (255, 255, 255, 0))
+    draw = ImageDraw.Draw(img)
+    
+    # Draw colored circle background
+    draw.ellipse([(0,0), (size, size)], fill=color)
+    
+    # Draw white paper plane shape (Telegram-like)
+    plane_points = [
+        (size // 2, size // 4),
+        (size // 4, size * 3 // 4),
+        (size // 2, size // 2),
+        (size * 3 // 4, size * 3 // 4)
+    ]
+    draw.polygon(plane_points, fill="white")
+    
+    # Add text overlay: first 10 chars of description
+    font = ImageFont.load_default()
+    text = description[:10]
+    bbox = draw.textbbox((0, 0), text, font=font)
+    text_width = bbox[2] - bbox[0]
+    text_position = ((size - text_width) // 2, size * 3 // 4)
+    draw.text(text_position, text, fill="white", font=font)
+    
+    # Save to in-memory bytes buffer
+    buf = io.BytesIO()
+    img.save(buf, format='PNG')
+    return buf.getvalue()
+
+class LogoCache:
+    """Bounded cache of rendered logos keyed by a hash of (description, size, color).
+
+    Once Telegram has stored an upload its file_id is kept and the PNG bytes
+    are dropped, so repeats are re-sent by reference.
+    """
+
+    def __init__(self, maxsize: int = 512):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()  # key -> {"file_id": ..., "png": ...}
+
+    @staticmethod
+    def key(description: str, size: int, color: str) -> str:
+        return hashlib.sha256(f"{description}\0{size}\0{color}".encode()).hexdigest()
+
+    def get(self, key: str):
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._entries.move_to_end(key)
+        return entry
+
+    def put(self, key: str, png: bytes = None, file_id: str = None):
+        entry = self._entries.setdefault(key, {"file_id": None, "png": None})
+        if file_id:
+            entry["file_id"], entry["png"] = file_id, None
+        elif png and not entry["file_id"]:
+            entry["png"] = png
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+logo_cache = LogoCache(LOGO_CACHE_SIZE)
+_logo_executor = None
+
+async def get_logo(description: str, size: int, color: str):
+    """Return (cache key, file_id or PNG bytes) for a logo, rendering off the event loop."""
+    global _logo_executor
+    key = LogoCache.key(description, size, color)
+    entry = logo_cache.get(key)
+    if entry and (entry["file_id"] or entry["png"]):
+        return key, entry["file_id"] or entry["png"]
+
+    if _logo_executor is None:
+        # Spawned, not forked: this process already runs threads whose locks a fork could copy held
+        _logo_executor = ProcessPoolExecutor(max_workers=LOGO_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+    png = await asyncio.get_running_loop().run_in_executor(
+        _logo_executor, render_logo, description, size, color
+    )
+    logo_cache.put(key, png=png)
+    return key, png
+
+def _parse_logo_args(args):
+    """Split leading size, #color and --all options from the description."""
+    size, color, variants = LOGO_DEFAULT_SIZE, None, False
+    args = list(args)
+    while args:
+        option = args[0]
+        if option.isdigit() and int(option) in LOGO_SIZES:
+            size = int(option)
+        elif re.fullmatch(r"#[0-9a-fA-F]{6}", option):
+            color = option
+        elif option == "--all":
+            variants = True
+        else:
+            break
+        args.pop(0)
+    return size, color, variants, " ".join(args) or "default"
+
+async def logo_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    size, color, variants, description = _parse_logo_args(context.args or [])
+    # Choose color based on length of description (just an example customization)
+    color = color or ("#0088cc" if len(description) % 2 == 0 else "#00aaff")
+
+    if variants:
+        # Render every configured size in parallel and send them as one album
+        logos = await asyncio.gather(*(get_logo(description, s, color) for s in LOGO_SIZES))
+        messages = await update.message.reply_media_group(media=[
+            InputMediaPhoto(photo, caption=f"Logo for: {description} ({s}px)")
+            for s, (_, photo) in zip(LOGO_SIZES, logos)
+        ])
+        for (key, _), message in zip(logos, messages):
+            if message.photo:
+                logo_cache.put(key, file_id=message.photo[-1].file_id)
+        return
+
+    key, photo = await get_logo(description, size, color)
+    message = await update.message.reply_photo(photo=photo, caption=f"Logo for: {description}")
+    if message.photo:
+        logo_cache.put(key, file_id=message.photo[-1].file_id)
+    
+# --- Leaderboards ---
+LEADERBOARD_WINDOWS = {"all": "All time", "week": "This week", "month": "This month"}
+
+def leaderboard_period(window: str, now: datetime = None) -> str:
+    now = now or datetime.now()
+    if window == "week":
+        return now.strftime("w%G-%V")
+    if window == "month":
+        return now.strftime("m%Y-%m")
+    return "all"
+
+def leaderboard_periods(now: datetime = None) -> tuple:
+    """Every period bucket a result recorded now counts towards."""
+    return tuple(leaderboard_period(window, now) for window in LEADERBOARD_WINDOWS)
+
+class LeaderboardCache:
+    """Rendered leaderboard pages, dropped whenever a scope's rankings change.
+
+    Bounded in both directions: least recently used scopes are evicted past
+    ``max_scopes``, and a scope holds at most ``max_pages`` pages.
+    """
+
+    def __init__(self, max_scopes: int = 1000, max_pages: int = 64):
+        self.max_scopes = max_scopes
+        self.max_pages = max_pages
+        self._pages = OrderedDict()  # scope -> OrderedDict((period, page, cursor) -> rendered)
+
+    def get(self, scope: int, key: tuple):
+        pages = self._pages.get(scope)
+        if pages is None or key not in pages:
+            return None
+        self._pages.move_to_end(scope)
+        pages.move_to_end(key)
+        return pages[key]
+
+    def put(self, scope: int, key: tuple, rendered):
+        pages = self._pages.get(scope)
+        if pages is None:
+            pages = self._pages[scope] = OrderedDict()
+            if len(self._pages) > self.max_scopes:
+                self._pages.popitem(last=False)
+        self._pages.move_to_end(scope)
+        pages[key] = rendered
+        if len(pages) > self.max_pages:
+            pages.popitem(last=False)
+
+    def invalidate(self, chat_id: int):
+        self._pages.pop(chat_id, None)
+        self._pages.pop(0, None)  # every chat feeds the global board
+
+leaderboard_cache = LeaderboardCache(LEADERBOARD_CACHE_SCOPES)
+
+# Rank order is (wins DESC, games_played, user_id); cursors are "<dir><wins>.<games>.<user_id>"
+# with dir "a" (page after this row) or "b" (page before it)
+_LEADERBOARD_ORDER = {
+    "a": ("s.wins <= ? AND (s.wins < ? OR s.games_played > ? OR (s.games_played = ? AND s.user_id > ?))",
+          "s.wins DESC, s.games_played, s.user_id"),
+    "b": ("s.wins >= ? AND (s.wins > ? OR s.games_played < ? OR (s.games_played = ? AND s.user_id < ?))",
+          "s.wins, s.games_played DESC, s.user_id DESC"),
+}
+
+def _leaderboard_cursor(direction: str, row) -> str:
+    return f"{direction}{row[1]}.{row[2]}.{row[3]}"
+
+def _parse_leaderboard_cursor(cursor: str) -> tuple:
+    """Split a cursor into (direction, wins, games, user_id); ValueError if malformed."""
+    wins, games, user_id = (int(part) for part in cursor[1:].split("."))
+    if cursor[0] not in _LEADERBOARD_ORDER:
+        raise ValueError(cursor)
+    return cursor[0], wins, games, user_id
+
+async def render_leaderboard(scope: int, window: str, page: int, cursor: str = None):
+    """Render one page: by offset for the first LEADERBOARD_MAX_PAGES pages,
+    or by keyset from a neighbouring page's cursor, which stays cheap at any depth."""
+    period = leaderboard_period(window)
+    cached = leaderboard_cache.get(scope, (period, page, cursor))
+    if cached:
+        return cached
+
+    select = """SELECT COALESCE(p.username, s.user_id), s.wins, s.games_played, s.user_id
+        FROM player_stats s LEFT JOIN players p ON p.user_id = s.user_id
+        WHERE s.chat_id = ? AND s.period = ?"""
+    if cursor:
+        direction, wins, games, user_id = _parse_leaderboard_cursor(cursor)
+        condition, order = _LEADERBOARD_ORDER[direction]
+        rows = await db.fetchall(
+            f"{select} AND {condition} ORDER BY {order} LIMIT ?",
+            (scope, period, wins, wins, games, games, user_id, LEADERBOARD_PAGE_SIZE + 1),
+            label="leaderboard_page"
+        )
+    else:
+        direction = "a"
+        rows = await db.fetchall(
+            f"{select} ORDER BY s.wins DESC, s.games_played, s.user_id LIMIT ? OFFSET ?",
+            (scope, period, LEADERBOARD_PAGE_SIZE + 1, page * LEADERBOARD_PAGE_SIZE),
+            label="leaderboard_page"
+        )
+    if direction == "b":
+        # Walking backwards from the cursor row, so the next page is that row's
+        rows, has_next = rows[:LEADERBOARD_PAGE_SIZE][::-1], True
+    else:
+        rows, has_next = rows[:LEADERBOARD_PAGE_SIZE], len(rows) > LEADERBOARD_PAGE_SIZE
+    if not rows:
+        rendered = ("No players yet!", False, None, None)
+    else:
+        title = "Global " if scope == 0 else ""
+        lines = [f"🏆 *{title}WCG Leaderboard* 🏆 — {LEADERBOARD_WINDOWS[window]}\n"]
+        for i, (username, wins, games, _) in enumerate(rows, page * LEADERBOARD_PAGE_SIZE + 1):
+            win_rate = (wins/games)*100 if games > 0 else 0
+            lines.append(f"{i}. {escape_markdown(str(username))}: {wins} wins ({win_rate:.1f}% win rate)")
+        rendered = (
+            "\n".join(lines), has_next, _leaderboard_cursor("b", rows[0]), _leaderboard_cursor("a", rows[-1])
+        )
+    leaderboard_cache.put(scope, (period, page, cursor), rendered)
+    return rendered
+
+def _leaderboard_keyboard(scope: int, window: str, page: int, rendered):
+    _, has_next, before, after = rendered
+    buttons = []
+    if page > 0 and before:
+        buttons.append(InlineKeyboardButton("⬅️ Prev", callback_data=f"lb_{scope}_{window}_{page - 1}_{before}"))
+    if has_next:
+        buttons.append(InlineKeyboardButton("Next ➡️", callback_data=f"lb_{scope}_{window}_{page + 1}_{after}"))
+    return InlineKeyboardMarkup([buttons]) if buttons else None
+
+async def leaderboard(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    scope, window, page = update.effective_chat.id, "all", 0
+    for arg in context.args or []:
+        if arg.lower() == "global":
+            scope = 0
+        elif arg.lower() in LEADERBOARD_WINDOWS:
+            window = arg.lower()
+        elif arg.isdigit() and int(arg) > 0:
+            # Deeper pages are reached with the Next button, which pages by keyset
+            page = min(int(arg), LEADERBOARD_MAX_PAGES) - 1
+    if update.effective_chat.type == "private":
+        scope = 0
+
+    rendered = await render_leaderboard(scope, window, page)
+    await update.message.reply_text(
+        rendered[0], parse_mode="Markdown", reply_markup=_leaderboard_keyboard(scope, window, page, rendered)
+    )
+
+async def leaderboard_page(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handle "lb_<scope>_<window>_<page>[_<cursor>]" pagination buttons."""
+    query = update.callback_query
+    try:
+        _, scope, window, page, *cursor = query.data.split("_")
+        scope, page = int(scope), int(page)
+        cursor = cursor[0] if cursor else None
+        if window not in LEADERBOARD_WINDOWS or page < 0:
+            raise ValueError
+        if cursor is None:
+            page = min(page, LEADERBOARD_MAX_PAGES - 1)  # buttons sent before keyset paging
+        else:
+            _parse_leaderboard_cursor(cursor)
+    except ValueError:
+        await query.edit_message_text("❌ Invalid leaderboard page.")
+        return
+
+    rendered = await render_leaderboard(scope, window, page, cursor)
+    await query.edit_message_text(
+        rendered[0], parse_mode="Markdown", reply_markup=_leaderboard_keyboard(scope, window, page, rendered)
+    )
+
+# --- Rules Management ---
+async def set_rules(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not await is_group_admin(update, context):
+        await update.message.reply_text("🚫 *Admin only!*", parse_mode="Markdown")
+        return
+
+    rules_text = " ".join(context.args)
+    if not rules_text:
+        await update.message.reply_text("ℹ️ Usage: /setrules <text>")
+        return
+
+    await db.execute(
+        """INSERT INTO group_rules (chat_id, rules_text) VALUES (?, ?)
+        ON CONFLICT(chat_id) DO UPDATE SET rules_text = excluded.rules_text""",
+        (update.effective_chat.id, rules_text)
+    )
+    settings_cache.update(update.effective_chat.id, rules=rules_text)
+    await update.message.reply_text("✅ *Rules updated!*", parse_mode="Markdown")
+
+async def show_rules(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    rules = (await settings_cache.get(update.effective_chat.id))["rules"]
+    await update.message.reply_text(
+        rules or "📜 No rules set yet. Admins: use /setrules",
+        parse_mode="Markdown"
+    )
+
+# --- FAQ System ---
+FAQ_STOPWORDS = frozenset(
+    "a an the is are was were be do does did i you we it to of in on for and or "
+    "how what why when where who can my your me this that".split()
+)
+_COMMAND_PREFIX = re.compile(r"^/\w+(@\w+)?\s*")
+
+def _faq_terms(text: str) -> dict:
+    """Weighted search terms: whole tokens count 3, character trigrams 1.
+    Stopwords contribute neither."""
+    terms = {}
+    for token in re.findall(r"\w+", normalize_text(text)):
+        if token in FAQ_STOPWORDS:
+            continue
+        terms[token] = 3
+        padded = f" {token} "
+        for i in range(len(padded) - 2):
+            terms.setdefault("#" + padded[i:i + 3], 1)
+    return terms
+
+class FAQIndex:
+    """In-memory inverted index over one chat's FAQ questions.
+
+    Searches skip the postings of a query's most widespread terms, as long
+    as a question matching only those could not reach ``min_score``; the
+    skipped terms are then added only to candidates that could still make
+    the top results. Scores at or above ``min_score`` are exact.
+    """
+
+    def __init__(self):
+        self.answers = {}  # question -> answer
+        self._terms = {}  # question -> {term: weight}
+        self._weights = {}  # question -> total term weight
+        self._postings = {}  # term -> set of questions
+
+    def add(self, question: str, answer: str):
+        self.remove(question)
+        terms = _faq_terms(question)
+        self.answers[question] = answer
+        self._terms[question] = terms
+        self._weights[question] = sum(terms.values())
+        for term in terms:
+            self._postings.setdefault(term, set()).add(question)
+
+    def remove(self, question: str):
+        for term in self._terms.pop(question, ()):
+            postings = self._postings[term]
+            postings.discard(question)
+            if not postings:
+                del self._postings[term]
+        self.answers.pop(question, None)
+        self._weights.pop(question, None)
+
+    def search(self, query: str, limit: int = 3, min_score: float = FAQ_SUGGEST_THRESHOLD) -> list:
+        """Best matches scoring at least ``min_score``, as (score, question,
+        answer) with score in [0, 1]."""
+        if query in self.answers:
+            return [(1.0, query, self.answers[query])]
+        terms = _faq_terms(query)
+        query_weight = sum(terms.values())
+        if not query_weight:
+            return []
+
+        # A question sharing only skipped terms (total weight s) scores at
+        # most 2s / (query_weight + s), so s stays below this budget
+        budget = min_score * query_weight / (2 - min_score)
+        matched = sorted(
+            ((term, weight, self._postings[term]) for term, weight in terms.items() if term in self._postings),
+            key=lambda entry: len(entry[2]), reverse=True
+        )
+        common = []  # (term, weight) whose postings are not walked
+        common_weight = 0
+        shared = {}
+        for term, weight, postings in matched:
+            if common_weight + weight < budget:
+                common.append((term, weight))
+                common_weight += weight
+                continue
+            for question in postings:
+                shared[question] = shared.get(question, 0) + weight
+
+        # Best possible score first; stop once no candidate can beat the current results
+        bounded = sorted(
+            ((2 * (overlap + common_weight) / (query_weight + self._weights[question]), question)
+             for question, overlap in shared.items()),
+            reverse=True
+        )
+        scored = []
+        for bound, question in bounded:
+            if bound < min_score or (len(scored) >= limit and bound <= scored[-1][0]):
+                break
+            overlap = shared[question] + sum(weight for term, weight in common if term in self._terms[question])
+            score = 2 * overlap / (query_weight + self._weights[question])
+            if score >= min_score:
+                scored.append((score, question))
+                scored.sort(reverse=True)
+                del scored[limit:]
+        return [(score, question, self.answers[question]) for score, question in scored]
+
+faq_indexes = OrderedDict()  # chat_id -> FAQIndex, LRU
+
+async def get_faq_index(chat_id: int) -> FAQIndex:
+    index = faq_indexes.get(chat_id)
+    if index is not None:
+        faq_indexes.move_to_end(chat_id)
+        return index
+
+    rows = await db.fetchall("SELECT question, answer FROM faqs WHERE chat_id = ?", (chat_id,))
+    index = faq_indexes.get(chat_id)  # another task may have loaded it meanwhile
+    if index is None:
+        index = FAQIndex()
+        for question, answer in rows:
+            index.add(_COMMAND_PREFIX.sub("", question), answer)
+        faq_indexes[chat_id] = index
+        if len(faq_indexes) > FAQ_INDEX_CACHE_SIZE:
+            faq_indexes.popitem(last=False)
+    return index
+
+async def add_faq(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not await is_group_admin(update, context):
+        await update.message.reply_text("🚫 *Admin only!*", parse_mode="Markdown")
+        return
+
+    args = update.message.text.split(" | ", 1)
+    if len(args) != 2:
+        await update.message.reply_text("ℹ️ Usage: /addfaq <question> | <answer>")
+        return
+
+    question, answer = _COMMAND_PREFIX.sub("", args[0].strip()), args[1].strip()
+    if not question or not answer:
+        await update.message.reply_text("ℹ️ Usage: /addfaq <question> | <answer>")
+        return
+
+    await db.execute(
+        """INSERT INTO faqs (chat_id, question, answer) VALUES (?, ?, ?)
+        ON CONFLICT(chat_id, question) DO UPDATE SET answer = excluded.answer""",
+        (update.effective_chat.id, question, answer)
+    )
+    (await get_faq_index(update.effective_chat.id)).add(question, answer)
+    await update.message.reply_text(f"✅ FAQ added: *{question}*", parse_mode="Markdown")
+
+async def get_faq(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    question = " ".join(context.args)
+    if not question:
+        await update.message.reply_text("ℹ️ Usage: /faq <question>")
+        return
+
+    matches = (await get_faq_index(update.effective_chat.id)).search(question)
+    if matches and matches[0][0] >= FAQ_MATCH_THRESHOLD:
+        await update.message.reply_text(matches[0][2], parse_mode="Markdown")
+        return
+
+    suggestions = [match[1] for match in matches if match[0] >= FAQ_SUGGEST_THRESHOLD]
+    if suggestions:
+        await update.message.reply_text(
+            "🤔 Did you mean:\n" + "\n".join(f"• /faq {s}" for s in suggestions)
+        )
+    else:
+        await update.message.reply_text("❌ FAQ not found. Admins: use /addfaq")
+
+async def faq_autoreply(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Answer question-like messages from the FAQ when the group enables it."""
+    message = update.message
+    if not message or not message.text or update.effective_chat.type == "private":
+        return
+    if "?" not in message.text:
+        return
+    features = (await settings_cache.get(update.effective_chat.id))["features"]
+    if not features.get("faq_autoreply"):
+        return
+
+    matches = (await get_faq_index(update.effective_chat.id)).search(
+        message.text, limit=1, min_score=FAQ_AUTOREPLY_THRESHOLD
+    )
+    if matches and matches[0][0] >= FAQ_AUTOREPLY_THRESHOLD:
+        outbound.post(
+            update.effective_chat.id,
+            matches[0][2],
+            PRIORITY_NORMAL,
+            parse_mode="Markdown",
+            reply_to_message_id=message.message_id
+        )
+
+async def toggle_faq_autoreply(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not await is_group_admin(update, context):
+        await update.message.reply_text("🚫 Admin only!")
+        return
+
+    chat_id = update.effective_chat.id
+
+    def _toggle(conn):
+        conn.execute("""
+            INSERT INTO group_features (group_id, feature, is_active) VALUES (?, 'faq_autoreply', 1)
+            ON CONFLICT(group_id, feature) DO UPDATE SET is_active = NOT is_active
+        """, (chat_id,))
+        return conn.execute(
+            "SELECT is_active FROM group_features WHERE group_id = ? AND feature = 'faq_autoreply'",
+            (chat_id,)
+        ).fetchone()[0]
+
+    is_active = bool(await db.run(_toggle, label="toggle_faq_autoreply"))
+    settings_cache.set_feature(chat_id, "faq_autoreply", is_active)
+    status = "✅ enabled" if is_active else "❌ disabled"
+    await update.message.reply_text(f"Automatic FAQ answers are now {status}")
+
+# --- Audit Log ---
+AUDIT_COLUMNS = ("entry_id", "chat_id", "action", "target_id", "actor_id", "reason", "created_at")
+AUDIT_EXPORT_FORMATS = ("csv", "json")
+
+class AuditLog:
+    """Append-only record of moderation actions.
+
+    Entries queue in memory and are inserted in batches, so moderating a
+    raid costs one commit rather than one per action. Reads flush first,
+    and page by entry_id so deep pages cost the same as the first.
+    """
+
+    def __init__(self, flush_interval: float = 2.0, flush_size: int = 500):
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+        self._pending = []
+        self._lock = asyncio.Lock()
+        self._task = None
+        self.flushed = 0
+
+    def record(self, chat_id: int, action: str, target_id: int = None, actor_id: int = None, reason: str = None):
+        """Queue an entry; ``actor_id`` None means the bot acted on its own."""
+        self._pending.append((chat_id, action, target_id, actor_id, reason, int(time.time())))
+        if self._task is None:
+            self.start()
+        if len(self._pending) >= self.flush_size:
+            asyncio.get_running_loop().create_task(self.flush())
+
+    async def flush(self) -> int:
+        async with self._lock:
+            if not self._pending:
+                return 0
+            batch, self._pending = self._pending, []
+            try:
+                await db.executemany(
+                    """INSERT INTO audit_log (chat_id, action, target_id, actor_id, reason, created_at)
+                    VALUES (?, ?, ?, ?, ?, ?)""",
+                    batch, label="flush_audit_log"
+                )
+            except sqlite3.Error as e:
+                print(f"Audit log flush error: {e}")
+                self._pending[:0] = batch
+                return 0
+            self.flushed += len(batch)
+            return len(batch)
+
+    async def page(self, chat_id: int, target_id: int = None, before: int = None, after: int = None,
+                   limit: int = 15):
+        """Entries newest first, either older than ``before`` or newer than
+        ``after``; returns (rows, has_older, has_newer)."""
+        await self.flush()
+        where, params = "chat_id = ?", [chat_id]
+        if target_id is not None:
+            where += " AND target_id = ?"
+            params.append(target_id)
+        if after is not None:
+            rows = await db.fetchall(
+                f"""SELECT {", ".join(AUDIT_COLUMNS)} FROM audit_log
+                WHERE {where} AND entry_id > ? ORDER BY entry_id LIMIT ?""",
+                (*params, after, limit + 1), label="audit_page"
+            )
+            return rows[:limit][::-1], True, len(rows) > limit
+        if before is not None:
+            where += " AND entry_id < ?"
+            params.append(before)
+        rows = await db.fetchall(
+            f"""SELECT {", ".join(AUDIT_COLUMNS)} FROM audit_log
+            WHERE {where} ORDER BY entry_id DESC LIMIT ?""",
+            (*params, limit + 1), label="audit_page"
+        )
+        return rows[:limit], len(rows) > limit, before is not None
+
+    async def export(self, chat_id: int, target_id: int, fmt: str, out) -> int:
+        """Stream a chat's entries, oldest first, into binary file ``out``
+        as CSV or a JSON array; returns the row count."""
+        await self.flush()
+        sql = f"SELECT {', '.join(AUDIT_COLUMNS)} FROM audit_log WHERE chat_id = ?"
+        params = [chat_id]
+        if target_id is not None:
+            sql += " AND target_id = ?"
+            params.append(target_id)
+        sql += " ORDER BY entry_id"
+
+        def _write(conn):
+            # Rows come off the cursor one at a time; nothing is collected
+            text = io.TextIOWrapper(out, encoding="utf-8", newline="", write_through=True)
+            count = 0
+            try:
+                if fmt == "csv":
+                    writer = csv.writer(text)
+                    writer.writerow(AUDIT_COLUMNS)
+                    for row in conn.execute(sql, params):
+                        writer.writerow(row)
+                        count += 1
+                else:
+                    text.write("[")
+                    for row in conn.execute(sql, params):
+                        text.write(",\n" if count else "\n")
+                        text.write(json.dumps(dict(zip(AUDIT_COLUMNS, row)), ensure_ascii=False))
+                        count += 1
+                    text.write("\n]\n")
+            finally:
+                text.detach()
+            return count
+
+        return await db.run(_write, label="audit_export")
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self.flush()
+
+audit_log = AuditLog(AUDIT_FLUSH_INTERVAL, AUDIT_FLUSH_SIZE)
+
+def _audit_keyboard(target_id, rows, has_older: bool, has_newer: bool):
+    buttons = []
+    if rows and has_newer:
+        buttons.append(InlineKeyboardButton("⬅️ Newer", callback_data=f"audit_{target_id or 0}_a{rows[0][0]}"))
+    if rows and has_older:
+        buttons.append(InlineKeyboardButton("Older ➡️", callback_data=f"audit_{target_id or 0}_b{rows[-1][0]}"))
+    return InlineKeyboardMarkup([buttons]) if buttons else None
+
+def render_audit_page(target_id, rows) -> str:
+    title = f"📒 Audit log for user {target_id}" if target_id else "📒 Audit log"
+    if not rows:
+        return f"{title}\nNo moderation actions recorded."
+    lines = [title]
+    for entry_id, _, action, target, actor, reason, created_at in rows:
+        when = datetime.fromtimestamp(created_at).strftime("%Y-%m-%d %H:%M")
+        line = f"#{entry_id} {when} {action} {target if target is not None else '-'} by {actor or 'bot'}"
+        if reason:
+            line += f" — {reason}"
+        lines.append(line)
+    return "\n".join(lines)
+
+async def show_audit_log(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not await is_group_admin(update, context):
+        await update.message.reply_text("🚫 Admin only!")
+        return
+
+    target_id, _ = await command_target(update, context)
+    if target_id is None and context.args:
+        await update.message.reply_text("❌ Unknown user. Use their ID, or reply to one of their messages.")
+        return
+    rows, has_older, has_newer = await audit_log.page(update.effective_chat.id, target_id, limit=AUDIT_PAGE_SIZE)
+    await update.message.reply_text(
+        render_audit_page(target_id, rows), reply_markup=_audit_keyboard(target_id, rows, has_older, has_newer)
+    )
+
+async def audit_log_page(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handle "audit_<target>_<a|b><entry_id>" paging buttons."""
+    query = update.callback_query
+    if not await is_group_admin(update, context):
+        await query.edit_message_text("🚫 Admin only!")
+        return
+    try:
+        _, target_id, cursor = query.data.split("_")
+        target_id, direction, entry_id = int(target_id) or None, cursor[0], int(cursor[1:])
+        if direction not in "ab":
+            raise ValueError
+    except ValueError:
+        await query.edit_message_text("❌ Invalid audit log page.")
+        return
+
+    bound = {"after" if direction == "a" else "before": entry_id}
+    rows, has_older, has_newer = await audit_log.page(
+        update.effective_chat.id, target_id, limit=AUDIT_PAGE_SIZE, **bound
+    )
+    await query.edit_message_text(
+        render_audit_page(target_id, rows), reply_markup=_audit_keyboard(target_id, rows, has_older, has_newer)
+    )
+
+async def export_audit_log(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not await is_group_admin(update, context):
+        await update.message.reply_text("🚫 Admin only!")
+        return
+
+    args = list(context.args or [])
+    fmt = "csv"
+    if args and args[0].lower() in AUDIT_EXPORT_FORMATS:
+        fmt = args.pop(0).lower()
+    target_id, _ = await command_target(update, context, args)
+    if target_id is None and args:
+        await update.message.reply_text("ℹ️ Usage: /auditexport [csv|json] [user_id|@username]")
+        return
+
+    chat_id = update.effective_chat.id
+    # Spooled to disk, so a long history never sits in memory while it is written
+    out = tempfile.TemporaryFile()
+    try:
+        count = await audit_log.export(chat_id, target_id, fmt, out)
+    except BaseException:
+        out.close()
+        raise
+    if not count:
+        out.close()
+        await update.message.reply_text("📒 No moderation actions recorded.")
+        return
+
+    def rewound():
+        out.seek(0)  # a RetryAfter resend must upload the whole file again
+        return out
+
+    suffix = f"-{target_id}" if target_id else ""
+    upload = outbound.forget(outbound.submit(
+        "send_document",
+        PRIORITY_NORMAL,
+        chat_id=chat_id,
+        document=rewound,
+        filename=f"audit-{chat_id}{suffix}.{fmt}",
+        caption=f"📒 {count} audit log entries",
+        reply_to_message_id=update.message.message_id,
+    ))
+    upload.add_done_callback(lambda _: out.close())  # kept open until the upload is done
+
+# --- Warnings ---
+WARN_ACTIONS = {"mute": "muted", "ban": "banned"}
+_WARNING_WRITES = {
+    "add": """INSERT INTO warnings (chat_id, user_id, reason, issued_by, created_at, expires_at)
+        VALUES (?, ?, ?, ?, ?, ?)""",
+    "clear": "UPDATE warnings SET expires_at = ? WHERE chat_id = ? AND user_id = ? AND expires_at > ?",
+}
+
+class WarningLedger:
+    """Active warnings per (chat, user) in memory, written to the warnings
+    table in ordered batches.
+
+    A chat's active warnings are loaded once on first use; after that a
+    user's count is a dict lookup. The least recently used chats are
+    dropped past ``max_chats`` and reloaded from the table when needed.
+    Writes from the last ``flush_interval`` are lost if the process dies.
+    """
+
+    def __init__(self, flush_interval: float = 2.0, flush_size: int = 200, max_chats: int = 10000):
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+        self.max_chats = max_chats
+        self._chats = OrderedDict()  # chat_id -> {user_id: sorted list of expiry epochs}
+        self._loading = {}  # chat_id -> task loading it
+        self._pending = []  # ("add" | "clear", params) in issue order
+        self._lock = asyncio.Lock()
+        self._task = None
+        self.flushed = 0
+
+    async def _ensure_loaded(self, chat_id: int) -> dict:
+        users = self._chats.get(chat_id)
+        if users is not None:
+            self._chats.move_to_end(chat_id)
+            return users
+        loading = self._loading.get(chat_id)
+        if loading is None:
+            loading = self._loading[chat_id] = asyncio.ensure_future(self._load(chat_id))
+        return await loading
+
+    async def _load(self, chat_id: int) -> dict:
+        try:
+            await self.flush()  # an evicted chat may still have writes queued
+            rows = await db.fetchall(
+                """SELECT user_id, expires_at FROM warnings
+                WHERE chat_id = ? AND expires_at > ? ORDER BY expires_at""",
+                (chat_id, int(time.time()))
+            )
+        finally:
+            del self._loading[chat_id]
+        users = {}
+        for user_id, expires_at in rows:
+            users.setdefault(user_id, []).append(expires_at)
+        self._chats[chat_id] = users
+        if len(self._chats) > self.max_chats:
+            self._chats.popitem(last=False)
+        return users
+
+    def count(self, chat_id: int, user_id: int) -> int:
+        """Active warnings for a user in a loaded chat."""
+        users = self._chats.get(chat_id)
+        expiries = users.get(user_id) if users else None
+        if not expiries:
+            return 0
+        now = time.time()
+        if expiries[0] <= now:  # sorted, so the soonest expiry comes first
+            del expiries[:bisect.bisect_right(expiries, now)]
+            if not expiries:
+                del users[user_id]
+        return len(expiries)
+
+    async def add(self, chat_id: int, user_id: int, reason: str = None, issued_by: int = None,
+                  ttl: float = 30 * 86400) -> int:
+        """Record a warning and return the user's active count."""
+        users = await self._ensure_loaded(chat_id)
+        now = int(time.time())
+        expires_at = now + int(ttl)
+        bisect.insort(users.setdefault(user_id, []), expires_at)
+        self._queue("add", (chat_id, user_id, reason, issued_by, now, expires_at))
+        return self.count(chat_id, user_id)
+
+    async def clear(self, chat_id: int, user_id: int) -> int:
+        """Expire all of a user's active warnings; returns how many there were."""
+        users = await self._ensure_loaded(chat_id)
+        cleared = self.count(chat_id, user_id)
+        users.pop(user_id, None)
+        now = int(time.time())
+        self._queue("clear", (now, chat_id, user_id, now))
+        return cleared
+
+    def _queue(self, op: str, params: tuple):
+        self._pending.append((op, params))
+        if self._task is None:
+            self.start()
+        if len(self._pending) >= self.flush_size:
+            asyncio.get_running_loop().create_task(self.flush())
+
+    async def flush(self) -> int:
+        async with self._lock:
+            if not self._pending:
+                return 0
+            batch, self._pending = self._pending, []
+
+            def _write(conn):
+                # Consecutive writes of one kind share an executemany; order is preserved
+                for op, group in itertools.groupby(batch, key=lambda item: item[0]):
+                    conn.executemany(_WARNING_WRITES[op], [params for _, params in group])
+
+            try:
+                await db.run(_write, label="flush_warnings")
+            except sqlite3.Error as e:
+                print(f"Warning flush error: {e}")
+                self._pending[:0] = batch
+                return 0
+            self.flushed += len(batch)
+            return len(batch)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self.flush()
+
+warning_ledger = WarningLedger(WARN_FLUSH_INTERVAL, WARN_FLUSH_SIZE, WARN_CACHE_CHATS)
+
+async def issue_warning(bot, chat_id: int, user_id: int, reason: str = None, issued_by: int = None):
+    """Warn a user and escalate at the group's max_warnings.
+
+    Returns (count, limit, escalation) where escalation is "muted"/"banned"
+    or None. Escalating clears the user's warnings.
+    """
+    settings = (await settings_cache.get(chat_id))["anti_spam"]
+    limit = settings["max_warnings"] if settings else 3
+    action = settings["warn_action"] if settings else "mute"
+
+    count = await warning_ledger.add(chat_id, user_id, reason, issued_by, WARNING_TTL_DAYS * 86400)
+    audit_log.record(chat_id, "warn", user_id, issued_by, reason)
+    if count < limit:
+        return count, limit, None
+
+    await warning_ledger.clear(chat_id, user_id)
+    if action == "ban":
+        applied = await moderate(bot, chat_id, user_id, "ban", reason="warning limit")
+    else:
+        until, lift_tag = time.time() + WARN_MUTE_SECONDS, new_lift_tag()
+        applied = await moderate(
+            bot, chat_id, user_id, "mute", until_date=int(until), reason="warning limit", lift_tag=lift_tag
+        )
+        if applied:
+            await scheduler.schedule("unmute", until, {"chat_id": chat_id, "user_id": user_id, "tag": lift_tag})
+    return count, limit, WARN_ACTIONS.get(action, "muted") if applied else None
+
+# --- Moderation ---
+MODERATION_EMOJI = {"ban": "🔨", "kick": "👢", "mute": "🔇", "unmute": "🔊"}
+_ID_RANGE = re.compile(r"^(\d+)(?:-|\.\.)(\d+)$")
+_DURATION = re.compile(r"^(\d+)([mhd])$", re.IGNORECASE)
+_DURATION_SECONDS = {"m": 60, "h": 3600, "d": 86400}
+
+def parse_duration(token: str):
+    """Seconds for "30m", "2h" or "1d"; None if ``token`` is not a duration."""
+    match = _DURATION.match(token)
+    if not match or not int(match.group(1)):
+        return None
+    return int(match.group(1)) * _DURATION_SECONDS[match.group(2).lower()]
+
+async def command_targets(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Every user a moderation command names: the replied-to user (or the
+    members a replied-to join message added), text mentions, then leading
+    IDs, ID ranges and @usernames.
+
+    Returns (user_ids, unknown, rest): IDs in order without duplicates, tokens
+    that could not be resolved, and the arguments after the targets.
+    """
+    chat_id = update.effective_chat.id
+    message = update.message
+    targets = {}
+    reply = message.reply_to_message
+    if reply and reply.new_chat_members:
+        targets.update((member.id, None) for member in reply.new_chat_members if not member.is_bot)
+    elif reply and reply.from_user:
+        targets[reply.from_user.id] = None
+
+    args = list(context.args or [])
+    for entity, text in message.parse_entities(["text_mention"]).items():
+        targets[entity.user.id] = None
+        words = text.split()
+        for i in range(len(args) - len(words) + 1):
+            if args[i:i + len(words)] == words:
+                del args[i:i + len(words)]
+                break
+
+    unknown = []
+    while args:
+        token = args[0]
+        id_range = _ID_RANGE.match(token)
+        if token.isdigit():
+            targets[int(token)] = None
+        elif id_range:
+            first, last = int(id_range.group(1)), int(id_range.group(2))
+            if first > last or last - first >= MODERATION_MAX_TARGETS:
+                unknown.append(token)
+            else:
+                targets.update(dict.fromkeys(range(first, last + 1)))
+                if len(targets) > MODERATION_MAX_TARGETS:
+                    break  # already too many; the caller rejects the command
+        elif token.startswith("@") and len(token) > 1:
+            found = await user_directory.resolve(chat_id, token)
+            if found:
+                targets[found[0]] = None
+            else:
+                unknown.append(token)
+        else:
+            break
+        args.pop(0)
+    return list(targets), unknown, args
+
+def _format_ids(user_ids, limit: int = 20) -> str:
+    shown = ", ".join(f"`{user_id}`" for user_id in user_ids[:limit])
+    if len(user_ids) > limit:
+        shown += f" and {len(user_ids) - limit} more"
+    return shown
+
+async def moderation_command(update: Update, context: ContextTypes.DEFAULT_TYPE, action: str):
+    """Shared body of /ban, /kick, /mute and /unmute: resolve every target,
+    act on them concurrently and answer with one summary."""
+    if not await is_group_admin(update, context):
+        await update.message.reply_text("🚫 Admin only!")
+        return
+
+    user_ids, unknown, rest = await command_targets(update, context)
+    duration = rest[0] if action == "mute" and rest and parse_duration(rest[0]) else None
+    if duration:
+        rest = rest[1:]
+    bad_ranges = [token for token in unknown if _ID_RANGE.match(token)]
+    if bad_ranges:
+        await update.message.reply_text(
+            f"❌ Invalid ID range: {', '.join(bad_ranges)}. Ranges go low-high and cover at most "
+            f"{MODERATION_MAX_TARGETS} users."
+        )
+        return
+    if not user_ids:
+        if unknown:
+            await update.message.reply_text(
+                f"❌ Unknown user(s): {', '.join(unknown)}. Use their ID, or reply to one of their messages."
+            )
+        else:
+            extra = " [30m|2h|1d]" if action == "mute" else ""
+            await update.message.reply_text(
+                f"ℹ️ Usage: `/{action} <user_id|@username|first-last> ...{extra} [reason]` "
+                f"or reply to a message with `/{action}`",
+                parse_mode="Markdown"
+            )
+        return
+    if len(user_ids) > MODERATION_MAX_TARGETS:
+        await update.message.reply_text(
+            f"❌ Too many users ({len(user_ids)}); the limit is {MODERATION_MAX_TARGETS}. Use /kickall for larger sweeps."
+        )
+        return
+
+    # The caller's admin check loaded the chat's admin list, so these are cache hits
+    chat_id = update.effective_chat.id
+    skipped = []
+    if action != "unmute":
+        for user_id in list(user_ids):
+            if user_id == context.bot.id or await is_group_admin(update, context, user_id):
+                skipped.append(user_id)
+                user_ids.remove(user_id)
+
+    until = int(time.time()) + parse_duration(duration) if duration else None
+    lift_tag = new_lift_tag() if until else None
+    results = await run_moderation_batch(
+        context.bot, chat_id, user_ids, action, until_date=until,
+        actor_id=update.effective_user.id, reason=" ".join(rest) or None, lift_tag=lift_tag
+    )
+    done = [user_id for user_id, ok in zip(user_ids, results) if ok]
+    failed = [user_id for user_id, ok in zip(user_ids, results) if not ok]
+    if until and done:
+        await scheduler.schedule("unmute", until, {"chat_id": chat_id, "user_ids": done, "tag": lift_tag})
+
+    lines = []
+    if done:
+        noun = "user" if len(done) == 1 else f"{len(done)} users"
+        line = f"{MODERATION_EMOJI[action]} {BULK_ACTIONS[action]} {noun}: {_format_ids(done)}"
+        if action == "mute":
+            line += f" for {duration}" if duration else " until unmuted"
+        lines.append(line)
+    if failed:
+        lines.append(f"❌ Failed: {_format_ids(failed)}")
+    if skipped:
+        lines.append(f"🛡 Skipped admins: {_format_ids(skipped)}")
+    if unknown:
+        lines.append(f"❓ Unknown: {escape_markdown(', '.join(unknown))}")
+    await update.message.reply_text("\n".join(lines), parse_mode="Markdown")
+
+async def ban_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await moderation_command(update, context, "ban")
+
+async def kick_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await moderation_command(update, context, "kick")
+
+async def mute_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await moderation_command(update, context, "mute")
+
+async def unmute_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await moderation_command(update, context, "unmute")
+
+async def warn_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not await is_group_admin(update, context):
+        await update.message.reply_text("🚫 *Admin only!*", parse_mode="Markdown")
+        return
+
+    user_id, rest = await command_target(update, context)
+    if user_id is None:
+        await update.message.reply_text("ℹ️ Usage: /warn <user_id|@username> [reason], or reply to a message with /warn [reason]")
+        return
+    # Warnings escalate to a mute or ban, which admins are exempt from
+    if user_id == context.bot.id or await is_group_admin(update, context, user_id):
+        await update.message.reply_text(f"🛡 User {user_id} is an admin and can't be warned.")
+        return
+
+    reason = " ".join(rest) or None
+    count, limit, escalation = await issue_warning(
+        context.bot, update.effective_chat.id, user_id, reason, update.effective_user.id
+    )
+    text = f"⚠️ Warned user: {user_id} ({count}/{limit})"
+    if reason:
+        text += f"\nReason: {reason}"
+    if escalation:
+        text += f"\nWarning limit reached: user {escalation}."
+    await update.message.reply_text(text)
+
+async def list_warnings(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not await is_group_admin(update, context):
+        await update.message.reply_text("🚫 Admin only!")
+        return
+
+    user_id, _ = await command_target(update, context)
+    if user_id is None:
+        await update.message.reply_text("ℹ️ Usage: /warnings <user_id>, or reply to a message with /warnings")
+        return
+
+    await warning_ledger.flush()  # reasons live in the table
+    rows = await db.fetchall(
+        """SELECT reason, issued_by, created_at, expires_at FROM warnings
+        WHERE chat_id = ? AND user_id = ? AND expires_at > ? ORDER BY created_at""",
+        (update.effective_chat.id, user_id, int(time.time()))
+    )
+    if not rows:
+        await update.message.reply_text(f"✅ User {user_id} has no active warnings.")
+        return
+    lines = [
+        f"{i}. {reason or 'no reason'} — {'auto' if issued_by is None else f'by {issued_by}'}, "
+        f"{datetime.fromtimestamp(created_at):%Y-%m-%d}, expires {datetime.fromtimestamp(expires_at):%Y-%m-%d}"
+        for i, (reason, issued_by, created_at, expires_at) in enumerate(rows, 1)
+    ]
+    await update.message.reply_text(f"⚠️ Warnings for {user_id}:\n" + "\n".join(lines))
+
+async def clear_warnings(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not await is_group_admin(update, context):
+        await update.message.reply_text("🚫 Admin only!")
+        return
+
+    user_id, _ = await command_target(update, context)
+    if user_id is None:
+        await update.message.reply_text("ℹ️ Usage: /unwarn <user_id>, or reply to a message with /unwarn")
+        return
+    cleared = await warning_ledger.clear(update.effective_chat.id, user_id)
+    audit_log.record(update.effective_chat.id, "unwarn", user_id, update.effective_user.id)
+    await update.message.reply_text(f"🧽 Cleared {cleared} warning(s) for user {user_id}")
+
+async def warn_config(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not await is_group_admin(update, context):
+        await update.message.reply_text("🚫 Admin only!")
+        return
+
+    usage = "ℹ️ Usage: /warnconfig <mute|ban> [max_warnings]"
+    try:
+        action = context.args[0].lower()
+        limit = int(context.args[1]) if len(context.args) > 1 else None
+        if action not in WARN_ACTIONS or (limit is not None and limit < 1):
+            raise ValueError
+    except (IndexError, ValueError):
+        await update.message.reply_text(usage)
+        return
+
+    def _configure(conn):
+        conn.execute("""
+            INSERT INTO anti_spam_settings (group_id) VALUES (?)
+            ON CONFLICT(group_id) DO NOTHING
+        """, (update.effective_chat.id,))
+        conn.execute("""
+            UPDATE anti_spam_settings
+            SET warn_action = ?, max_warnings = COALESCE(?, max_warnings)
+            WHERE group_id = ?
+        """, (action, limit, update.effective_chat.id))
+        return conn.execute(
+            f"SELECT {ANTI_SPAM_COLUMNS} FROM anti_spam_settings WHERE group_id = ?",
+            (update.effective_chat.id,)
+        ).fetchone()
+
+    row = await db.run(_configure, label="warn_config")
+    settings = _anti_spam_row(row)
+    settings_cache.update(update.effective_chat.id, anti_spam=settings)
+    await update.message.reply_text(
+        f"⚠️ Users are {WARN_ACTIONS[settings['warn_action']]} after {settings['max_warnings']} warnings"
+    )
+
+# --- Flood Control ---
+FLOOD_ACTIONS = ("delete", "mute", "ban")
+
+class FloodDetector:
+    """Sliding-window message rates per (chat, user) and duplicate-text
+    fingerprints per chat, with periodic eviction of idle entries."""
+
+    def __init__(self, idle_seconds: float = 300, fingerprints_per_chat: int = 512):
+        self.idle_seconds = idle_seconds
+        self.fingerprints_per_chat = fingerprints_per_chat
+        self._rates = {}  # (chat_id, user_id) -> deque of timestamps
+        self._fingerprints = {}  # chat_id -> OrderedDict(fingerprint -> deque of timestamps)
+        self._next_sweep = time.monotonic() + idle_seconds
+
+    def check(self, chat_id: int, user_id: int, text: str, limit: int, window: float, duplicate_limit: int):
+        """Record a message and return "flood", "duplicate" or None."""
+        now = time.monotonic()
+        if now >= self._next_sweep:
+            self.sweep(now)
+
+        key = (chat_id, user_id)
+        stamps = self._rates.get(key)
+        if stamps is None or stamps.maxlen != limit:
+            stamps = self._rates[key] = deque(stamps or (), maxlen=max(limit, 1))
+        stamps.append(now)
+        if len(stamps) == stamps.maxlen and now - stamps[0] <= window:
+            return "flood"
+
+        if text and duplicate_limit:
+            chat_prints = self._fingerprints.get(chat_id)
+            if chat_prints is None:
+                chat_prints = self._fingerprints[chat_id] = OrderedDict()
+            fingerprint = hash(" ".join(normalize_text(text).split()))
+            seen = chat_prints.get(fingerprint)
+            if seen is None or seen.maxlen != duplicate_limit:
+                seen = chat_prints[fingerprint] = deque(seen or (), maxlen=duplicate_limit)
+            chat_prints.move_to_end(fingerprint)
+            seen.append(now)
+            if len(chat_prints) > self.fingerprints_per_chat:
+                chat_prints.popitem(last=False)
+            if len(seen) == seen.maxlen and now - seen[0] <= window:
+                return "duplicate"
+        return None
+
+    def sweep(self, now: float = None):
+        now = now or time.monotonic()
+        cutoff = now - self.idle_seconds
+        self._rates = {key: stamps for key, stamps in self._rates.items() if stamps[-1] > cutoff}
+        for chat_id in list(self._fingerprints):
+            chat_prints = self._fingerprints[chat_id]
+            for fingerprint in [fp for fp, seen in chat_prints.items() if seen[-1] <= cutoff]:
+                del chat_prints[fingerprint]
+            if not chat_prints:
+                del self._fingerprints[chat_id]
+        self._next_sweep = now + self.idle_seconds
+
+flood_detector = FloodDetector(FLOOD_IDLE_SECONDS, FLOOD_FINGERPRINTS_PER_CHAT)
+
+async def anti_flood(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not update.effective_chat or update.effective_chat.type == "private" or not update.effective_user:
+        return
+
+    settings = (await settings_cache.get(update.effective_chat.id))["anti_spam"]
+    if not settings or not settings["is_active"]:
+        return
+
+    message = update.effective_message
+    reason = flood_detector.check(
+        update.effective_chat.id,
+        update.effective_user.id,
+        message.text or message.caption,
+        settings["flood_limit"],
+        settings["flood_window"],
+        settings["duplicate_limit"],
+    )
+    if not reason or await is_group_admin(update, context):
+        return
+
+    activity.event(update.effective_chat.id, "spam")
+    action = settings["flood_action"]
+    chat_id, user_id = update.effective_chat.id, update.effective_user.id
+    try:
+        await message.delete()
+        audit_log.record(chat_id, "delete", user_id, reason=f"flood: {reason}")
+        if action == "mute":
+            until, lift_tag = time.time() + FLOOD_MUTE_SECONDS, new_lift_tag()
+            if await moderate(context.bot, chat_id, user_id, "mute", until_date=int(until),
+                              reason=f"flood: {reason}", lift_tag=lift_tag):
+                await scheduler.schedule("unmute", until, {"chat_id": chat_id, "user_id": user_id, "tag": lift_tag})
+        elif action == "ban":
+            await moderate(context.bot, chat_id, user_id, "ban", reason=f"flood: {reason}")
+
+        if action != "delete":
+            outbound.notify(
+                update.effective_chat.id,
+                "🌊 Flood Control:",
+                f"User: {markdown_mention(update.effective_user)}\n"
+                f"Reason: {reason}\n"
+                f"Action: {'muted' if action == 'mute' else 'banned'}"
+            )
+    except Exception as e:
+        print(f"Anti-flood error: {e}")
+
+    # The message is gone; don't run keyword checks on it
+    raise ApplicationHandlerStop
+
+async def set_antiflood(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not await is_group_admin(update, context):
+        await update.message.reply_text("🚫 Admin only!")
+        return
+
+    usage = "ℹ️ Usage: /antiflood <delete|mute|ban> [messages] [seconds]"
+    if not context.args or context.args[0].lower() not in FLOOD_ACTIONS:
+        await update.message.reply_text(usage)
+        return
+
+    try:
+        action = context.args[0].lower()
+        limit = int(context.args[1]) if len(context.args) > 1 else None
+        window = int(context.args[2]) if len(context.args) > 2 else None
+        if (limit is not None and limit < 2) or (window is not None and window < 1):
+            raise ValueError
+    except ValueError:
+        await update.message.reply_text(usage)
+        return
+
+    def _configure(conn):
+        conn.execute("""
+            INSERT INTO anti_spam_settings (group_id) VALUES (?)
+            ON CONFLICT(group_id) DO NOTHING
+        """, (update.effective_chat.id,))
+        conn.execute("""
+            UPDATE anti_spam_settings
+            SET flood_action = ?,
+                flood_limit = COALESCE(?, flood_limit),
+                flood_window = COALESCE(?, flood_window)
+            WHERE group_id = ?
+        """, (action, limit, window, update.effective_chat.id))
+        return conn.execute(
+            f"SELECT {ANTI_SPAM_COLUMNS} FROM anti_spam_settings WHERE group_id = ?",
+            (update.effective_chat.id,)
+        ).fetchone()
+
+    row = await db.run(_configure, label="set_antiflood")
+    settings = _anti_spam_row(row)
+    settings_cache.update(update.effective_chat.id, anti_spam=settings)
+    await update.message.reply_text(
+        f"🌊 Flood control: {settings['flood_action']} after "
+        f"{settings['flood_limit']} messages in {settings['flood_window']}s"
+    )
+
+# --- Anti-Spam ---
+async def anti_spam(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_chat.type == "private":
+        return
+    
+    # Get group settings
+    group = await settings_cache.get(update.effective_chat.id)
+    settings = group["anti_spam"]
+    
+    # Skip if anti-spam is disabled
+    if not settings or not settings["is_active"]:
+        return
+    
+    # Check for spam triggers
+    message_text = update.message.text.lower() if update.message.text else ""
+    rules = get_spam_matcher(group)
+    rule, seconds = rules.check(message_text)
+    if rules.slow_match_ms is not None:
+        outbound.notify(
+            update.effective_chat.id,
+            "⚠️ Anti-Spam:",
+            f"Regex rules took {rules.slow_match_ms:.0f} ms on one message and are paused "
+            f"until the rules change. Check them with /spamrule list."
+        )
+        rules.slow_match_ms = None
+
+    if rule and settings["dry_run"]:
+        outbound.notify(
+            update.effective_chat.id,
+            "🧪 Anti-Spam Dry Run:",
+            f"User: {markdown_mention(update.effective_user)}\n"
+            f"Rule: {describe_spam_rule(rule)}\n"
+            f"Match time: {seconds * 1000:.2f} ms"
+        )
+        return
+
+    if rule:
+        chat_id, user_id = update.effective_chat.id, update.effective_user.id
+        try:
+            await update.message.delete()
+            audit_log.record(chat_id, "delete", user_id, reason=f"spam: {describe_spam_rule(rule)}")
+            
+            is_admin = await is_group_admin(update, context, user_id)
+            if not is_admin:
+                activity.event(chat_id, "spam")  # /stats counts spammers moderated, not admins' slips
+            if is_admin:
+                action = "message deleted (admins are not warned or banned)"
+            elif settings["warn_on_spam"]:
+                count, limit, escalation = await issue_warning(
+                    context.bot, update.effective_chat.id, update.effective_user.id, f"spam: {rule[2]}"
+                )
+                action = f"message deleted, warned ({count}/{limit})"
+                if escalation:
+                    action += f", {escalation}"
+            elif settings["ban_instead_of_delete"]:
+                await moderate(context.bot, chat_id, user_id, "ban", reason=f"spam: {describe_spam_rule(rule)}")
+                action = "banned"
+            else:
+                action = "message deleted"
+                
+            admin_notice = (
+                f"User: {markdown_mention(update.effective_user)}\n"
+                f"Action: {action}\n"
+                f"Content: {escape_markdown(message_text[:100])}..."
+            )
+            
+            # Send notice to admins (optional); bursts are merged into one summary
+            outbound.notify(update.effective_chat.id, "🚨 Anti-Spam Action:", admin_notice)
+            
+        except Exception as e:
+            print(f"Anti-spam error: {e}")
+
+        # Spam never reaches later stages such as FAQ auto-replies
+        raise ApplicationHandlerStop
+
+SPAM_MODES = {"delete": (0, 0), "ban": (1, 0), "warn": (0, 1)}  # (ban_instead_of_delete, warn_on_spam)
+SPAM_MODE_DESCRIPTIONS = {
+    "delete": "delete spam",
+    "ban": "delete spam and ban the sender",
+    "warn": "delete spam and warn the sender, escalating at the warning limit",
+}
+
+async def toggle_antispam(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not await is_group_admin(update, context):
+        await update.message.reply_text("🚫 Admin only!")
+        return
+    
+    # With an argument, choose what happens to spammers instead of toggling
+    mode = context.args[0].lower() if context.args else None
+    if mode is not None and mode not in SPAM_MODES:
+        await update.message.reply_text("ℹ️ Usage: /antispam [delete|ban|warn]")
+        return
+
+    def _toggle(conn):
+        cursor = conn.cursor()
+
+        if mode is None:
+            # Toggle the setting, keeping the group's other anti-spam columns
+            cursor.execute("""
+                INSERT INTO anti_spam_settings (group_id, is_active) VALUES (?, 1)
+                ON CONFLICT(group_id) DO UPDATE SET is_active = NOT is_active
+            """, (update.effective_chat.id,))
+        else:
+            ban, warn = SPAM_MODES[mode]
+            cursor.execute("""
+                INSERT INTO anti_spam_settings (group_id, ban_instead_of_delete, warn_on_spam) VALUES (?, ?, ?)
+                ON CONFLICT(group_id) DO UPDATE SET
+                    ban_instead_of_delete = excluded.ban_instead_of_delete,
+                    warn_on_spam = excluded.warn_on_spam
+            """, (update.effective_chat.id, ban, warn))
+
+        # Get new status
+        cursor.execute(
+            f"SELECT {ANTI_SPAM_COLUMNS} FROM anti_spam_settings WHERE group_id = ?",
+            (update.effective_chat.id,)
+        )
+        return cursor.fetchone()
+
+    row = await db.run(_toggle, label="toggle_antispam")
+    is_active = row[0]
+    settings_cache.update(update.effective_chat.id, anti_spam=_anti_spam_row(row))
+    
+    if mode is not None:
+        await update.message.reply_text(f"Anti-spam will now {SPAM_MODE_DESCRIPTIONS[mode]}")
+        return
+    status = "✅ enabled" if is_active else "❌ disabled"
+    await update.message.reply_text(f"Anti-spam is now {status}")
+
+SPAM_RULE_USAGE = (
+    "ℹ️ Usage:\n"
+    "/spamrule list\n"
+    "/spamrule add <keyword>\n"
+    "/spamrule regex <pattern>\n"
+    "/spamrule remove <id>\n"
+    "/spamrule test <text>\n"
+    "/spamrule dryrun <on|off>"
+)
+
+async def spam_rule(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Manage the group's keyword and regex spam rules."""
+    if not await is_group_admin(update, context):
+        await update.message.reply_text("🚫 Admin only!")
+        return
+
+    chat_id = update.effective_chat.id
+    parts = (update.message.text or "").split(None, 2)
+    verb = parts[1].lower() if len(parts) > 1 else ""
+    argument = parts[2].strip() if len(parts) > 2 else ""
+    group = await settings_cache.get(chat_id)
+
+    if verb == "list":
+        anti_spam_settings = group["anti_spam"]
+        lines = [describe_spam_rule(rule) for rule in group["triggers"]]
+        dry_run = "on" if anti_spam_settings and anti_spam_settings["dry_run"] else "off"
+        text = f"🧾 *Spam rules* ({len(lines)}, dry run {dry_run})\n" + ("\n".join(lines) or "No custom rules.")
+        await update.message.reply_text(text[:4000], parse_mode="Markdown")
+        return
+
+    if verb == "test" and argument:
+        rule, seconds = get_spam_matcher(group).check(argument)
+        result = f"Matched {describe_spam_rule(rule)}" if rule else "No rule matched"
+        await update.message.reply_text(f"🧪 {result} in {seconds * 1000:.2f} ms", parse_mode="Markdown")
+        return
+
+    if verb == "dryrun" and argument.lower() in ("on", "off"):
+        def _set_dry_run(conn):
+            conn.execute("""
+                INSERT INTO anti_spam_settings (group_id, dry_run) VALUES (?, ?)
+                ON CONFLICT(group_id) DO UPDATE SET dry_run = excluded.dry_run
+            """, (chat_id, argument.lower() == "on"))
+            return conn.execute(
+                f"SELECT {ANTI_SPAM_COLUMNS} FROM anti_spam_settings WHERE group_id = ?", (chat_id,)
+            ).fetchone()
+
+        row = await db.run(_set_dry_run, label="set_spam_dry_run")
+        settings_cache.update(chat_id, anti_spam=_anti_spam_row(row))
+        await update.message.reply_text(
+            "🧪 Dry run on: matches are reported, not acted on." if row[7] else "🧪 Dry run off."
+        )
+        return
+
+    if verb in ("add", "regex") and argument:
+        kind = "regex" if verb == "regex" else "keyword"
+        if len(group["triggers"]) >= SPAM_RULES_PER_GROUP:
+            await update.message.reply_text(f"❌ Groups are limited to {SPAM_RULES_PER_GROUP} rules.")
+            return
+        if kind == "keyword":
+            problem = None if normalize_text(argument).strip() else "Keyword is empty."
+            if len(argument) > SPAM_RULE_MAX_LENGTH:
+                problem = f"Keywords are limited to {SPAM_RULE_MAX_LENGTH} characters."
+        else:
+            problem = validate_spam_regex(argument)
+            if not problem:
+                worst = await probe_spam_regex(argument)
+                if worst is None:
+                    problem = f"Matching did not finish within {SPAM_REGEX_PROBE_TIMEOUT:g}s on a test message."
+                elif worst * 1000 > SPAM_REGEX_BUDGET_MS:
+                    problem = f"Matching took {worst * 1000:.0f} ms on a test message (limit {SPAM_REGEX_BUDGET_MS:g} ms)."
+        if problem:
+            await update.message.reply_text(f"❌ {problem}")
+            return
+
+        def _add(conn):
+            conn.execute("""
+                INSERT INTO spam_triggers (chat_id, kind, trigger, created_by, created_at)
+                VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT(chat_id, kind, trigger) DO NOTHING
+            """, (chat_id, kind, argument, update.effective_user.id, int(time.time())))
+            return _load_spam_rules(conn, chat_id)
+
+        rules = await db.run(_add, label="add_spam_rule")
+        settings_cache.update(chat_id, triggers=rules)
+        rule = next(rule for rule in rules if rule[1:] == (kind, argument))
+        await update.message.reply_text(f"✅ Added {describe_spam_rule(rule)}", parse_mode="Markdown")
+        return
+
+    if verb == "remove" and argument.lstrip("#").isdigit():
+        rule_id = int(argument.lstrip("#"))
+
+        def _remove(conn):
+            removed = conn.execute(
+                "DELETE FROM spam_triggers WHERE rule_id = ? AND chat_id = ?", (rule_id, chat_id)
+            ).rowcount
+            return removed, _load_spam_rules(conn, chat_id)
+
+        removed, rules = await db.run(_remove, label="remove_spam_rule")
+        settings_cache.update(chat_id, triggers=rules)
+        await update.message.reply_text(f"🗑 Removed rule #{rule_id}" if removed else f"❌ No rule #{rule_id}")
+        return
+
+    await update.message.reply_text(SPAM_RULE_USAGE)
+
+async def userinfo(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not await is_group_admin(update, context):
+        await update.message.reply_text("🚫 Admin only!")
+        return
+
+    # Replies carry the user; IDs and @usernames come from the user directory,
+    # falling back to the API only for IDs the bot has not seen here
+    chat_id = update.effective_chat.id
+    found = None
+    reply = update.message.reply_to_message
+    if reply and reply.from_user:
+        found = (reply.from_user.id, reply.from_user.username, reply.from_user.full_name)
+    else:
+        user_id, _ = await command_target(update, context)
+        if user_id is not None:
+            found = await user_directory.get(chat_id, user_id)
+            if found is None:
+                try:
+                    member = await context.bot.get_chat_member(chat_id, user_id)
+                    found = (member.user.id, member.user.username, member.user.full_name)
+                    user_directory.observe(chat_id, member.user)
+                except TelegramError as e:
+                    print(f"Error fetching user: {e}")
+
+    if not found:
+        await update.message.reply_text("❌ User not found. Reply to their message or tag them (@username).")
+        return
+
+    # Send user details
+    user_id, username, full_name = found
+    response = (
+        f"👤 *User Info*\n"
+        f"Name: `{full_name}`\n"
+        f"Username: `{'@' + username if username else '-'}`\n"
+        f"ID: `{user_id}`\n\n"
+        f"⚠️ *Pro Tip*: Use `/ban {user_id}`"
+    )
+    await update.message.reply_text(response, parse_mode="Markdown")
+
+# --- Bulk Moderation ---
+BULK_ACTIONS = {"kick": "Kicked", "ban": "Banned", "unban": "Unbanned", "mute": "Muted", "unmute": "Unmuted"}
+_running_jobs = set()
+_cancelled_jobs = set()
+
+def new_lift_tag() -> str:
+    """Identifies one timed mute; its unmute job lifts only users still carrying it."""
+    return f"{time.time_ns():x}"
+
+async def track_restrictions(chat_id: int, user_ids, action: str, lift_tag: str = None):
+    """Record applied actions against scheduled unmutes.
+
+    A mute with a ``lift_tag`` becomes the user's current timed mute; any
+    other action (a permanent mute, unmute, ban or kick) supersedes it, so
+    an older unmute job no longer undoes the later decision.
+    """
+    rows = [(chat_id, user_id) for user_id in user_ids]
+    if not rows:
+        return
+    try:
+        if action == "mute" and lift_tag is not None:
+            await db.executemany(
+                """INSERT INTO timed_mutes (chat_id, user_id, lift_tag) VALUES (?, ?, ?)
+                ON CONFLICT(chat_id, user_id) DO UPDATE SET lift_tag = excluded.lift_tag""",
+                [(*row, lift_tag) for row in rows], label="track_timed_mutes"
+            )
+        else:
+            await db.executemany(
+                "DELETE FROM timed_mutes WHERE chat_id = ? AND user_id = ?", rows, label="clear_timed_mutes"
+            )
+    except sqlite3.Error as e:
+        print(f"Timed mute tracking error: {e}")
+
+async def claim_timed_mutes(chat_id: int, user_ids, lift_tag: str) -> list:
+    """The given users whose current timed mute is ``lift_tag``, forgetting it."""
+    def _claim(conn):
+        current = {user_id for (user_id,) in conn.execute(
+            "SELECT user_id FROM timed_mutes WHERE chat_id = ? AND lift_tag = ?", (chat_id, lift_tag)
+        )}
+        claimed = [user_id for user_id in dict.fromkeys(user_ids) if user_id in current]
+        conn.executemany(
+            "DELETE FROM timed_mutes WHERE chat_id = ? AND user_id = ?", [(chat_id, user_id) for user_id in claimed]
+        )
+        return claimed
+
+    return await db.run(_claim, label="claim_timed_mutes")
+
+async def moderate(bot, chat_id: int, user_id: int, action: str, until_date=None,
+                   actor_id: int = None, reason: str = None, lift_tag: str = None,
+                   track: bool = True) -> bool:
+    """Apply one moderation action, honouring the per-chat rate and RetryAfter.
+
+    Applied actions go to the audit log under ``actor_id`` (None for the bot)
+    and, unless ``track`` is off, to track_restrictions with ``lift_tag``.
+    """
+    for _ in range(BULK_MAX_RETRIES):
+        await moderation_limiter.wait(chat_id)
+        try:
+            if action == "kick":
+                await bot.ban_chat_member(chat_id, user_id, until_date=int(time.time()) + 60)
+            elif action == "ban":
+                await bot.ban_chat_member(chat_id, user_id, until_date=until_date)
+            elif action == "unban":
+                await bot.unban_chat_member(chat_id, user_id, only_if_banned=True)
+            elif action == "mute":
+                await bot.restrict_chat_member(chat_id, user_id, permissions=MUTED_PERMISSIONS, until_date=until_date)
+            elif action == "unmute":
+                await bot.restrict_chat_member(chat_id, user_id, permissions=UNMUTED_PERMISSIONS)
+            else:
+                raise ValueError(f"Unknown moderation action: {action}")
+            audit_log.record(chat_id, action, user_id, actor_id, reason)
+            if track:
+                await track_restrictions(chat_id, [user_id], action, lift_tag)
+            return True
+        except RetryAfter as e:
+            moderation_limiter.pause(chat_id, e.retry_after)
+        except TelegramError as e:
+            print(f"Moderation error ({action} {user_id} in {chat_id}): {e}")
+            return False
+    return False
+
+async def run_moderation_batch(bot, chat_id: int, user_ids, action: str, until_date=None,
+                               concurrency: int = BULK_CONCURRENCY, actor_id: int = None,
+                               reason: str = None, lift_tag: str = None) -> list:
+    """Run ``action`` for every user with bounded concurrency; returns per-user success flags."""
+    semaphore = asyncio.Semaphore(concurrency)
+    user_ids = list(user_ids)
+
+    async def _one(user_id):
+        async with semaphore:
+            return await moderate(
+                bot, chat_id, user_id, action, until_date, actor_id, reason, lift_tag, track=False
+            )
+
+    results = await asyncio.gather(*(_one(user_id) for user_id in user_ids))
+    await track_restrictions(chat_id, [user_id for user_id, ok in zip(user_ids, results) if ok], action, lift_tag)
+    return results
+
+async def create_bulk_job(chat_id: int, action: str, user_ids, created_by: int) -> int:
+    def _create(conn):
+        cursor = conn.execute(
+            """INSERT INTO bulk_jobs (chat_id, action, created_by, total, created_at)
+            VALUES (?, ?, ?, ?, ?)""",
+            (chat_id, action, created_by, len(user_ids), datetime.now().isoformat())
+        )
+        job_id = cursor.lastrowid
+        conn.executemany(
+            "INSERT OR IGNORE INTO bulk_job_targets (job_id, user_id) VALUES (?, ?)",
+            [(job_id, user_id) for user_id in user_ids]
+        )
+        return job_id
+
+    return await db.run(_create, label="create_bulk_job")
+
+async def _edit_bulk_status(bot, job_id: int, chat_id: int, message_id: int,
+                            action: str, done: int, failed: int, total: int, state: str):
+    if not message_id:
+        return
+    text = (
+        f"🧹 *Bulk {action}* — {state}\n"
+        f"{BULK_ACTIONS[action]}: {done}/{total}\n"
+        f"Failed: {failed}"
+    )
+    keyboard = None
+    if state == "running":
+        keyboard = InlineKeyboardMarkup([[InlineKeyboardButton("⏹ Stop", callback_data=f"bulk_cancel_{job_id}")]])
+    try:
+        await bot.edit_message_text(text, chat_id=chat_id, message_id=message_id,
+                                    parse_mode="Markdown", reply_markup=keyboard)
+    except TelegramError as e:
+        print(f"Bulk status edit error: {e}")
+
+async def run_bulk_job(bot, job_id: int):
+    """Work through a job's pending targets in persisted chunks; safe to resume."""
+    if job_id in _running_jobs:
+        return
+    _running_jobs.add(job_id)
+    try:
+        job = await db.fetchone(
+            """SELECT chat_id, action, status_message_id, total, done_count, failed_count, created_by
+            FROM bulk_jobs WHERE job_id = ?""",
+            (job_id,)
+        )
+        if not job:
+            return
+        chat_id, action, message_id, total, done, failed, created_by = job
+        pending = [row[0] for row in await db.fetchall(
+            "SELECT user_id FROM bulk_job_targets WHERE job_id = ? AND status = 'pending'", (job_id,)
+        )]
+
+        last_edit = 0.0
+        for start in range(0, len(pending), BULK_CHUNK_SIZE):
+            if job_id in _cancelled_jobs:
+                break
+            chunk = pending[start:start + BULK_CHUNK_SIZE]
+            results = await run_moderation_batch(
+                bot, chat_id, chunk, action, actor_id=created_by, reason=f"bulk job {job_id}"
+            )
+            done += sum(results)
+            failed += len(results) - sum(results)
+
+            def _save(conn):
+                conn.executemany(
+                    "UPDATE bulk_job_targets SET status = ? WHERE job_id = ? AND user_id = ?",
+                    [("done" if ok else "failed", job_id, user_id) for user_id, ok in zip(chunk, results)]
+                )
+                conn.execute(
+                    "UPDATE bulk_jobs SET done_count = ?, failed_count = ? WHERE job_id = ?",
+                    (done, failed, job_id)
+                )
+
+            await db.run(_save, label="bulk_job_progress")
+            if time.monotonic() - last_edit >= BULK_PROGRESS_INTERVAL:
+                last_edit = time.monotonic()
+                await _edit_bulk_status(bot, job_id, chat_id, message_id, action, done, failed, total, "running")
+
+        state = "cancelled" if job_id in _cancelled_jobs else "done"
+        await db.execute("UPDATE bulk_jobs SET status = ? WHERE job_id = ?", (state, job_id))
+        await _edit_bulk_status(bot, job_id, chat_id, message_id, action, done, failed, total, state)
+    finally:
+        _running_jobs.discard(job_id)
+        _cancelled_jobs.discard(job_id)
+
+async def resume_bulk_jobs(app):
+    """Restart jobs that were running when the bot last stopped."""
+    rows = await db.fetchall("SELECT job_id, chat_id FROM bulk_jobs WHERE status = 'running'")
+    for job_id, chat_id in rows:
+        if shard_for(chat_id) == SHARD_ID:
+            app.create_task(run_bulk_job(app.bot, job_id))
+
+async def known_member_ids(chat_id: int) -> list:
+    """Members the bot has seen in this chat.
+
+    The Bot API cannot list group members, so this is limited to users the
+    bot has recorded itself: the user directory plus WCG participants.
+    """
+    await user_directory.flush()
+    rows = await db.fetchall(
+        """SELECT user_id FROM chat_users WHERE chat_id = ?
+        UNION
+        SELECT p.user_id FROM games g
+        JOIN game_participants p ON p.poll_id = g.poll_id
+        WHERE g.chat_id = ?""",
+        (chat_id, chat_id)
+    )
+    return [user_id for (user_id,) in rows]
+
+async def kickall(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not await is_group_admin(update, context):
+        await update.message.reply_text("🚫 Admin only!")
+        return
+
+    chat_id = update.effective_chat.id
+    try:
+        targets = [int(arg) for arg in context.args] if context.args else await known_member_ids(chat_id)
+    except ValueError:
+        await update.message.reply_text("ℹ️ Usage: /kickall [user_id ...]")
+        return
+
+    try:
+        admins = await prefetch_admins(context.bot, chat_id)
+    except TelegramError as e:
+        await update.message.reply_text(f"❌ Couldn't load the admin list: {e}")
+        return
+    targets = [
+        user_id for user_id in dict.fromkeys(targets)
+        if user_id not in admins and user_id != context.bot.id
+    ]
+    if not targets:
+        await update.message.reply_text("ℹ️ No known non-admin members to kick.")
+        return
+
+    job_id = await create_bulk_job(chat_id, "kick", targets, update.effective_user.id)
+    keyboard = InlineKeyboardMarkup([[
+        InlineKeyboardButton("✅ Confirm", callback_data=f"bulk_confirm_{job_id}"),
+        InlineKeyboardButton("❌ Cancel", callback_data=f"bulk_cancel_{job_id}"),
+    ]])
+    message = await update.message.reply_text(
+        f"⚠️ Kick {len(targets)} non-admin members? This cannot be undone.",
+        reply_markup=keyboard
+    )
+    await db.execute(
+        "UPDATE bulk_jobs SET status_message_id = ? WHERE job_id = ?", (message.message_id, job_id)
+    )
+
+async def handle_bulk_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Confirm, cancel or stop a bulk job ("bulk_<confirm|cancel>_<job_id>")."""
+    query = update.callback_query
+    if not await is_group_admin(update, context):
+        await query.edit_message_text("🚫 Admin only!")
+        return
+
+    parts = query.data.split("_", 2)
+    if len(parts) != 3 or not parts[2].isdigit():
+        await query.edit_message_text("❌ Invalid bulk command format.")
+        return
+    _, verb, job_id = parts
+    job_id = int(job_id)
+
+    row = await db.fetchone(
+        "SELECT chat_id, action, status, total FROM bulk_jobs WHERE job_id = ?", (job_id,)
+    )
+    if not row or row[0] != update.effective_chat.id:
+        await query.edit_message_text("❌ Job not found.")
+        return
+    chat_id, action, status, total = row
+
+    if verb == "confirm" and status == "pending":
+        await db.execute(
+            "UPDATE bulk_jobs SET status = 'running', status_message_id = ? WHERE job_id = ?",
+            (query.message.message_id, job_id)
+        )
+        await _edit_bulk_status(context.bot, job_id, chat_id, query.message.message_id, action, 0, 0, total, "running")
+        context.application.create_task(run_bulk_job(context.bot, job_id))
+    elif verb == "cancel" and status == "pending":
+        await db.execute("UPDATE bulk_jobs SET status = 'cancelled' WHERE job_id = ?", (job_id,))
+        await query.edit_message_text("❌ Bulk action cancelled.")
+    elif verb == "cancel" and status == "running":
+        _cancelled_jobs.add(job_id)
+
+# --- Join Raid Protection ---
+class JoinGuard:
+    """New-member pipeline: sliding-window join rates per chat, batched
+    restriction and collapsed welcomes.
+
+    Joins are only appended to memory; each chat is flushed at most once per
+    ``batch_seconds``, and a whole raid costs a single scheduled lift job.
+    """
+
+    def __init__(self, limit: int = 10, window: float = 10, quiet_seconds: float = 60, batch_seconds: float = 1.0):
+        self.limit = limit
+        self.window = window
+        self.quiet_seconds = quiet_seconds
+        self.batch_seconds = batch_seconds
+        self._chats = {}  # chat_id -> state dict
+        self._tasks = set()
+        self._next_sweep = time.monotonic() + quiet_seconds
+        self.raids = 0
+
+    def add(self, bot, chat_id: int, members: list, features: dict, raid_protection: bool):
+        """Record (user_id, name) newcomers; restriction and welcome happen on the next flush."""
+        now = time.monotonic()
+        if now >= self._next_sweep:
+            self.sweep(now)
+
+        state = self._chats.get(chat_id)
+        if state is None:
+            state = self._chats[chat_id] = {
+                "joins": deque(), "pending": [], "raid": None, "flush": None, "last_join": now, "features": features,
+            }
+        joins = state["joins"]
+        joins.extend((now, member) for member in members)
+        while joins and now - joins[0][0] > self.window:
+            joins.popleft()
+        state["last_join"] = now
+        state["features"] = features
+        state["pending"].extend(members)
+
+        if raid_protection and state["raid"] is None and len(joins) >= self.limit:
+            # Everyone who joined inside the window is part of the raid, even if already welcomed
+            state["pending"] = list(dict.fromkeys([member for _, member in joins] + state["pending"]))
+            state["raid"] = {"started": time.time(), "user_ids": [], "tasks": set(), "tag": new_lift_tag()}
+            self.raids += 1
+            self._send(chat_id, "🛡 Join raid detected: new members are muted until it is over.")
+            asyncio.get_running_loop().call_later(self.quiet_seconds, self._check_quiet, bot, chat_id)
+
+        if state["flush"] is None:
+            # The coroutine is only created when the timer fires; flush() may cancel it first
+            state["flush"] = asyncio.get_running_loop().call_later(
+                self.batch_seconds, self._spawn_flush, bot, chat_id
+            )
+
+    async def flush(self, bot, chat_id: int):
+        state = self._chats.get(chat_id)
+        if state is None:
+            return
+        if state["flush"] is not None:
+            state["flush"].cancel()
+            state["flush"] = None
+        members, state["pending"] = state["pending"], []
+        if not members:
+            return
+        user_ids = list(dict.fromkeys(user_id for user_id, _ in members))
+
+        raid = state["raid"]
+        if raid is not None:
+            raid["user_ids"].extend(user_ids)
+            task = asyncio.ensure_future(run_moderation_batch(
+                bot, chat_id, user_ids, "mute", until_date=int(time.time()) + JOIN_RAID_MAX_MUTE_SECONDS,
+                reason="join raid", lift_tag=raid["tag"]
+            ))
+            raid["tasks"].add(task)
+            task.add_done_callback(raid["tasks"].discard)
+            await task
+            return
+
+        features = state["features"]
+        if features.get("welcome_message"):
+            names = list(dict.fromkeys(name for _, name in members))
+            shown = ", ".join(names[:20]) + (f" and {len(names) - 20} more" if len(names) > 20 else "")
+            self._send(chat_id, f"👋 Welcome, {shown}! Please read the /rules.")
+        if features.get("mute_new_members"):
+            await run_moderation_batch(
+                bot, chat_id, user_ids, "mute", until_date=int(time.time()) + NEW_MEMBER_MUTE_SECONDS,
+                reason="new member"
+            )
+
+    def _check_quiet(self, bot, chat_id: int):
+        state = self._chats.get(chat_id)
+        if state is None or state["raid"] is None:
+            return
+        idle = time.monotonic() - state["last_join"]
+        if idle < self.quiet_seconds:
+            asyncio.get_running_loop().call_later(self.quiet_seconds - idle, self._check_quiet, bot, chat_id)
+        else:
+            self._spawn(self.end_raid(bot, chat_id))
+
+    async def end_raid(self, bot, chat_id: int):
+        """Flush the last batch, wait for in-flight mutes, then schedule the lift."""
+        state = self._chats.get(chat_id)
+        if state is None or state["raid"] is None:
+            return
+        await self.flush(bot, chat_id)
+        raid, state["raid"] = state["raid"], None
+        if raid["tasks"]:
+            await asyncio.gather(*raid["tasks"], return_exceptions=True)
+
+        user_ids = list(dict.fromkeys(raid["user_ids"]))
+        if user_ids:
+            await scheduler.schedule(
+                "lift_raid", time.time(), {"chat_id": chat_id, "user_ids": user_ids, "tag": raid["tag"]}
+            )
+        minutes = max(1, round((time.time() - raid["started"]) / 60))
+        summary = f"✅ Join raid over: {len(user_ids)} members joined in about {minutes} min. Restrictions are being lifted."
+        if state["features"].get("welcome_message"):
+            summary += f"\n👋 Welcome to all {len(user_ids)} of you! Please read the /rules."
+        self._send(chat_id, summary)
+
+    async def stop(self, bot):
+        """End raids in progress so their lift jobs are persisted before exit."""
+        for chat_id in [chat_id for chat_id, state in self._chats.items() if state["raid"] is not None]:
+            await self.end_raid(bot, chat_id)
+        for task in list(self._tasks):
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    def in_raid(self, chat_id: int) -> bool:
+        state = self._chats.get(chat_id)
+        return state is not None and state["raid"] is not None
+
+    def sweep(self, now: float = None):
+        now = now or time.monotonic()
+        self._chats = {
+            chat_id: state for chat_id, state in self._chats.items()
+            if state["raid"] is not None or state["pending"] or now - state["last_join"] <= self.window
+        }
+        self._next_sweep = now + self.quiet_seconds
+
+    def _spawn(self, coro):
+        task = asyncio.ensure_future(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def _spawn_flush(self, bot, chat_id: int):
+        self._spawn(self.flush(bot, chat_id))
+
+    @staticmethod
+    def _send(chat_id: int, text: str):
+        outbound.post(chat_id, text, PRIORITY_MODERATION)
+
+join_guard = JoinGuard(JOIN_RAID_LIMIT, JOIN_RAID_WINDOW, JOIN_RAID_QUIET_SECONDS, JOIN_BATCH_SECONDS)
+
+async def on_new_members(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    chat = update.effective_chat
+    if chat.type == "private":
+        return
+    members = [(user.id, user.first_name) for user in update.message.new_chat_members if not user.is_bot]
+    if not members:
+        return
+
+    settings = await settings_cache.get(chat.id)
+    anti_spam = settings["anti_spam"]
+    join_guard.add(
+        context.bot, chat.id, members, settings["features"],
+        raid_protection=bool(anti_spam and anti_spam["is_active"])
+    )
+
+# --- Analytics ---
+ACTIVITY_EVENTS = ("spam", "joins", "leaves")
+
+class ActivityStats:
+    """Streaming group activity counters.
+
+    Each message bumps one dict entry keyed (chat, user, hour); nothing else
+    happens on the message path. Every ``flush_interval`` the counters are
+    rolled up into hourly per-chat and daily per-user rows with additive
+    upserts, and join/leave deltas adjust tracked_groups.member_count.
+    """
+
+    def __init__(self, flush_interval: float = 60.0):
+        self.flush_interval = flush_interval
+        self._messages = {}  # (chat_id, user_id, hour) -> count
+        self._events = {}  # (chat_id, hour) -> [spam, joins, leaves]
+        self._lock = asyncio.Lock()
+        self._task = None
+        self.flushed = 0
+
+    def message(self, chat_id: int, user_id: int):
+        key = (chat_id, user_id, int(time.time()) // 3600)
+        self._messages[key] = self._messages.get(key, 0) + 1
+        if self._task is None:
+            self.start()
+
+    def event(self, chat_id: int, kind: str, count: int = 1):
+        key = (chat_id, int(time.time()) // 3600)
+        counters = self._events.get(key)
+        if counters is None:
+            counters = self._events[key] = [0] * len(ACTIVITY_EVENTS)
+        counters[ACTIVITY_EVENTS.index(kind)] += count
+        if self._task is None:
+            self.start()
+
+    async def flush(self) -> int:
+        async with self._lock:
+            if not self._messages and not self._events:
+                return 0
+            messages, self._messages = self._messages, {}
+            events, self._events = self._events, {}
+
+            hourly = {key: [0, *counters] for key, counters in events.items()}
+            daily = {}
+            for (chat_id, user_id, hour), count in messages.items():
+                hourly.setdefault((chat_id, hour), [0] * (len(ACTIVITY_EVENTS) + 1))[0] += count
+                day_key = (chat_id, hour // 24, user_id)
+                daily[day_key] = daily.get(day_key, 0) + count
+            members = {}
+            for (chat_id, _), (_, _, joins, leaves) in hourly.items():
+                members[chat_id] = members.get(chat_id, 0) + joins - leaves
+
+            def _write(conn):
+                conn.executemany(
+                    """INSERT INTO activity_hourly (chat_id, hour, messages, spam, joins, leaves)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                    ON CONFLICT(chat_id, hour) DO UPDATE SET
+                        messages = messages + excluded.messages,
+                        spam = spam + excluded.spam,
+                        joins = joins + excluded.joins,
+                        leaves = leaves + excluded.leaves""",
+                    [(chat_id, hour, *counters) for (chat_id, hour), counters in hourly.items()]
+                )
+                conn.executemany(
+                    """INSERT INTO user_activity_daily (chat_id, day, user_id, messages) VALUES (?, ?, ?, ?)
+                    ON CONFLICT(chat_id, day, user_id) DO UPDATE SET
+                        messages = messages + excluded.messages""",
+                    [(*key, count) for key, count in daily.items()]
+                )
+                conn.executemany(
+                    "UPDATE tracked_groups SET member_count = MAX(member_count + ?, 0) WHERE group_id = ?",
+                    [(delta, chat_id) for chat_id, delta in members.items() if delta]
+                )
+
+            try:
+                await db.run(_write, label="flush_activity")
+            except sqlite3.Error as e:
+                print(f"Activity flush error: {e}")
+                for key, count in messages.items():
+                    self._messages[key] = self._messages.get(key, 0) + count
+                for key, counters in events.items():
+                    merged = self._events.setdefault(key, [0] * len(ACTIVITY_EVENTS))
+                    merged[:] = [a + b for a, b in zip(merged, counters)]
+                return 0
+            self.flushed += len(hourly) + len(daily)
+            return len(hourly) + len(daily)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self.flush()
+
+activity = ActivityStats(ANALYTICS_FLUSH_INTERVAL)
+
+async def count_activity(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    message = update.message
+    if message is None or not message.from_user:
+        return
+    if message.new_chat_members:
+        # Bots are left out, as in the join pipeline
+        humans = sum(not user.is_bot for user in message.new_chat_members)
+        if humans:
+            activity.event(message.chat_id, "joins", humans)
+    elif message.left_chat_member:
+        if not message.left_chat_member.is_bot:
+            activity.event(message.chat_id, "leaves")
+    elif not message.from_user.is_bot:
+        activity.message(message.chat_id, message.from_user.id)
+
+async def group_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not await is_group_admin(update, context):
+        await update.message.reply_text("🚫 Admin only!")
+        return
+
+    days = STATS_DEFAULT_DAYS
+    if context.args:
+        if not context.args[0].isdigit() or not 1 <= int(context.args[0]) <= ANALYTICS_RETENTION_DAYS:
+            await update.message.reply_text(f"ℹ️ Usage: /stats [days, 1-{ANALYTICS_RETENTION_DAYS}]")
+            return
+        days = int(context.args[0])
+
+    chat_id = update.effective_chat.id
+    try:
+        member_count = await context.bot.get_chat_member_count(chat_id)
+        await db.execute("UPDATE tracked_groups SET member_count = ? WHERE group_id = ?", (member_count, chat_id))
+    except TelegramError:
+        member_count = None
+
+    await activity.flush()
+    since_hour = int(time.time()) // 3600 - days * 24 + 1
+
+    def _read(conn):
+        totals = conn.execute(
+            """SELECT COALESCE(SUM(messages), 0), COALESCE(SUM(spam), 0),
+                COALESCE(SUM(joins), 0), COALESCE(SUM(leaves), 0)
+            FROM activity_hourly WHERE chat_id = ? AND hour >= ?""",
+            (chat_id, since_hour)
+        ).fetchone()
+        hours = conn.execute(
+            """SELECT hour % 24, SUM(messages) FROM activity_hourly
+            WHERE chat_id = ? AND hour >= ? GROUP BY hour % 24 ORDER BY 2 DESC LIMIT 3""",
+            (chat_id, since_hour)
+        ).fetchall()
+        posters = conn.execute(
+            """SELECT user_id, SUM(messages) FROM user_activity_daily
+            WHERE chat_id = ? AND day >= ? GROUP BY user_id ORDER BY 2 DESC LIMIT 5""",
+            (chat_id, since_hour // 24)
+        ).fetchall()
+        return totals, hours, posters
+
+    (messages, spam, joins, leaves), hours, posters = await db.run(_read, label="group_stats")
+    if member_count is None:
+        row = await db.fetchone("SELECT member_count FROM tracked_groups WHERE group_id = ?", (chat_id,))
+        member_count = row[0] if row else "?"
+
+    lines = [
+        f"📊 *Group stats* — last {days} day{'s' if days != 1 else ''}",
+        f"Members: {member_count} (+{joins} / -{leaves})",
+        f"Messages: {messages}",
+        f"Spam: {spam} ({spam / messages:.1%} of messages)" if messages else f"Spam: {spam}",
+    ]
+    if posters:
+        lines.append("\n*Top posters*:")
+        for i, (user_id, count) in enumerate(posters, 1):
+            known = await user_directory.get(chat_id, user_id)
+            name = (known[2] or known[1]) if known else None
+            lines.append(f"{i}. {escape_markdown(name or str(user_id))}: {count}")
+    if hours:
+        lines.append("\n*Busiest hours (UTC)*:")
+        lines.extend(f"{hour:02d}:00–{hour:02d}:59: {count} messages" for hour, count in hours)
+    await update.message.reply_text("\n".join(lines), parse_mode="Markdown")
+
+# --- Scheduler ---
+def job_shard(payload: str) -> int:
+    """Shard that runs a job: its chat's shard, or shard 0 for global jobs.
+
+    Derived from the payload rather than stored, so changing SHARD_COUNT
+    hands existing jobs to their chats' new owners instead of orphaning them.
+    """
+    chat_id = json.loads(payload or "{}").get("chat_id")
+    return 0 if chat_id is None else shard_for(chat_id)
+
+class Scheduler:
+    """Persistent timers: a min-heap in memory mirrored by the scheduled_jobs table.
+
+    One task sleeps until the earliest deadline, so pending timers cost a heap
+    entry each rather than an asyncio task.
+    """
+
+    def __init__(self, concurrency: int = 8):
+        self._heap = []  # (run_at, job_id, kind, payload)
+        self._handlers = {}
+        self._cancelled = set()
+        self._done = []
+        self._flushing = False
+        self._wake = None
+        self._task = None
+        self._running = set()
+        self._semaphore = None
+        self.concurrency = concurrency
+        self.bot = None
+
+    def register(self, kind: str, handler):
+        """``handler(bot, payload)`` is awaited when a job of ``kind`` comes due."""
+        self._handlers[kind] = handler
+
+    async def schedule(self, kind: str, run_at: float, payload: dict = None) -> int:
+        return (await self.schedule_many(kind, [(run_at, payload)]))[0]
+
+    async def schedule_many(self, kind: str, jobs) -> list:
+        """Persist several (run_at, payload) timers in one transaction."""
+        jobs = [(run_at, json.dumps(payload or {})) for run_at, payload in jobs]
+
+        def _insert(conn):
+            now = datetime.now().isoformat()
+            return [
+                conn.execute(
+                    "INSERT INTO scheduled_jobs (run_at, kind, payload, created_at, shard) VALUES (?, ?, ?, ?, ?)",
+                    (run_at, kind, payload, now, job_shard(payload))
+                ).lastrowid
+                for run_at, payload in jobs
+            ]
+
+        job_ids = await db.run(_insert, label="schedule_jobs")
+        for job_id, (run_at, payload) in zip(job_ids, jobs):
+            self._push(run_at, job_id, kind, payload)
+        return job_ids
+
+    async def cancel(self, job_id: int):
+        self._cancelled.add(job_id)
+        await db.execute("DELETE FROM scheduled_jobs WHERE job_id = ?", (job_id,))
+
+    def pending(self) -> int:
+        return len(self._heap) - len(self._cancelled)
+
+    def _push(self, run_at: float, job_id: int, kind: str, payload: str):
+        earliest = self._heap[0][0] if self._heap else None
+        heapq.heappush(self._heap, (run_at, job_id, kind, payload))
+        if self._wake and (earliest is None or run_at < earliest):
+            self._wake.set()
+
+    async def start(self, bot):
+        self.bot = bot
+        self._wake = asyncio.Event()
+        self._semaphore = asyncio.Semaphore(self.concurrency)
+        rows = await db.fetchall("SELECT run_at, job_id, kind, payload FROM scheduled_jobs")
+        self._heap = [tuple(row) for row in rows if job_shard(row[3]) == SHARD_ID]
+        heapq.heapify(self._heap)
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, *self._running, return_exceptions=True)
+            self._task = None
+
+    async def _run(self):
+        while True:
+            now = time.time()
+            while self._heap and self._heap[0][0] <= now:
+                job = heapq.heappop(self._heap)
+                if job[1] in self._cancelled:
+                    self._cancelled.discard(job[1])
+                    continue
+                task = asyncio.create_task(self._execute(*job))
+                self._running.add(task)
+                task.add_done_callback(self._running.discard)
+
+            self._wake.clear()
+            timeout = self._heap[0][0] - now if self._heap else None
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _execute(self, run_at, job_id, kind, payload):
+        handler = self._handlers.get(kind)
+        try:
+            async with self._semaphore:
+                if handler is None:
+                    print(f"No scheduler handler for {kind}")
+                else:
+                    await handler(self.bot, json.loads(payload or "{}"))
+        except RetryAfter as e:
+            # Keep the row; just try again once Telegram allows it
+            self._push(time.time() + e.retry_after, job_id, kind, payload)
+            return
+        except Exception as e:
+            print(f"Scheduled {kind} job {job_id} failed: {e}")
+        await self._mark_done(job_id)
+
+    async def _mark_done(self, job_id: int):
+        """Delete finished jobs, batching deletes that pile up during a flush."""
+        self._done.append(job_id)
+        if self._flushing:
+            return
+        self._flushing = True
+        try:
+            while self._done:
+                job_ids, self._done = self._done, []
+                await db.executemany(
+                    "DELETE FROM scheduled_jobs WHERE job_id = ?", [(job_id,) for job_id in job_ids]
+                )
+        finally:
+            self._flushing = False
+
+scheduler = Scheduler(SCHEDULER_CONCURRENCY)
+
+async def _lift_mutes(bot, payload: dict, user_ids, reason: str):
+    # Jobs scheduled before lift tags existed carry none and lift unconditionally
+    if payload.get("tag") is not None:
+        user_ids = await claim_timed_mutes(payload["chat_id"], user_ids, payload["tag"])
+    await run_moderation_batch(bot, payload["chat_id"], user_ids, "unmute", reason=reason)
+
+async def _job_unmute(bot, payload: dict):
+    await _lift_mutes(bot, payload, payload.get("user_ids") or [payload["user_id"]], "mute expired")
+
+async def _job_lift_raid(bot, payload: dict):
+    await _lift_mutes(bot, payload, payload["user_ids"], "raid over")
+
+async def _job_close_game(bot, payload: dict):
+    scored = await db.fetchone("SELECT scored FROM games WHERE poll_id = ?", (payload["poll_id"],))
+    if not scored or scored[0]:
+        return  # already finished with /wcg_results, or pruned
+    result_msg = await finish_game(bot, payload["poll_id"])
+    if result_msg:
+        await outbound.send(payload["chat_id"], result_msg, PRIORITY_CHATTER, parse_mode="Markdown")
+
+def _prune(conn, cutoff: int, users_cutoff: int = None, analytics_cutoff: int = None):
+    """Delete games (and their votes/participants), long-expired warnings and
+    finished bulk jobs older than ``cutoff``, directory users not seen since
+    ``users_cutoff`` and activity rollups older than ``analytics_cutoff``."""
+    old_games = "SELECT poll_id FROM games WHERE created_at < ?"
+    conn.execute(f"DELETE FROM votes WHERE poll_id IN ({old_games})", (cutoff,))
+    conn.execute(f"DELETE FROM game_participants WHERE poll_id IN ({old_games})", (cutoff,))
+    games = conn.execute("DELETE FROM games WHERE created_at < ?", (cutoff,)).rowcount
+    conn.execute("DELETE FROM warnings WHERE expires_at < ?", (cutoff,))
+    if users_cutoff is not None:
+        conn.execute("DELETE FROM chat_users WHERE last_seen < ?", (users_cutoff,))
+    if analytics_cutoff is not None:
+        conn.execute("DELETE FROM activity_hourly WHERE hour < ?", (analytics_cutoff // 3600,))
+        conn.execute("DELETE FROM user_activity_daily WHERE day < ?", (analytics_cutoff // 86400,))
+    # bulk_jobs still stores ISO strings
+    job_cutoff = datetime.fromtimestamp(cutoff).isoformat()
+    old_jobs = "SELECT job_id FROM bulk_jobs WHERE status IN ('done', 'cancelled') AND created_at < ?"
+    conn.execute(f"DELETE FROM bulk_job_targets WHERE job_id IN ({old_jobs})", (job_cutoff,))
+    conn.execute("DELETE FROM bulk_jobs WHERE status IN ('done', 'cancelled') AND created_at < ?", (job_cutoff,))
+    return games
+
+async def _job_housekeeping(bot, payload: dict):
+    now = int(time.time())
+    cutoff = now - GAME_RETENTION_DAYS * 86400
+    users_cutoff = now - USER_DIRECTORY_RETENTION_DAYS * 86400
+    analytics_cutoff = now - ANALYTICS_RETENTION_DAYS * 86400
+    pruned = await db.run(
+        lambda conn: _prune(conn, cutoff, users_cutoff, analytics_cutoff), label="housekeeping"
+    )
+    print(f"Housekeeping: pruned {pruned} old games")
+    await scheduler.schedule("housekeeping", time.time() + HOUSEKEEPING_INTERVAL)
+
+scheduler.register("unmute", _job_unmute)
+scheduler.register("lift_raid", _job_lift_raid)
+scheduler.register("close_game", _job_close_game)
+scheduler.register("housekeeping", _job_housekeeping)
+
+# --- Metrics ---
+class Metrics:
+    """Latency histograms and counters for handlers and Bot API calls."""
+
+    BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self):
+        self.families = {"handler": {}, "api": {}}
+
+    def observe(self, family: str, name: str, seconds: float, error: bool = False, rate_limited: bool = False):
+        series = self.families[family].get(name)
+        if series is None:
+            series = self.families[family][name] = {
+                "count": 0, "errors": 0, "rate_limited": 0, "sum": 0.0, "max": 0.0,
+                "buckets": [0] * len(self.BUCKETS),
+            }
+        series["count"] += 1
+        series["sum"] += seconds
+        series["max"] = max(series["max"], seconds)
+        series["errors"] += error
+        series["rate_limited"] += rate_limited
+        for i, bound in enumerate(self.BUCKETS):
+            if seconds <= bound:
+                series["buckets"][i] += 1
+                break
+
+    def quantile(self, series: dict, q: float) -> float:
+        """Upper bucket bound containing the q-th quantile."""
+        target = q * series["count"]
+        seen = 0
+        for bound, count in zip(self.BUCKETS, series["buckets"]):
+            seen += count
+            if seen >= target:
+                return bound
+        return series["max"]
+
+    def slowest(self, family: str = "handler", n: int = 5) -> list:
+        ranked = sorted(
+            self.families[family].items(),
+            key=lambda item: item[1]["sum"] / item[1]["count"],
+            reverse=True,
+        )
+        return ranked[:n]
+
+    def render(self) -> str:
+        """Prometheus text exposition of every metric the bot keeps."""
+        lines = []
+
+        def _label(value) -> str:
+            return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", " ")
+
+        for family, label in (("handler", "handler"), ("api", "method")):
+            metric = f"bot_{family}_seconds"
+            lines.append(f"# TYPE {metric} histogram")
+            for name, series in sorted(self.families[family].items()):
+                tag = f'{label}="{_label(name)}"'
+                cumulative = 0
+                for bound, count in zip(self.BUCKETS, series["buckets"]):
+                    cumulative += count
+                    lines.append(f'{metric}_bucket{{{tag},le="{bound}"}} {cumulative}')
+                lines.append(f'{metric}_bucket{{{tag},le="+Inf"}} {series["count"]}')
+                lines.append(f"{metric}_sum{{{tag}}} {series['sum']:.6f}")
+                lines.append(f"{metric}_count{{{tag}}} {series['count']}")
+            lines.append(f"# TYPE bot_{family}_errors_total counter")
+            for name, series in sorted(self.families[family].items()):
+                lines.append(f'bot_{family}_errors_total{{{label}="{_label(name)}"}} {series["errors"]}')
+        # 429 answers; the callers that back off and retry decide whether one is retried
+        lines.append("# TYPE bot_api_rate_limited_total counter")
+        for name, series in sorted(self.families["api"].items()):
+            lines.append(f'bot_api_rate_limited_total{{method="{_label(name)}"}} {series["rate_limited"]}')
+
+        lines.append("# TYPE bot_db_query_seconds summary")
+        for name, stats in sorted(db.query_stats().items()):
+            tag = f'query="{_label(name)}"'
+            lines.append(f"bot_db_query_seconds_sum{{{tag}}} {stats['total_ms'] / 1000:.6f}")
+            lines.append(f"bot_db_query_seconds_count{{{tag}}} {stats['count']}")
+            lines.append(f"bot_db_query_seconds_max{{{tag}}} {stats['max_ms'] / 1000:.6f}")
+
+        gauges = {
+            "bot_admin_cache_hits_total": admin_cache.hits,
+            "bot_admin_cache_misses_total": admin_cache.misses,
+            "bot_outbound_queue_depth": outbound.stats()["depth"],
+            "bot_outbound_sent_total": outbound.sent,
+            "bot_outbound_failed_total": outbound.failed,
+            "bot_outbound_coalesced_total": outbound.coalesced,
+            "bot_outbound_wait_seconds_max": outbound.wait_max,
+            "bot_votes_flushed_total": vote_buffer.flushed,
+            "bot_warnings_flushed_total": warning_ledger.flushed,
+            "bot_user_directory_size": len(user_directory._entries),
+            "bot_audit_entries_flushed_total": audit_log.flushed,
+            "bot_activity_rows_flushed_total": activity.flushed,
+            "bot_scheduled_jobs_pending": scheduler.pending(),
+            "bot_join_raids_total": join_guard.raids,
+        }
+        for name, value in gauges.items():
+            lines.append(f"{name} {value}")
+
+        lines.append("# TYPE bot_startup_seconds gauge")
+        for phase, seconds in startup.phases.items():
+            lines.append(f'bot_startup_seconds{{phase="{phase}"}} {seconds:.3f}')
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
 
-async def handle_vote(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    poll_answer = update.poll_answer
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
+def _process_uptime() -> float:
+    """Seconds since this process was started (from /proc; elsewhere, since this module loaded)."""
+    try:
+        with open("/proc/self/stat") as f:
+            start_ticks = int(f.read().rsplit(")", 1)[1].split()[19])
+        with open("/proc/uptime") as f:
+            uptime = float(f.read().split()[0])
+        return uptime - start_ticks / os.sysconf("SC_CLK_TCK")
+    except (OSError, ValueError, IndexError):
+        return time.monotonic() - _LOADED_AT
 
-    cursor.execute("SELECT * FROM games WHERE poll_id = ?", (poll_answer.poll_id,))
-    game = cursor.fetchone()
+_LOADED_AT = time.monotonic()
 
-    if game:
-        cursor.execute(
-            """INSERT OR IGNORE INTO players 
-            (user_id, username, last_played) 
-            VALUES (?, ?, ?)""",
-            (
-                poll_answer.user.id,
-                poll_answer.user.username or str(poll_answer.user.id),
-                datetime.now().isoformat()
-            )
-        )
-        cursor.execute(
-            """UPDATE players 
-            SET games_played = games_played + 1 
-            WHERE user_id = ?""",
-            (poll_answer.user.id,)
-        )
-        conn.commit()
-    conn.close()
+class StartupTimer:
+    """Milestones in seconds since process start: imported, schema_ready, ready, first_update."""
 
-async def show_results(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
+    def __init__(self):
+        self.phases = {}
 
-    cursor.execute(
-        """SELECT * FROM games 
-        WHERE chat_id = ? 
-        ORDER BY created_at DESC LIMIT 1""",
-        (update.effective_chat.id,)
-    )
-    game = cursor.fetchone()
+    def mark(self, phase: str) -> float:
+        if phase not in self.phases:
+            self.phases[phase] = _process_uptime()
+        return self.phases[phase]
 
-    if not game:
-        await update.message.reply_text("No recent game found!")
-        conn.close()
-        return
+    def report(self) -> str:
+        return ", ".join(f"{phase} {seconds:.2f}s" for phase, seconds in self.phases.items())
 
-    poll_id, chat_id, question, correct_option, participants, created_at = game
-    participants = json.loads(participants)
+startup = StartupTimer()
 
-    try:
-        poll = await context.bot.stop_poll(chat_id, poll_id)
-    except Exception:
-        await update.message.reply_text("Couldn't retrieve poll results")
-        conn.close()
-        return
+async def mark_first_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if "first_update" not in startup.phases:
+        startup.mark("first_update")
+        print(f"Startup: {startup.report()} after process start")
 
-    # Note: `poll.options` does not expose voter user IDs in the library.
-    # To find winners, you'd need to track votes yourself in `handle_vote`.
+def instrument_handler(name: str, callback):
+    """Wrap a handler callback so every call is timed and errors counted."""
+    async def _timed(update, context):
+        start = time.perf_counter()
+        error = False
+        try:
+            return await callback(update, context)
+        except ApplicationHandlerStop:
+            raise
+        except Exception:
+            error = True
+            raise
+        finally:
+            metrics.observe("handler", name, time.perf_counter() - start, error=error)
+    _timed.__name__ = getattr(callback, "__name__", name)
+    return _timed
 
-    # Here, just announce correct answer and no names (privacy limitation).
-    result_msg = (
-        f"🏆 *WCG Results* 🏆\n\n"
-        f"Question: {question}\n"
-        f"Correct answer: {poll.options[correct_option].text}\n\n"
-        "Winners tracking unavailable due to Telegram API limitations."
-    )
+class InstrumentedRequest(BaseRequest):
+    """Bot API transport wrapper recording latency, errors and 429s per method."""
 
-    await update.message.reply_text(result_msg, parse_mode="Markdown")
-    conn.close()
+    def __init__(self, inner: BaseRequest):
+        self.inner = inner
 
-async def logo_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    description = ' '.join(context.args) if context.args else "default"
-    
-    size = 256
-    # Choose color based on length of description (just an example customization)
-    color = "#0088cc" if len(description) % 2 == 0 else "#00aaff"
-    
-    img = Image.new("RGBA", (size, size), (255, 255, 255, 0))
-    draw = ImageDraw.Draw(img)
-    
-    # Draw colored circle background
-    draw.ellipse([(0,0), (size, size)], fill=color)
-    
-    # Draw white paper plane shape (Telegram-like)
-    plane_points = [
-        (size // 2, size // 4),
-        (size // 4, size * 3 // 4),
-        (size // 2, size // 2),
-        (size * 3 // 4, size * 3 // 4)
-    ]
-    draw.polygon(plane_points, fill="white")
-    
-    # Add text overlay: first 10 chars of description
-    font = ImageFont.load_default()
-    text = description[:10]
-    bbox = draw.textbbox((0, 0), text, font=font)
-    text_width = bbox - bbox
-    text_height = bbox - bbox
-    text_position = ((size - text_width) // 2, size * 3 // 4)
-    draw.text(text_position, text, fill="white", font=font)
-    
-    # Save to in-memory bytes buffer
-    buf = io.BytesIO()
-    img.save(buf, format='PNG')
-    buf.seek(0)
-    
-    # Send photo with caption
-    await update.message.reply_photo(photo=buf, caption=f"Logo for: {description}")
-    
-async def leaderboard(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
+    async def initialize(self):
+        await self.inner.initialize()
 
-    cursor.execute(
-        """SELECT username, wins, games_played 
-        FROM players 
-        ORDER BY wins DESC 
-        LIMIT 10"""
-    )
-    top_players = cursor.fetchall()
+    async def shutdown(self):
+        await self.inner.shutdown()
 
-    if not top_players:
-        await update.message.reply_text("No players yet!")
-        conn.close()
-        return
+    async def do_request(self, url, method, request_data=None, read_timeout=BaseRequest.DEFAULT_NONE,
+                         write_timeout=BaseRequest.DEFAULT_NONE, connect_timeout=BaseRequest.DEFAULT_NONE,
+                         pool_timeout=BaseRequest.DEFAULT_NONE):
+        endpoint = url.rsplit("/", 1)[-1]
+        start = time.perf_counter()
+        code = None
+        try:
+            code, payload = await self.inner.do_request(
+                url, method, request_data, read_timeout=read_timeout, write_timeout=write_timeout,
+                connect_timeout=connect_timeout, pool_timeout=pool_timeout
+            )
+            return code, payload
+        finally:
+            metrics.observe(
+                "api", endpoint, time.perf_counter() - start,
+                error=code is None or code >= 400, rate_limited=code == 429
+            )
 
-    leaderboard_msg = "🏆 *WCG Leaderboard* 🏆\n\n"
-    for i, (username, wins, games) in enumerate(top_players, 1):
-        win_rate = (wins/games)*100 if games > 0 else 0
-        leaderboard_msg += (
-            f"{i}. {username}: {wins} wins ({win_rate:.1f}% win rate)\n"
-        )
+def instrument_application(app):
+    for handlers in app.handlers.values():
+        for handler in handlers:
+            if callable(handler.callback):
+                handler.callback = instrument_handler(handler.callback.__name__, handler.callback)
 
-    await update.message.reply_text(leaderboard_msg, parse_mode="Markdown")
-    conn.close()
+async def _handle_metrics_request(reader, writer):
+    try:
+        head = await reader.readuntil(b"\r\n\r\n")
+        path = head.split(b" ", 2)[1].decode("latin-1") if head.count(b" ") >= 2 else ""
+        if path.split("?", 1)[0] == "/metrics":
+            body, status = metrics.render().encode(), "200 OK"
+        else:
+            body, status = b"not found\n", "404 Not Found"
+        writer.write(
+            f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4\r\n"
+            f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body
+        )
+        await writer.drain()
+    except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+        pass
+    finally:
+        writer.close()
 
+_metrics_server = None
 
-# --- Rules Management ---
-async def set_rules(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def slowest_handlers(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not await is_group_admin(update, context):
-        await update.message.reply_text("🚫 *Admin only!*", parse_mode="Markdown")
+        await update.message.reply_text("🚫 Admin only!")
         return
 
-    rules_text = " ".join(context.args)
-    if not rules_text:
-        await update.message.reply_text("ℹ️ Usage: /setrules <text>")
+    n = int(context.args[0]) if context.args and context.args[0].isdigit() else 5
+    ranked = metrics.slowest("handler", max(1, min(n, 25)))
+    if not ranked:
+        await update.message.reply_text("No handler timings recorded yet.")
         return
 
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute(
-        "INSERT OR REPLACE INTO group_rules VALUES (?, ?)",
-        (update.effective_chat.id, rules_text)
-    )
-    conn.commit()
-    conn.close()
-    await update.message.reply_text("✅ *Rules updated!*", parse_mode="Markdown")
+    lines = ["🐢 *Slowest handlers* (mean / p99 / max ms)\n"]
+    for name, series in ranked:
+        lines.append(
+            f"`{name}`: {series['sum'] / series['count'] * 1000:.1f} / "
+            f"≤{metrics.quantile(series, 0.99) * 1000:.0f} / {series['max'] * 1000:.1f} "
+            f"({series['count']} calls, {series['errors']} errors)"
+        )
+    await update.message.reply_text("\n".join(lines), parse_mode="Markdown")
 
-async def show_rules(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute(
-        "SELECT rules_text FROM group_rules WHERE chat_id=?",
-        (update.effective_chat.id,)
-    )
-    rules = cursor.fetchone()
-    conn.close()
-    await update.message.reply_text(
-        rules[0] if rules else "📜 No rules set yet. Admins: use /setrules",
-        parse_mode="Markdown"
-    )
+async def on_startup(app):
+    global _metrics_server
+    if METRICS_PORT:
+        _metrics_server = await asyncio.start_server(_handle_metrics_request, METRICS_LISTEN, METRICS_PORT)
+    init_db()
+    outbound.start(app.bot)
+    await scheduler.start(app.bot)
+    if SHARD_ID == 0 and not await db.fetchone("SELECT 1 FROM scheduled_jobs WHERE kind = 'housekeeping'"):
+        await scheduler.schedule("housekeeping", time.time() + 60)
+    await resume_bulk_jobs(app)
+    startup.mark("ready")
 
-# --- FAQ System ---
-async def add_faq(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not await is_group_admin(update, context):
-        await update.message.reply_text("🚫 *Admin only!*", parse_mode="Markdown")
-        return
+async def on_shutdown(app):
+    if _metrics_server is not None:
+        _metrics_server.close()
+    await join_guard.stop(app.bot)
+    await scheduler.stop()
+    await outbound.stop()
+    await vote_buffer.stop()
+    await warning_ledger.stop()
+    await user_directory.stop()
+    await audit_log.stop()
+    await activity.stop()
+    if _logo_executor is not None:
+        _logo_executor.shutdown(wait=False)
+    db.close()
 
-    args = update.message.text.split(" | ", 1)
-    if len(args) != 2:
-        await update.message.reply_text("ℹ️ Usage: /addfaq <question> | <answer>")
-        return
+# --- Webhook Mode ---
+def update_order_key(update: Update):
+    """Updates sharing a key are processed in order; chats run in parallel."""
+    if update.effective_chat:
+        return update.effective_chat.id
+    if update.effective_user:
+        return update.effective_user.id
+    return ("update", update.update_id)
 
-    question, answer = args[0].strip(), args[1].strip()
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute(
-        "INSERT OR REPLACE INTO faqs VALUES (?, ?, ?)",
-        (update.effective_chat.id, question, answer)
-    )
-    conn.commit()
-    conn.close()
-    await update.message.reply_text(f"✅ FAQ added: *{question}*", parse_mode="Markdown")
+class ChatOrderedDispatcher:
+    """Feeds updates to ``app.process_update`` concurrently across chats while
+    keeping them strictly ordered within each chat."""
 
-async def get_faq(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    question = " ".join(context.args)
-    if not question:
-        await update.message.reply_text("ℹ️ Usage: /faq <question>")
-        return
+    def __init__(self, app, concurrency: int = 32):
+        self.app = app
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._chats = {}  # order key -> deque of pending updates
+        self._tasks = set()
 
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute(
-        "SELECT answer FROM faqs WHERE chat_id=? AND question=?",
-        (update.effective_chat.id, question)
-    )
-    answer = cursor.fetchone()
-    conn.close()
-    await update.message.reply_text(
-        answer[0] if answer else "❌ FAQ not found. Admins: use /addfaq",
-        parse_mode="Markdown"
-    )
+    def submit(self, update: Update):
+        key = update_order_key(update)
+        pending = self._chats.get(key)
+        if pending is not None:
+            pending.append(update)
+            return
+        self._chats[key] = deque([update])
+        task = asyncio.create_task(self._drain(key))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
 
-# --- Moderation ---
-async def ban_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not await is_group_admin(update, context):
-        await update.message.reply_text("🚫 Admin only!")
-        return
+    async def _drain(self, key):
+        pending = self._chats[key]
+        while pending:
+            async with self._semaphore:
+                try:
+                    await self.app.process_update(pending[0])
+                except Exception as e:
+                    print(f"Update processing error: {e}")
+            pending.popleft()
+        del self._chats[key]
 
-    if not context.args:
-        await update.message.reply_text("ℹ️ Usage: `/ban <user_id>` or reply to a message with `/ban`", parse_mode="Markdown")
-        return
+    def pending(self) -> int:
+        return sum(len(updates) for updates in self._chats.values())
 
-    try:
-        user_id = int(context.args[0])
-        await context.bot.ban_chat_member(update.effective_chat.id, user_id)
-        await update.message.reply_text(f"🔨 Banned user: `{user_id}`", parse_mode="Markdown")
-    except ValueError:
-        await update.message.reply_text("❌ Invalid ID. Use `/userinfo @username` to get the ID.")
-        
-async def warn_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not await is_group_admin(update, context):
-        await update.message.reply_text("🚫 *Admin only!*", parse_mode="Markdown")
-        return
+    async def join(self):
+        while self._tasks:
+            await asyncio.gather(*list(self._tasks), return_exceptions=True)
 
+async def _handle_webhook_request(reader, writer, bot, dispatcher):
+    """Minimal HTTP/1.1 endpoint for Telegram's webhook POSTs."""
     try:
-        user_id = int(context.args[0])
-        await update.message.reply_text(f"⚠️ Warned user: {user_id}")
-    except (IndexError, ValueError):
-        await update.message.reply_text("ℹ️ Usage: /warn <user_id>")
+        while True:
+            try:
+                head = await reader.readuntil(b"\r\n\r\n")
+            except (asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+                break
+            request_line, *header_lines = head.decode("latin-1").split("\r\n")
+            method, path, _ = (request_line.split(" ", 2) + ["", ""])[:3]
+            headers = {}
+            for line in header_lines:
+                if ":" in line:
+                    name, value = line.split(":", 1)
+                    headers[name.strip().lower()] = value.strip()
+            try:
+                length = int(headers.get("content-length", "0") or 0)
+            except ValueError:
+                length = -1
+            if not 0 <= length <= WEBHOOK_MAX_BODY:
+                # The body is never read, so the connection can't be reused
+                status = "413 Payload Too Large" if length > WEBHOOK_MAX_BODY else "400 Bad Request"
+                writer.write(f"HTTP/1.1 {status}\r\nContent-Length: 0\r\nConnection: close\r\n\r\n".encode())
+                await writer.drain()
+                break
+            body = await reader.readexactly(length)
 
-# --- Anti-Spam ---
-async def anti_spam(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if update.effective_chat.type == "private":
-        return
-    
-    # Get group settings
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute("""
-        SELECT is_active, ban_instead_of_delete 
-        FROM anti_spam_settings 
-        WHERE group_id = ?
-    """, (update.effective_chat.id,))
-    
-    settings = cursor.fetchone()
-    conn.close()
-    
-    # Skip if anti-spam is disabled
-    if not settings or not settings[0]:
-        return
-    
-    # Check for spam triggers
-    message_text = update.message.text.lower() if update.message.text else ""
-    is_spam = any(trigger in message_text for trigger in SPAM_TRIGGERS)
-    
-    if is_spam:
-        try:
-            await update.message.delete()
-            
-            if settings[1]:  # ban_instead_of_delete
-                await context.bot.ban_chat_member(
-                    chat_id=update.effective_chat.id,
-                    user_id=update.effective_user.id
-                )
-                action = "banned"
+            if path.split("?", 1)[0] != WEBHOOK_PATH:
+                status = "404 Not Found"
+            elif method != "POST":
+                status = "405 Method Not Allowed"
+            elif WEBHOOK_SECRET and not hmac.compare_digest(
+                headers.get("x-telegram-bot-api-secret-token", "").encode("latin-1"), WEBHOOK_SECRET.encode()
+            ):
+                status = "403 Forbidden"
+            elif dispatcher.pending() >= WEBHOOK_MAX_PENDING:
+                # Telegram redelivers failed updates, so shed load instead of queueing without bound
+                status = "503 Service Unavailable"
             else:
-                action = "message deleted"
-                
-            admin_notice = (
-                f"🚨 Anti-Spam Action:\n"
-                f"User: {update.effective_user.mention_markdown()}\n"
-                f"Action: {action}\n"
-                f"Content: {message_text[:100]}..."
-            )
-            
-            # Send notice to admins (optional)
-            await context.bot.send_message(
-                chat_id=update.effective_chat.id,
-                text=admin_notice,
-                parse_mode="Markdown"
-            )
-            
-        except Exception as e:
-            print(f"Anti-spam error: {e}")
+                try:
+                    dispatcher.submit(Update.de_json(json.loads(body), bot))
+                    status = "200 OK"
+                except (ValueError, TypeError, KeyError) as e:
+                    print(f"Bad webhook payload: {e}")
+                    status = "400 Bad Request"
 
-async def toggle_antispam(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not await is_group_admin(update, context):
-        await update.message.reply_text("🚫 Admin only!")
-        return
-    
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    
-    # Toggle the setting
-    cursor.execute("""
-        INSERT OR REPLACE INTO anti_spam_settings 
-        (group_id, is_active) 
-        VALUES (?, COALESCE((SELECT NOT is_active FROM anti_spam_settings WHERE group_id = ?), 1))
-    """, (update.effective_chat.id, update.effective_chat.id))
-    
-    conn.commit()
-    
-    # Get new status
-    cursor.execute("""
-        SELECT is_active FROM anti_spam_settings WHERE group_id = ?
-    """, (update.effective_chat.id,))
-    is_active = cursor.fetchone()[0]
-    conn.close()
-    
-    status = "✅ enabled" if is_active else "❌ disabled"
-    await update.message.reply_text(f"Anti-spam is now {status}")
+            keep_alive = headers.get("connection", "").lower() != "close"
+            writer.write(
+                f"HTTP/1.1 {status}\r\nContent-Length: 0\r\n"
+                f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode()
+            )
+            await writer.drain()
+            if not keep_alive:
+                break
+    except (ConnectionError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        writer.close()
 
-async def userinfo(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not await is_group_admin(update, context):
-        await update.message.reply_text("🚫 Admin only!")
-        return
+def warn_if_webhook_open():
+    if not WEBHOOK_SECRET:
+        print("WEBHOOK_SECRET is not set: anyone who finds the webhook URL can post updates to the bot")
 
-    # Check if user replied to a message or tagged someone
-    target_user = None
-    if update.message.reply_to_message:
-        target_user = update.message.reply_to_message.from_user
-    elif context.args:
+async def serve_webhook(app, stop_event: asyncio.Event = None):
+    """Run the bot behind a local HTTP server instead of long polling."""
+    stop_event = stop_event or asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
         try:
-            # Extract user ID from mention (e.g., @username)
-            mention = context.args[0].strip("@")
-            if mention.isdigit():  # Direct ID provided
-                target_user = await context.bot.get_chat_member(update.effective_chat.id, int(mention))
-                target_user = target_user.user
-            else:
-                # Search by username (Note: Works only if user has interacted in the group)
-                chat_members = await context.bot.get_chat_members(update.effective_chat.id)
-                for member in chat_members:
-                    if member.user.username and member.user.username.lower() == mention.lower():
-                        target_user = member.user
-                        break
-        except Exception as e:
-            print(f"Error fetching user: {e}")
-
-    if not target_user:
-        await update.message.reply_text("❌ User not found. Reply to their message or tag them (@username).")
-        return
+            loop.add_signal_handler(sig, stop_event.set)
+        except (NotImplementedError, RuntimeError):
+            pass
 
-    # Send user details
-    response = (
-        f"👤 *User Info*\n"
-        f"Name: `{target_user.full_name}`\n"
-        f"Username: `@{target_user.username}`\n"
-        f"ID: `{target_user.id}`\n\n"
-        f"⚠️ *Pro Tip*: Use `/ban {target_user.id}`"
+    warn_if_webhook_open()
+    dispatcher = ChatOrderedDispatcher(app, UPDATE_CONCURRENCY)
+    await app.initialize()
+    if app.post_init:
+        await app.post_init(app)
+    if WEBHOOK_URL:
+        await app.bot.set_webhook(
+            WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=Update.ALL_TYPES
+        )
+    await app.start()
+    server = await asyncio.start_server(
+        lambda r, w: _handle_webhook_request(r, w, app.bot, dispatcher), WEBHOOK_LISTEN, WEBHOOK_PORT
     )
-    await update.message.reply_text(response, parse_mode="Markdown")
+    try:
+        await stop_event.wait()
+    finally:
+        server.close()
+        await server.wait_closed()
+        await dispatcher.join()
+        await app.stop()
+        if app.post_stop:
+            await app.post_stop(app)
+        await app.shutdown()
+        if app.post_shutdown:
+            await app.post_shutdown(app)
 
-async def mute_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not await is_group_admin(update, context):
-        await update.message.reply_text("🚫 Admin only!")
-        return
+# --- Sharded Mode ---
+def shard_for(key, shard_count: int = None) -> int:
+    """Stable shard index for an update order key (usually a chat id)."""
+    return zlib.crc32(str(key).encode()) % (shard_count or SHARD_COUNT)
 
-    try:
-        # Parse arguments
-        user_id = int(context.args[0])
-        duration = None
-        
-        # Check for duration (e.g., "30m", "2h", "1d")
-        if len(context.args) > 1:
-            time_unit = context.args[1][-1].lower()
-            time_value = int(context.args[1][:-1])
-            
-            if time_unit == 'm':  # Minutes
-                duration = timedelta(minutes=time_value)
-            elif time_unit == 'h':  # Hours
-                duration = timedelta(hours=time_value)
-            elif time_unit == 'd':  # Days
-                duration = timedelta(days=time_value)
-        
-        # Apply mute
-        permissions = ChatPermissions(
-            can_send_messages=False,
-            can_send_media_messages=False,
-            can_send_other_messages=False,
-            can_add_web_page_previews=False
-        )
-        
-        until_date = datetime.now() + duration if duration else None
-        await context.bot.restrict_chat_member(
-            chat_id=update.effective_chat.id,
-            user_id=user_id,
-            permissions=permissions,
-            until_date=until_date
-        )
-        
-        # Confirmation message
-        if duration:
-            await update.message.reply_text(
-                f"⏳ Muted user `{user_id}` for {context.args[1]}",
-                parse_mode="Markdown"
-            )
+class ShardRouter:
+    """Front-side dispatcher: sends each update to the worker owning its chat.
+
+    A chat always maps to the same worker, and each worker keeps per-chat
+    order, so ordering within a chat is preserved end to end. Poll answers
+    carry no chat, so they are routed to the shard of the game's chat.
+    Queue puts never block the event loop: when a worker's queue is full,
+    its updates wait in an overflow deque that a task drains in order.
+    """
+
+    def __init__(self, queues, poll_cache_size: int = 10000):
+        self.queues = queues
+        self.routed = [0] * len(queues)
+        self._overflow = [deque() for _ in queues]
+        self._drainers = {}  # shard -> task feeding its overflow to the queue
+        self._poll_chats = OrderedDict()  # poll_id -> chat_id, LRU
+        self._poll_cache_size = poll_cache_size
+        self._unresolved = {}  # poll_id -> poll answers waiting for the lookup
+        self._lookups = set()
+
+    def pending(self) -> int:
+        return sum(map(len, self._overflow)) + sum(map(len, self._unresolved.values()))
+
+    def submit(self, update: Update):
+        if update.poll_answer:
+            poll_id = update.poll_answer.poll_id
+            chat_id = self._poll_chats.get(poll_id)
+            if chat_id is None:
+                self._defer_poll_answer(poll_id, update)
+                return
+            self._poll_chats.move_to_end(poll_id)
+            key = chat_id
         else:
-            await update.message.reply_text(
-                f"🔇 Permanently muted user `{user_id}`",
-                parse_mode="Markdown"
-            )
-            
-    except (IndexError, ValueError, AttributeError):
-        await update.message.reply_text(
-            "ℹ️ Usage:\n"
-            "• `/mute <user_id>` - Permanent mute\n"
-            "• `/mute <user_id> 30m` - 30 minutes\n"
-            "• `/mute <user_id> 2h` - 2 hours\n"
-            "• `/mute <user_id> 1d` - 1 day",
-            parse_mode="Markdown"
-        )
+            key = update_order_key(update)
+        self._put(shard_for(key, len(self.queues)), update.to_dict())
 
-async def unmute_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Unmute a user (restore default permissions)"""
-    if not await is_group_admin(update, context):
-        await update.message.reply_text("🚫 Admin only!")
-        return
+    def _put(self, shard: int, item):
+        self.routed[shard] += 1
+        overflow = self._overflow[shard]
+        if not overflow:
+            try:
+                self.queues[shard].put_nowait(item)
+                return
+            except QueueFull:
+                pass
+        overflow.append(item)
+        if shard not in self._drainers:
+            self._drainers[shard] = asyncio.create_task(self._drain(shard))
+
+    async def _drain(self, shard: int):
+        loop = asyncio.get_running_loop()
+        overflow = self._overflow[shard]
+        try:
+            while overflow:
+                # The blocking put waits for the worker on an executor thread
+                await loop.run_in_executor(None, self.queues[shard].put, overflow[0])
+                overflow.popleft()
+        finally:
+            del self._drainers[shard]
+
+    def _defer_poll_answer(self, poll_id: str, update: Update):
+        waiting = self._unresolved.get(poll_id)
+        if waiting is not None:
+            waiting.append(update)
+            return
+        self._unresolved[poll_id] = [update]
+        task = asyncio.create_task(self._resolve_poll(poll_id))
+        self._lookups.add(task)
+        task.add_done_callback(self._lookups.discard)
 
+    async def _resolve_poll(self, poll_id: str):
+        row = None
+        try:
+            # Answers can beat the worker recording a brand-new game
+            for delay in (0, 0.25, 1.0):
+                await asyncio.sleep(delay)
+                row = await db.fetchone("SELECT chat_id FROM games WHERE poll_id = ?", (poll_id,))
+                if row:
+                    break
+        finally:
+            waiting = self._unresolved.pop(poll_id)
+            if row:
+                self._poll_chats[poll_id] = row[0]
+                if len(self._poll_chats) > self._poll_cache_size:
+                    self._poll_chats.popitem(last=False)
+            for update in waiting:
+                # Not a known game: any shard will do, it ignores the answer
+                key = row[0] if row else update_order_key(update)
+                self._put(shard_for(key, len(self.queues)), update.to_dict())
+
+    async def wait_drained(self):
+        """Wait until every routed update is in a worker queue."""
+        while self._lookups or self._drainers:
+            await asyncio.gather(*self._lookups, *self._drainers.values(), return_exceptions=True)
+
+    async def close(self):
+        """Flush pending updates, then send each worker its shutdown sentinel."""
+        await self.wait_drained()
+        loop = asyncio.get_running_loop()
+        for inbox in self.queues:
+            await loop.run_in_executor(None, inbox.put, None)
+
+async def _shard_worker_main(inbox):
+    app = build_application()
+    warn_if_webhook_open()
+    dispatcher = ChatOrderedDispatcher(app, UPDATE_CONCURRENCY)
+    await app.initialize()
+    if app.post_init:
+        await app.post_init(app)
+    await app.start()
+    loop = asyncio.get_running_loop()
     try:
-        user_id = int(context.args[0])
-        await context.bot.restrict_chat_member(
-            chat_id=update.effective_chat.id,
-            user_id=user_id,
-            permissions=ChatPermissions(
-                can_send_messages=True,
-                can_send_media_messages=True,
-                can_send_other_messages=True,
-                can_add_web_page_previews=True
-            )
-        )
-        await update.message.reply_text(f"🔊 Unmuted user: `{user_id}`", parse_mode="Markdown")
-    except (IndexError, ValueError):
-        await update.message.reply_text("ℹ️ Usage: `/unmute <user_id>` or reply with `/unmute`", parse_mode="Markdown")
+        while True:
+            item = await loop.run_in_executor(None, inbox.get)
+            if item is None:  # shutdown sentinel from the front process
+                break
+            dispatcher.submit(Update.de_json(item, app.bot))
+    finally:
+        await dispatcher.join()
+        await app.stop()
+        if app.post_stop:
+            await app.post_stop(app)
+        await app.shutdown()
+        if app.post_shutdown:
+            await app.post_shutdown(app)
 
-async def kick_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Kick a single user"""
-    if not await is_group_admin(update, context):
-        await update.message.reply_text("🚫 Admin only!")
-        return
+def run_shard_worker(shard_id: int, shard_count: int, inbox):
+    """Worker process entry point; owns the caches for its slice of chats."""
+    global SHARD_ID, SHARD_COUNT, METRICS_PORT
+    SHARD_ID, SHARD_COUNT = shard_id, shard_count
+    if METRICS_PORT:
+        METRICS_PORT += shard_id
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # the front process coordinates shutdown
+    asyncio.run(_shard_worker_main(inbox))
+
+async def poll_updates(bot, stop_event: asyncio.Event):
+    """Default update source for the front process: long polling."""
+    offset = None
+    while not stop_event.is_set():
+        try:
+            updates = await bot.get_updates(offset=offset, timeout=30, allowed_updates=Update.ALL_TYPES)
+        except RetryAfter as e:
+            await asyncio.sleep(e.retry_after)
+            continue
+        except NetworkError as e:
+            print(f"Polling error: {e}")
+            await asyncio.sleep(1)
+            continue
+        for update in updates:
+            offset = update.update_id + 1
+            yield update
+
+async def serve_sharded(shard_count: int, source=None, stop_event: asyncio.Event = None):
+    """Run a front dispatcher routing updates by chat to ``shard_count`` workers.
+
+    ``source`` is an async iterator of Updates; it defaults to webhook or long
+    polling depending on BOT_MODE, and can be a fake stream for local testing.
+    """
+    stop_event = stop_event or asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop_event.set)
+        except (NotImplementedError, RuntimeError):
+            pass
+
+    mp = multiprocessing.get_context("spawn")
+    queues = [mp.Queue(SHARD_QUEUE_SIZE) for _ in range(shard_count)]
+    workers = [
+        mp.Process(target=run_shard_worker, args=(i, shard_count, queues[i]), name=f"shard-{i}")
+        for i in range(shard_count)
+    ]
+    for worker in workers:
+        worker.start()
+    router = ShardRouter(queues)
 
+    base_url = f"{TELEGRAM_API_URL.rstrip('/')}/bot" if TELEGRAM_API_URL else "https://api.telegram.org/bot"
+    front_bot = Bot(TOKEN, base_url=base_url)
+    await front_bot.initialize()
+    server = None
     try:
-        user_id = int(context.args[0])
-        await context.bot.ban_chat_member(
-            chat_id=update.effective_chat.id,
-            user_id=user_id,
-            until_date=int(time.time()) + 60  # Ban for 60 seconds (effectively a kick)
-        )
-        await update.message.reply_text(f"👢 Kicked user: `{user_id}`", parse_mode="Markdown")
-    except (IndexError, ValueError):
-        await update.message.reply_text("ℹ️ Usage: /kick <user_id>")
+        if source is not None:
+            async for update in source:
+                router.submit(update)
+                if router.pending():
+                    await router.wait_drained()
+                if stop_event.is_set():
+                    break
+        elif BOT_MODE == "webhook":
+            warn_if_webhook_open()
+            if WEBHOOK_URL:
+                await front_bot.set_webhook(
+                    WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+                    secret_token=WEBHOOK_SECRET,
+                    allowed_updates=Update.ALL_TYPES
+                )
+            server = await asyncio.start_server(
+                lambda r, w: _handle_webhook_request(r, w, front_bot, router), WEBHOOK_LISTEN, WEBHOOK_PORT
+            )
+            await stop_event.wait()
+        else:
+            polling = asyncio.create_task(_drain_source(poll_updates(front_bot, stop_event), router))
+            await stop_event.wait()
+            polling.cancel()
+            await asyncio.gather(polling, return_exceptions=True)
+    finally:
+        if server is not None:
+            server.close()
+            await server.wait_closed()
+        await router.close()
+        for worker in workers:
+            await loop.run_in_executor(None, worker.join, 30)
+            if worker.is_alive():
+                print(f"{worker.name} did not stop in time; terminating")
+                worker.terminate()
+        await front_bot.shutdown()
+    return router.routed
+
+async def _drain_source(source, router):
+    async for update in source:
+        router.submit(update)
+        if router.pending():
+            await router.wait_drained()  # stop fetching while workers are saturated
 
 # --- Main ---
+# --- Handler Registry ---
+COMMANDS = (
+    ("start", start),
+    ("help", help_command),
+    ("rules", show_rules),
+    ("setrules", set_rules),
+    ("addfaq", add_faq),
+    ("faq", get_faq),
+    ("faqauto", toggle_faq_autoreply),
+    ("ban", ban_user),
+    ("warn", warn_user),
+    ("warnings", list_warnings),
+    ("unwarn", clear_warnings),
+    ("warnconfig", warn_config),
+    ("userinfo", userinfo),
+    ("mute", mute_user),
+    ("unmute", unmute_user),
+    ("antispam", toggle_antispam),
+    ("antiflood", set_antiflood),
+    ("spamrule", spam_rule),
+    ("kick", kick_user),
+    ("kickall", kickall),
+    ("auditlog", show_audit_log),
+    ("auditexport", export_audit_log),
+    ("stats", group_stats),
+    ("truthordare", truth_or_dare),
+    ("games", games_command),
+    ("wcg", start_wcg),
+    ("wcg_results", show_results),
+    ("wcg_leaderboard", leaderboard),
+    ("logo", logo_command),
+    ("slowest", slowest_handlers),
+)
+
+GROUP_MESSAGES = filters.ChatType.GROUPS & ~filters.StatusUpdate.ALL & ~filters.COMMAND
+PLAIN_TEXT = filters.TEXT & ~filters.COMMAND
+
+# (handler group, factory) in registration order; factories keep every
+# Application's handlers independent, since instrumenting wraps callbacks in place
+HANDLERS = (
+    (-4, lambda: MessageHandler(filters.ChatType.GROUPS, count_activity)),
+    (-3, lambda: TypeHandler(Update, record_users)),
+    (-2, lambda: TypeHandler(Update, mark_first_update)),
+    (-1, lambda: MessageHandler(GROUP_MESSAGES, anti_flood)),
+    *((0, lambda name=name, callback=callback: CommandHandler(name, callback)) for name, callback in COMMANDS),
+    (0, lambda: MessageHandler(filters.StatusUpdate.NEW_CHAT_MEMBERS, on_new_members)),
+    (0, lambda: PollAnswerHandler(handle_vote)),
+    (0, lambda: ChatMemberHandler(on_chat_member_update, ChatMemberHandler.ANY_CHAT_MEMBER)),
+    (0, lambda: MessageHandler(PLAIN_TEXT, anti_spam)),
+    (0, lambda: CallbackQueryHandler(button_handler)),
+    (0, lambda: CallbackQueryHandler(toggle_feature, pattern="^toggle_")),
+    (1, lambda: MessageHandler(PLAIN_TEXT, faq_autoreply)),
+)
+
+def build_application(token: str = None, request=None):
+    """Create the Application with every handler registered.
+
+    ``request`` replaces the HTTP transport, e.g. with an in-process fake API.
+    """
+    builder = ApplicationBuilder().token(token or TOKEN).post_init(on_startup).post_shutdown(on_shutdown)
+    if TELEGRAM_API_URL:
+        builder = builder.base_url(f"{TELEGRAM_API_URL.rstrip('/')}/bot")
+    if request is not None:
+        builder = builder.get_updates_request(request)
+    builder = builder.request(InstrumentedRequest(request or HTTPXRequest(connection_pool_size=256)))
+    app = builder.build()
+
+    for group, make_handler in HANDLERS:
+        app.add_handler(make_handler(), group=group)
+    instrument_application(app)
+    return app
+
+startup.mark("imported")
+
 if __name__ == "__main__":
     init_db()
-    
-    app = ApplicationBuilder().token(TOKEN).build()
-
-    # Commands
-    app.add_handler(CommandHandler("start", start))
-    app.add_handler(CommandHandler("help", help_command))
-    app.add_handler(CommandHandler("rules", show_rules))
-    app.add_handler(CommandHandler("setrules", set_rules))
-    app.add_handler(CommandHandler("addfaq", add_faq))
-    app.add_handler(CommandHandler("faq", get_faq))
-    app.add_handler(CommandHandler("ban", ban_user))
-    app.add_handler(CommandHandler("warn", warn_user))
-    app.add_handler(CommandHandler("userinfo", userinfo))
-    app.add_handler(CommandHandler("mute", mute_user))
-    app.add_handler(CommandHandler("unmute", unmute_user))
-    app.add_handler(CommandHandler("antispam", toggle_antispam))
-    app.add_handler(CommandHandler("kick", kick_user))
-    app.add_handler(CommandHandler("truthordare", truth_or_dare))
-    app.add_handler(CommandHandler("meme", ...))
-    app.add_handler(CommandHandler("games", games_command))  # Make sure this exists
-    app.add_handler(CommandHandler("wcg", start_wcg))
-    app.add_handler(CommandHandler("wcg_results", show_results))
-    app.add_handler(CommandHandler("wcg_leaderboard", leaderboard))
-    app.add_handler(CommandHandler("logo", logo_command))
-    
-    app.add_handler(PollAnswerHandler(handle_vote))
-    
-    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, anti_spam))
-
-    app.add_handler(CallbackQueryHandler(button_handler))
-    app.add_handler(CallbackQueryHandler(toggle_feature, pattern="^toggle_"))
-    
 
-    print("Bot is running...")
-    app.run_polling()
+    if SHARD_COUNT > 1:
+        print(f"Bot is running ({BOT_MODE}, {SHARD_COUNT} shards)...")
+        asyncio.run(serve_sharded(SHARD_COUNT))
+    elif BOT_MODE == "webhook":
+        print(f"Bot is running (webhook on {WEBHOOK_LISTEN}:{WEBHOOK_PORT}{WEBHOOK_PATH})...")
+        asyncio.run(serve_webhook(build_application()))
+    else:
+        print("Bot is running...")
+        build_application().run_polling(allowed_updates=Update.ALL_TYPES)
@@ -0,0 +1,137 @@
+import os
+import sys
+import asyncio
+import tempfile
+
+import pytest
+
+# bot.py's db object reads DB_NAME at import, so point it at a scratch file first
+os.environ.setdefault("DB_NAME", os.path.join(tempfile.mkdtemp(prefix="bot-tests-"), "test.db"))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bot  # noqa: E402
+
+
+@pytest.fixture(scope="session")
+def schema():
+    """The shared test database, migrated to the current schema."""
+    bot.init_db()
+    return bot.db
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+async def stop_buffers():
+    """Flush and stop the module-level write buffers started during a test."""
+    for buffer in (bot.audit_log, bot.user_directory, bot.activity, bot.warning_ledger, bot.vote_buffer):
+        await buffer.stop()
+
+
+class FakeTelegram:
+    """A local stand-in for the Bot API that records every call."""
+
+    def __init__(self):
+        import json
+        import threading
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+        fake = self
+        self.calls = []  # (method, parameters)
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                method = self.path.rsplit("/", 1)[-1]
+                body = self.rfile.read(int(self.headers.get("content-length", 0)))
+                params = fake.parse(self.headers.get("content-type", ""), body)
+                fake.calls.append((method, params))
+                out = json.dumps({"ok": True, "result": fake.result(method, params)}).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(out)))
+                self.end_headers()
+                self.wfile.write(out)
+
+            def log_message(self, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self._server.server_port}"
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+
+    @staticmethod
+    def parse(content_type: str, body: bytes) -> dict:
+        """Request parameters, with JSON-encoded values decoded and uploads as bytes."""
+        import json
+        from email.parser import BytesParser
+        from urllib.parse import parse_qsl
+
+        if content_type.startswith("multipart/"):
+            message = BytesParser().parsebytes(f"Content-Type: {content_type}\r\n\r\n".encode() + body)
+            fields = {
+                part.get_param("name", header="content-disposition"): part.get_payload(decode=True)
+                for part in message.get_payload()
+            }
+        else:
+            fields = dict(parse_qsl(body.decode()))
+        params = {}
+        for name, value in fields.items():
+            if isinstance(value, str):
+                try:
+                    value = json.loads(value)
+                except ValueError:
+                    pass
+            params[name] = value
+        return params
+
+    def result(self, method, params):
+        if method == "getMe":
+            return {"id": 42, "is_bot": True, "first_name": "Bot", "username": "test_bot"}
+        if method == "sendMessage":
+            chat = {"id": int(params.get("chat_id", 0)), "type": "group"}
+            return {"message_id": len(self.calls), "date": 0, "chat": chat, "text": params.get("text")}
+        if method == "sendPhoto":
+            chat = {"id": int(params.get("chat_id", 0)), "type": "group"}
+            photo = [{"file_id": f"photo-{len(self.calls)}", "file_unique_id": "u", "width": 1, "height": 1}]
+            return {"message_id": len(self.calls), "date": 0, "chat": chat, "photo": photo}
+        if method == "getChatAdministrators":
+            return []
+        return True
+
+    def sent(self, method="sendMessage"):
+        return [params for name, params in self.calls if name == method]
+
+    def close(self):
+        self._server.shutdown()
+
+
+@pytest.fixture
+def fake_telegram(monkeypatch):
+    fake = FakeTelegram()
+    monkeypatch.setattr(bot, "TELEGRAM_API_URL", fake.url)
+    yield fake
+    fake.close()
+
+
+def message_update(update_id: int, chat_id: int, text: str, user_id: int = 7) -> dict:
+    """A group text message as Telegram would POST it."""
+    entities = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}] if text.startswith("/") else []
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": 0,
+            "chat": {"id": chat_id, "type": "supergroup", "title": "group"},
+            "from": {"id": user_id, "is_bot": False, "first_name": "user"},
+            "text": text,
+            "entities": entities,
+        },
+    }
+
+
+def free_port() -> int:
+    import socket
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
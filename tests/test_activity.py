@@ -0,0 +1,127 @@
+import time
+from types import SimpleNamespace
+
+from telegram.error import TelegramError
+
+from conftest import run, stop_buffers
+
+import bot
+
+
+def _user(user_id: int, is_bot: bool = False):
+    return SimpleNamespace(id=user_id, is_bot=is_bot, full_name=f"user{user_id}")
+
+
+def _message(chat_id: int, user, text=None, new_chat_members=(), left_chat_member=None):
+    async def delete():
+        pass
+
+    async def reply_text(text, **kwargs):
+        replies.append(text)
+
+    replies = []
+    message = SimpleNamespace(
+        chat_id=chat_id, from_user=user, text=text, new_chat_members=list(new_chat_members),
+        left_chat_member=left_chat_member, delete=delete, reply_text=reply_text, replies=replies,
+    )
+    return SimpleNamespace(
+        message=message, effective_message=message, effective_user=user,
+        effective_chat=SimpleNamespace(id=chat_id, type="supergroup"),
+    )
+
+
+def _track(schema, chat_id: int, member_count: int):
+    schema._timed("test", lambda conn: conn.execute(
+        "INSERT OR REPLACE INTO tracked_groups (group_id, title, owner_id, date_added, member_count)"
+        " VALUES (?, 'test', 1, '', ?)", (chat_id, member_count)
+    ))
+
+
+def test_rollup_counts_human_traffic_and_adjusts_member_count(schema, monkeypatch):
+    chat_id = -4301
+    _track(schema, chat_id, 10)
+    stats = bot.ActivityStats(flush_interval=60)
+    monkeypatch.setattr(bot, "activity", stats)
+    updates = [
+        _message(chat_id, _user(1), new_chat_members=[_user(11), _user(12), _user(13, is_bot=True)]),
+        _message(chat_id, _user(11), left_chat_member=_user(11)),
+        _message(chat_id, _user(1), left_chat_member=_user(13, is_bot=True)),
+        *[_message(chat_id, _user(1), "hi") for _ in range(3)],
+        _message(chat_id, _user(2), "hello"),
+        _message(chat_id, _user(99, is_bot=True), "beep"),
+    ]
+
+    async def scenario():
+        for update in updates:
+            await bot.count_activity(update, None)
+        rows = await stats.flush()
+        await stats.stop()
+        return rows
+
+    assert run(scenario()) == 3  # one hourly row, two daily poster rows
+    hour = int(time.time()) // 3600
+    assert run(bot.db.fetchone(
+        "SELECT messages, spam, joins, leaves FROM activity_hourly WHERE chat_id = ? AND hour = ?", (chat_id, hour)
+    )) == (4, 0, 2, 1)
+    assert run(bot.db.fetchall(
+        "SELECT user_id, messages FROM user_activity_daily WHERE chat_id = ? ORDER BY user_id", (chat_id,)
+    )) == [(1, 3), (2, 1)]
+    assert run(bot.db.fetchone("SELECT member_count FROM tracked_groups WHERE group_id = ?", (chat_id,))) == (11,)
+
+    # /stats reads the rollups; without a live member count it falls back to the tracked one
+    async def failing_count(chat_id):
+        raise TelegramError("unavailable")
+
+    bot.admin_cache.set_admins(chat_id, frozenset({1}))
+    update = _message(chat_id, _user(1), "/stats")
+
+    async def stats_command():
+        context = SimpleNamespace(args=[], bot=SimpleNamespace(get_chat_member_count=failing_count))
+        await bot.group_stats(update, context)
+        await stop_buffers()
+
+    run(stats_command())
+    [reply] = update.message.replies
+    assert "Members: 11 (+2 / -1)" in reply
+    assert "Messages: 4" in reply
+    assert "1. 1: 3" in reply  # posters missing from the user directory are shown by ID
+
+
+def test_spam_is_counted_only_when_moderated(schema, monkeypatch):
+    chat_id, admin_id = -4302, 5
+    schema._timed("test", lambda conn: conn.execute(
+        "INSERT INTO spam_triggers (chat_id, kind, trigger) VALUES (?, 'keyword', 'cheap pills')", (chat_id,)
+    ))
+    schema._timed("test", lambda conn: conn.execute(
+        "INSERT OR REPLACE INTO anti_spam_settings (group_id, is_active, dry_run) VALUES (?, 1, 0)", (chat_id,)
+    ))
+    bot.settings_cache.invalidate(chat_id)
+    bot.admin_cache.set_admins(chat_id, frozenset({admin_id}))
+    stats = bot.ActivityStats(flush_interval=60)
+    monkeypatch.setattr(bot, "activity", stats)
+    monkeypatch.setattr(bot, "outbound", SimpleNamespace(notify=lambda *args: None))
+
+    async def send(user_id):
+        try:
+            await bot.anti_spam(_message(chat_id, _user(user_id), "cheap pills here"), SimpleNamespace(bot=None))
+        except bot.ApplicationHandlerStop:
+            pass
+
+    async def scenario():
+        await send(admin_id)  # deleted, but admins are never moderated
+        moderated = dict(stats._events)
+        await send(6)
+        counted = {key: list(counters) for key, counters in stats._events.items()}
+        # Dry runs only report what would have happened
+        await bot.db.execute("UPDATE anti_spam_settings SET dry_run = 1 WHERE group_id = ?", (chat_id,))
+        bot.settings_cache.invalidate(chat_id)
+        await send(7)
+        dry = {key: list(counters) for key, counters in stats._events.items()}
+        await stats.stop()
+        await stop_buffers()
+        return moderated, counted, dry
+
+    moderated, counted, dry = run(scenario())
+    assert moderated == {}
+    assert [counters[0] for counters in counted.values()] == [1]
+    assert dry == counted
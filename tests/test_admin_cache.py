@@ -0,0 +1,85 @@
+from types import SimpleNamespace
+
+import pytest
+from telegram import Update
+
+from conftest import run
+
+import bot
+
+ADMIN_RIGHTS = dict.fromkeys([
+    "can_be_edited", "is_anonymous", "can_manage_chat", "can_delete_messages", "can_manage_video_chats",
+    "can_restrict_members", "can_promote_members", "can_change_info", "can_invite_users",
+], False)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(bot.time, "monotonic", lambda: now[0])
+    return now
+
+
+class AdminListBot:
+    def __init__(self, admin_ids):
+        self.admin_ids = admin_ids
+        self.calls = 0
+
+    async def get_chat_administrators(self, chat_id):
+        self.calls += 1
+        return [SimpleNamespace(user=SimpleNamespace(id=user_id)) for user_id in self.admin_ids]
+
+
+def _is_admin(fake, chat_id: int, user_id: int) -> bool:
+    update = SimpleNamespace(
+        effective_chat=SimpleNamespace(id=chat_id, type="supergroup"), effective_user=SimpleNamespace(id=user_id)
+    )
+    return run(bot.is_group_admin(update, SimpleNamespace(bot=fake)))
+
+
+def _member_update(chat_id: int, user_id: int, old: str, new: str) -> Update:
+    user = {"id": user_id, "is_bot": False, "first_name": "member"}
+
+    def member(status):
+        return {"status": status, "user": user, **(ADMIN_RIGHTS if status == "administrator" else {})}
+
+    return Update.de_json({"update_id": 1, "chat_member": {
+        "chat": {"id": chat_id, "type": "supergroup"}, "from": user, "date": 0,
+        "old_chat_member": member(old), "new_chat_member": member(new),
+    }}, None)
+
+
+def test_one_admin_list_answers_every_lookup_until_it_expires(clock, monkeypatch):
+    monkeypatch.setattr(bot, "admin_cache", bot.AdminCache(ttl=300))
+    fake = AdminListBot({1, 2})
+
+    assert [_is_admin(fake, -4701, user_id) for user_id in (1, 2, 3, 4)] == [True, True, False, False]
+    assert fake.calls == 1
+    clock[0] += 299
+    assert _is_admin(fake, -4701, 3) is False and fake.calls == 1
+    clock[0] += 2  # past the TTL: the list is fetched again
+    fake.admin_ids = {1, 2, 3}
+    assert _is_admin(fake, -4701, 3) is True and fake.calls == 2
+    assert bot.admin_cache.stats()["hits"] == 4
+
+
+def test_promotions_and_demotions_invalidate_the_chat(clock, monkeypatch):
+    monkeypatch.setattr(bot, "admin_cache", bot.AdminCache(ttl=300))
+    fake = AdminListBot({1})
+    chat_id = -4702
+    assert _is_admin(fake, chat_id, 5) is False
+
+    # A promotion drops the stale list and records the member's new status
+    run(bot.on_chat_member_update(_member_update(chat_id, 5, "member", "administrator"), None))
+    assert bot.admin_cache.get(chat_id, 5) is True
+    assert bot.admin_cache.get(chat_id, 1) is None  # not known until the list is fetched again
+    fake.admin_ids = {1, 5}
+    assert _is_admin(fake, chat_id, 1) is True and fake.calls == 2
+
+    run(bot.on_chat_member_update(_member_update(chat_id, 5, "administrator", "member"), None))
+    assert bot.admin_cache.get(chat_id, 5) is False
+    # Changes that keep admin status leave the list alone
+    run(bot.on_chat_member_update(_member_update(chat_id, 6, "member", "left"), None))
+    fake.admin_ids = {1}
+    assert _is_admin(fake, chat_id, 1) is True and fake.calls == 3
+    assert _is_admin(fake, chat_id, 6) is False and fake.calls == 3
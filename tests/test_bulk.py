@@ -0,0 +1,103 @@
+import asyncio
+from types import SimpleNamespace
+
+from telegram.error import BadRequest, RetryAfter
+
+from conftest import run, stop_buffers
+
+import bot
+
+
+class KickingBot:
+    """Records ban_chat_member calls; ``failures`` maps user_id to errors to raise first."""
+
+    def __init__(self, delay: float = 0.0, failures: dict = None):
+        self.delay = delay
+        self.failures = failures or {}
+        self.calls = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    async def ban_chat_member(self, chat_id, user_id, until_date=None):
+        loop = asyncio.get_running_loop()
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            await asyncio.sleep(self.delay)
+            self.calls.append((user_id, loop.time()))
+            errors = self.failures.get(user_id)
+            if errors:
+                raise errors.pop(0)
+        finally:
+            self.in_flight -= 1
+
+
+def test_batches_run_with_bounded_concurrency(schema, monkeypatch):
+    monkeypatch.setattr(bot, "moderation_limiter", bot.RateLimiter(10000))
+    fake = KickingBot(delay=0.02, failures={7: [BadRequest("User not found")]})
+
+    async def scenario():
+        results = await bot.run_moderation_batch(fake, -4601, range(1, 21), "kick", concurrency=4)
+        await stop_buffers()
+        return results
+
+    results = run(scenario())
+    assert fake.max_in_flight == 4
+    assert results == [user_id != 7 for user_id in range(1, 21)]
+
+
+def test_retry_after_pauses_the_whole_chat(schema, monkeypatch):
+    monkeypatch.setattr(bot, "moderation_limiter", bot.RateLimiter(10000))
+    monkeypatch.setattr(bot, "BULK_MAX_RETRIES", 3)
+    fake = KickingBot(failures={
+        1: [RetryAfter(0.3)],
+        3: [RetryAfter(0), RetryAfter(0), RetryAfter(0)],  # never succeeds within the retry budget
+    })
+
+    async def scenario():
+        results = await bot.run_moderation_batch(fake, -4602, [1, 2, 3], "ban", concurrency=1)
+        await stop_buffers()
+        return results
+
+    assert run(scenario()) == [True, True, False]
+    (_, throttled), (_, retried), (_, after) = fake.calls[:3]
+    assert [user_id for user_id, _ in fake.calls] == [1, 1, 2, 3, 3, 3]
+    assert retried - throttled >= 0.29
+    assert after - throttled >= 0.29  # the next user waited out the same pause
+
+
+def _create_job(chat_id: int, user_ids, status: str, done=()):
+    async def create():
+        job_id = await bot.create_bulk_job(chat_id, "kick", user_ids, created_by=1)
+        await bot.db.execute("UPDATE bulk_jobs SET status = ?, done_count = ? WHERE job_id = ?",
+                             (status, len(done), job_id))
+        await bot.db.executemany(
+            "UPDATE bulk_job_targets SET status = 'done' WHERE job_id = ? AND user_id = ?",
+            [(job_id, user_id) for user_id in done]
+        )
+        return job_id
+
+    return run(create())
+
+
+def test_running_jobs_resume_where_they_stopped(schema, monkeypatch):
+    monkeypatch.setattr(bot, "moderation_limiter", bot.RateLimiter(10000))
+    interrupted = _create_job(-4603, [1, 2, 3, 4, 5], "running", done=[1, 2])
+    finished = _create_job(-4604, [6, 7], "done", done=[6, 7])
+    waiting = _create_job(-4605, [8], "pending")  # never confirmed
+    fake = KickingBot()
+
+    async def scenario():
+        tasks = []
+        app = SimpleNamespace(bot=fake, create_task=lambda coro: tasks.append(asyncio.ensure_future(coro)))
+        await bot.resume_bulk_jobs(app)
+        await asyncio.gather(*tasks)
+        await stop_buffers()
+
+    run(scenario())
+    assert sorted(user_id for user_id, _ in fake.calls) == [3, 4, 5]
+    jobs = run(bot.db.fetchall(
+        "SELECT job_id, status, done_count, failed_count FROM bulk_jobs WHERE job_id IN (?, ?, ?) ORDER BY job_id",
+        (interrupted, finished, waiting)
+    ))
+    assert jobs == [(interrupted, "done", 5, 0), (finished, "done", 2, 0), (waiting, "pending", 0, 0)]
@@ -0,0 +1,57 @@
+import asyncio
+import sqlite3
+
+import pytest
+
+from conftest import run
+
+import bot
+
+
+@pytest.fixture
+def database(tmp_path):
+    database = bot.Database(str(tmp_path / "db.sqlite"), pool_size=2)
+    yield database
+    database.close()
+
+
+def test_each_run_is_one_transaction(database):
+    async def scenario():
+        await database.execute("CREATE TABLE items (name TEXT PRIMARY KEY)")
+        assert await database.executemany("INSERT INTO items VALUES (?)", [("a",), ("b",)]) == 2
+
+        def fails_halfway(conn):
+            conn.execute("INSERT INTO items VALUES ('c')")
+            conn.execute("INSERT INTO items VALUES ('a')")  # duplicate key
+
+        with pytest.raises(sqlite3.IntegrityError):
+            await database.run(fails_halfway, label="fails_halfway")
+        return await database.fetchall("SELECT name FROM items ORDER BY name")
+
+    assert run(scenario()) == [("a",), ("b",)]  # 'c' was rolled back with the failed insert
+    # Committed writes are visible to other connections, and the file is in WAL mode
+    other = sqlite3.connect(database.path)
+    assert other.execute("SELECT COUNT(*) FROM items").fetchone() == (2,)
+    assert other.execute("PRAGMA journal_mode").fetchone() == ("wal",)
+    other.close()
+
+
+def test_connections_are_pooled_per_thread_and_queries_are_timed(database):
+    async def scenario():
+        spent = [0.0]
+        database.time_spent.set(spent)
+        await asyncio.gather(*(database.fetchone("SELECT ?", (i,)) for i in range(50)))
+        await database.fetchone("SELECT 1", label="one")
+        return spent[0]
+
+    spent = run(scenario())
+    assert spent > 0
+    assert len(database._connections) <= database.pool_size
+    stats = database.query_stats()
+    assert stats["SELECT ?"]["count"] == 50 and stats["one"]["count"] == 1
+    assert stats["SELECT ?"]["max_ms"] >= stats["SELECT ?"]["avg_ms"] > 0
+
+    # close() drops every connection; the next query opens new ones
+    database.close()
+    assert database._connections == []
+    assert run(database.fetchone("SELECT 2")) == (2,)
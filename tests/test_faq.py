@@ -0,0 +1,58 @@
+import random
+import statistics
+import time
+
+import bot
+
+
+def _questions(count: int, seed: int = 1):
+    rng = random.Random(seed)
+    vocab = ["".join(rng.choice("abcdefghijklmnopqrstuvwxyz") for _ in range(rng.randint(3, 9))) for _ in range(3000)]
+    stems = ["how do i", "what is the", "where can i find", "how to", "can you", "when does the"]
+    questions = []
+    for _ in range(count):
+        words = [rng.choice(vocab[:40]) if rng.random() < 0.3 else rng.choice(vocab) for _ in range(rng.randint(2, 5))]
+        questions.append(f"{rng.choice(stems)} {' '.join(words)}?")
+    return rng, questions
+
+
+def _index(questions):
+    index = bot.FAQIndex()
+    for question in questions:
+        index.add(question, f"answer to {question}")
+    return index
+
+
+def test_stopwords_neither_match_nor_dilute():
+    index = _index(["How do I reset my password?", "How do I join the game?"])
+    assert index.search("how do i?") == []
+    score, question, _ = index.search("reset password")[0]
+    assert question == "How do I reset my password?"
+    assert score >= bot.FAQ_MATCH_THRESHOLD
+
+
+def test_typos_still_match():
+    index = _index(["How do I reset my password?", "Where are the rules?"])
+    assert index.search("how to resett my pasword")[0][1] == "How do I reset my password?"
+
+
+def test_pruned_search_matches_exhaustive_scores():
+    rng, questions = _questions(2000)
+    index = _index(questions)
+    queries = [rng.choice(questions).replace("a", "e", 1) for _ in range(200)]
+    for query in queries:
+        exhaustive = [match for match in index.search(query, min_score=0) if match[0] >= bot.FAQ_SUGGEST_THRESHOLD]
+        pruned = index.search(query)
+        assert [score for score, _, _ in pruned] == [score for score, _, _ in exhaustive]
+
+
+def test_search_is_sub_millisecond_at_5000_questions():
+    rng, questions = _questions(5000)
+    index = _index(questions)
+    queries = [rng.choice(questions).replace("e", "a", 1) for _ in range(300)]
+    timings = []
+    for query in queries:
+        start = time.perf_counter()
+        index.search(query)
+        timings.append(time.perf_counter() - start)
+    assert statistics.median(timings) < 0.001
@@ -0,0 +1,49 @@
+import pytest
+
+import bot
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(bot.time, "monotonic", lambda: now[0])
+    return now
+
+
+def test_rate_limit_uses_a_sliding_window(clock):
+    detector = bot.FloodDetector()
+    results = []
+    for _ in range(5):
+        results.append(detector.check(-1, 7, None, limit=5, window=10, duplicate_limit=0))
+        clock[0] += 1
+    assert results == [None, None, None, None, "flood"]
+
+    # Spread out over more than the window, the same count is fine
+    clock[0] += 60
+    spaced = []
+    for _ in range(6):
+        spaced.append(detector.check(-1, 7, None, limit=5, window=10, duplicate_limit=0))
+        clock[0] += 3
+    assert spaced == [None] * 6
+    # Other users and chats keep their own windows
+    assert detector.check(-1, 8, None, limit=5, window=10, duplicate_limit=0) is None
+    assert detector.check(-2, 7, None, limit=5, window=10, duplicate_limit=0) is None
+
+
+def test_duplicates_are_counted_per_chat_across_users(clock):
+    detector = bot.FloodDetector()
+    texts = ["Buy NOW", "buy   now", "BUY NOW"]  # the same after normalization
+    results = [detector.check(-1, user_id, text, 100, 10, 3) for user_id, text in enumerate(texts, 1)]
+    assert results == [None, None, "duplicate"]
+    assert detector.check(-2, 1, "buy now", 100, 10, 3) is None
+
+
+def test_idle_entries_are_swept(clock):
+    detector = bot.FloodDetector(idle_seconds=30, fingerprints_per_chat=2)
+    for i in range(4):
+        detector.check(-1, i, f"message {i}", 100, 10, 3)
+    assert len(detector._fingerprints[-1]) == 2  # oldest fingerprints evicted
+    clock[0] += 31
+    detector.check(-2, 99, "fresh", 100, 10, 3)  # triggers the periodic sweep
+    assert list(detector._rates) == [(-2, 99)]
+    assert list(detector._fingerprints) == [-2]
@@ -0,0 +1,117 @@
+import asyncio
+import gc
+import json
+import warnings
+
+from conftest import run, stop_buffers
+
+import bot
+
+
+class ModerationBot:
+    def __init__(self):
+        self.calls = []
+
+    async def restrict_chat_member(self, chat_id, user_id, permissions=None, until_date=None):
+        self.calls.append(("mute" if not permissions.can_send_messages else "unmute", user_id))
+
+
+class Notices:
+    def __init__(self):
+        self.texts = []
+
+    def post(self, chat_id, text, priority=None, **kwargs):
+        self.texts.append((chat_id, text))
+
+
+def _members(first: int, count: int) -> list:
+    return [(user_id, f"user{user_id}") for user_id in range(first, first + count)]
+
+
+def test_joins_are_welcomed_and_muted_in_one_batch(schema, monkeypatch):
+    chat_id = -4101
+    notices = Notices()
+    monkeypatch.setattr(bot, "outbound", notices)
+    fake = ModerationBot()
+    features = {"welcome_message": True, "mute_new_members": True}
+
+    async def scenario():
+        guard = bot.JoinGuard(limit=10, window=10, quiet_seconds=60, batch_seconds=0.05)
+        for member in _members(701, 3):
+            guard.add(fake, chat_id, [member], features, raid_protection=True)
+        assert fake.calls == [] and notices.texts == []  # nothing happens before the batch timer
+        await asyncio.sleep(0.2)
+        await guard.stop(fake)
+        await stop_buffers()
+        return guard
+
+    guard = run(scenario())
+    assert guard.raids == 0 and not guard.in_raid(chat_id)
+    assert notices.texts == [(chat_id, "👋 Welcome, user701, user702, user703! Please read the /rules.")]
+    assert sorted(fake.calls) == [("mute", 701), ("mute", 702), ("mute", 703)]
+
+
+def test_a_raid_mutes_everyone_in_the_window_and_schedules_one_lift(schema, monkeypatch):
+    chat_id = -4102
+    notices = Notices()
+    monkeypatch.setattr(bot, "outbound", notices)
+    fake = ModerationBot()
+
+    async def scenario():
+        guard = bot.JoinGuard(limit=5, window=10, quiet_seconds=0.2, batch_seconds=0.05)
+        guard.add(fake, chat_id, _members(801, 2), {}, raid_protection=True)
+        await asyncio.sleep(0.1)  # the first two are flushed before the raid starts
+        guard.add(fake, chat_id, _members(803, 4), {}, raid_protection=True)
+        in_raid = guard.in_raid(chat_id)
+        for _ in range(50):
+            if not guard.in_raid(chat_id) and not guard._tasks:
+                break
+            await asyncio.sleep(0.05)
+        await stop_buffers()
+        return guard, in_raid
+
+    guard, in_raid = run(scenario())
+    assert in_raid and guard.raids == 1 and not guard.in_raid(chat_id)
+    assert sorted(fake.calls) == [("mute", user_id) for user_id in range(801, 807)]
+    assert notices.texts[0] == (chat_id, "🛡 Join raid detected: new members are muted until it is over.")
+    assert notices.texts[-1][1].startswith("✅ Join raid over: 6 members joined")
+
+    rows = run(bot.db.fetchall("SELECT payload FROM scheduled_jobs WHERE kind = 'lift_raid'"))
+    payloads = [json.loads(payload) for payload, in rows if json.loads(payload)["chat_id"] == chat_id]
+    assert len(payloads) == 1
+    [payload] = payloads
+    assert sorted(payload["user_ids"]) == list(range(801, 807))
+    run(bot.db.execute("DELETE FROM scheduled_jobs WHERE kind = 'lift_raid' AND payload LIKE ?", (f'%{chat_id}%',)))
+
+    # The lift job unmutes exactly the members the raid muted, once
+    async def lift_twice():
+        await bot._job_lift_raid(fake, payload)
+        first = sorted(fake.calls)
+        fake.calls.clear()
+        await bot._job_lift_raid(fake, payload)
+        await stop_buffers()
+        return first, fake.calls
+
+    fake.calls.clear()
+    first, second = run(lift_twice())
+    assert first == [("unmute", user_id) for user_id in range(801, 807)]
+    assert second == []
+
+
+def test_an_early_flush_leaves_no_unawaited_coroutine(schema, monkeypatch):
+    monkeypatch.setattr(bot, "outbound", Notices())
+    fake = ModerationBot()
+
+    async def scenario():
+        guard = bot.JoinGuard(limit=10, window=10, quiet_seconds=60, batch_seconds=60)
+        guard.add(fake, -4103, _members(901, 1), {"mute_new_members": True}, raid_protection=False)
+        await guard.flush(fake, -4103)  # cancels the pending timer
+        await guard.stop(fake)
+        await stop_buffers()
+
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter("always")
+        run(scenario())
+        gc.collect()
+    assert fake.calls == [("mute", 901)]
+    assert not [warning for warning in caught if "was never awaited" in str(warning.message)]
@@ -0,0 +1,74 @@
+import random
+import re
+
+from conftest import run
+
+import bot
+
+
+SCOPE = -4242
+
+
+def _seed(schema, players: int = 95):
+    rng = random.Random(12)
+    rows = [
+        (SCOPE, user_id, "all", rng.randint(0, 5), rng.randint(5, 8))  # plenty of ties
+        for user_id in range(1, players + 1)
+    ]
+    schema._timed("test", lambda conn: conn.executemany(
+        "INSERT OR REPLACE INTO player_stats (chat_id, user_id, period, wins, games_played) VALUES (?, ?, ?, ?, ?)",
+        rows
+    ))
+    bot.leaderboard_cache.invalidate(SCOPE)
+    return [str(row[1]) for row in sorted(rows, key=lambda row: (-row[3], row[4], row[1]))]
+
+
+def _names(text: str) -> list:
+    return re.findall(r"^\d+\. (\S+):", text, re.M)
+
+
+def test_keyset_pages_match_the_full_ranking(schema):
+    ranking = _seed(schema)
+
+    async def walk():
+        pages, page, cursor = [], 0, None
+        while True:
+            text, has_next, before, after = await bot.render_leaderboard(SCOPE, "all", page, cursor)
+            pages.append((page, _names(text), before))
+            if not has_next:
+                break
+            page, cursor = page + 1, after
+        # ...and back again with the Prev cursors
+        backwards = []
+        for page, _, before in reversed(pages[1:]):
+            text, has_next, _, _ = await bot.render_leaderboard(SCOPE, "all", page - 1, before)
+            assert has_next
+            backwards.append(_names(text))
+        return pages, backwards
+
+    pages, backwards = run(walk())
+    assert [name for _, names, _ in pages for name in names] == ranking
+    assert len(pages) == 10
+    assert backwards == [names for _, names, _ in reversed(pages[:-1])]
+
+
+def test_keyset_query_seeks_the_rank_index(schema):
+    condition, order = bot._LEADERBOARD_ORDER["a"]
+    plan = schema._timed("test", lambda conn: conn.execute(
+        f"EXPLAIN QUERY PLAN SELECT s.user_id FROM player_stats s WHERE s.chat_id = ? AND s.period = ?"
+        f" AND {condition} ORDER BY {order} LIMIT 11",
+        (SCOPE, "all", 3, 3, 6, 6, 10)
+    ).fetchall())
+    details = " ".join(row[-1] for row in plan)
+    assert "idx_player_stats_rank" in details
+    assert "TEMP B-TREE" not in details
+
+
+def test_cache_is_bounded():
+    cache = bot.LeaderboardCache(max_scopes=3, max_pages=4)
+    for scope in range(10):
+        for page in range(10):
+            cache.put(scope, ("all", page, None), ("text", False, None, None))
+    assert list(cache._pages) == [7, 8, 9]
+    assert all(len(pages) == 4 for pages in cache._pages.values())
+    assert cache.get(9, ("all", 9, None)) and cache.get(9, ("all", 0, None)) is None
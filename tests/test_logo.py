@@ -0,0 +1,51 @@
+from telegram import Update
+
+from conftest import message_update, run, stop_buffers
+
+import bot
+
+
+def test_cache_evicts_least_recently_used_logos():
+    cache = bot.LogoCache(maxsize=2)
+    keys = [bot.LogoCache.key(f"logo {i}", 256, "#000000") for i in range(3)]
+    cache.put(keys[0], png=b"0")
+    cache.put(keys[1], png=b"1")
+    assert cache.get(keys[0])["png"] == b"0"  # now the most recently used
+    cache.put(keys[2], png=b"2")
+    assert cache.get(keys[1]) is None
+    assert cache.get(keys[0]) and cache.get(keys[2])
+
+
+def test_uploaded_logo_keeps_only_its_file_id():
+    cache = bot.LogoCache()
+    key = bot.LogoCache.key("acme", 256, "#0088cc")
+    cache.put(key, png=b"png bytes")
+    cache.put(key, file_id="file-1")
+    assert cache.get(key) == {"file_id": "file-1", "png": None}
+    cache.put(key, png=b"late render")  # a concurrent render must not replace the reference
+    assert cache.get(key) == {"file_id": "file-1", "png": None}
+
+
+def test_second_logo_request_is_sent_by_file_id(schema, fake_telegram):
+    chat_id = -3301
+    app = bot.build_application(token="1:test")
+
+    async def scenario():
+        await app.initialize()
+        try:
+            for update_id in (1, 2):
+                update = Update.de_json(message_update(update_id, chat_id, "/logo 128 Acme Rockets"), app.bot)
+                await app.process_update(update)
+        finally:
+            await stop_buffers()
+            await app.shutdown()
+
+    run(scenario())
+    first, second = fake_telegram.sent("sendPhoto")
+    assert first["photo"].startswith(b"\x89PNG")  # rendered in the spawned pool and uploaded
+    assert second["photo"] == _uploaded_file_id(fake_telegram)
+
+
+def _uploaded_file_id(fake_telegram) -> str:
+    index = next(i for i, (method, _) in enumerate(fake_telegram.calls) if method == "sendPhoto")
+    return f"photo-{index + 1}"
@@ -0,0 +1,86 @@
+import json
+import sqlite3
+
+import bot
+
+
+def _legacy_db(path) -> sqlite3.Connection:
+    """A database as the bot left it before versioned migrations: schema v1 plus data."""
+    conn = sqlite3.connect(path)
+    assert bot.apply_migrations(conn, up_to=1) == 1
+    conn.execute(
+        "INSERT INTO games (poll_id, chat_id, question, correct_option, participants, created_at, message_id, scored)"
+        " VALUES ('p1', -10, 'q?', 1, ?, '2024-05-01T12:00:00', 77, 1)",
+        (json.dumps({"ids": [1, 2], "names": ["ann", "bob"]}),)
+    )
+    conn.execute(
+        "INSERT INTO games (poll_id, chat_id, question, correct_option, participants, created_at)"
+        " VALUES ('p2', NULL, 'q2?', 0, 'not json', NULL)"
+    )
+    conn.execute("INSERT INTO players (user_id, username, wins, games_played, last_played)"
+                 " VALUES (1, 'ann', 3, 5, '2024-05-01T12:00:00')")
+    conn.execute("INSERT INTO votes (poll_id, user_id, option_id, voted_at) VALUES ('p1', 1, 1, '2024-05-01T12:00:05')")
+    conn.execute("INSERT INTO spam_triggers (chat_id, trigger) VALUES (-10, 'free crypto')")
+    conn.execute("INSERT INTO anti_spam_settings (group_id) VALUES (-10)")
+    conn.commit()
+    return conn
+
+
+def _columns(conn, table: str) -> dict:
+    return {row[1]: row[2] for row in conn.execute(f"PRAGMA table_info({table})")}
+
+
+def test_v1_database_migrates_to_current_schema(tmp_path):
+    conn = _legacy_db(tmp_path / "legacy.db")
+    assert bot.apply_migrations(conn) == bot.SCHEMA_VERSION
+    assert conn.execute("PRAGMA user_version").fetchone()[0] == bot.SCHEMA_VERSION
+
+    # v2: compact games, participants split out, timestamps as epochs
+    games = conn.execute(
+        "SELECT poll_id, chat_id, created_at, message_id, scored FROM games ORDER BY poll_id"
+    ).fetchall()
+    assert games[0][:2] == ("p1", -10) and isinstance(games[0][2], int) and games[0][2] > 0
+    assert games[0][3:] == (77, 1)
+    assert games[1] == ("p2", 0, 0, None, 0)
+    participants = conn.execute("SELECT user_id, name FROM game_participants ORDER BY user_id").fetchall()
+    assert participants == [(1, "ann"), (2, "bob")]
+    assert "participants" not in _columns(conn, "games")
+    assert isinstance(conn.execute("SELECT voted_at FROM votes").fetchone()[0], int)
+    assert conn.execute("SELECT username, wins, games_played FROM players").fetchall() == [("ann", 3, 5)]
+
+    # v3/v4: typed spam rules and the new settings columns with their defaults
+    rules = conn.execute("SELECT chat_id, kind, trigger FROM spam_triggers").fetchall()
+    assert rules == [(-10, "keyword", "free crypto")]
+    assert conn.execute(
+        "SELECT dry_run, warn_action, warn_on_spam FROM anti_spam_settings WHERE group_id = -10"
+    ).fetchone() == (0, "mute", 0)
+
+    # Later versions only add tables and indexes
+    tables = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    assert {"warnings", "chat_users", "audit_log", "activity_hourly", "timed_mutes"} <= tables
+    rank_index = [row[2] for row in conn.execute("PRAGMA index_info(idx_player_stats_rank)")]
+    assert rank_index == ["chat_id", "period", "wins", "games_played", "user_id"]
+    conn.close()
+
+
+def test_migrations_run_each_step_once(tmp_path):
+    conn = _legacy_db(tmp_path / "steps.db")
+    for target, _ in bot.MIGRATIONS[1:]:
+        assert bot.apply_migrations(conn, up_to=target) == target
+    schema = conn.execute("SELECT name, sql FROM sqlite_master ORDER BY name").fetchall()
+    # Re-running is a no-op, as when several shard workers start together
+    assert bot.apply_migrations(conn) == bot.SCHEMA_VERSION
+    assert conn.execute("SELECT name, sql FROM sqlite_master ORDER BY name").fetchall() == schema
+    assert conn.execute("SELECT COUNT(*) FROM game_participants").fetchone()[0] == 2
+    conn.close()
+
+
+def test_fresh_database_matches_a_migrated_one(tmp_path):
+    fresh = sqlite3.connect(tmp_path / "fresh.db")
+    bot.apply_migrations(fresh)
+    migrated = _legacy_db(tmp_path / "migrated.db")
+    bot.apply_migrations(migrated)
+    query = "SELECT type, name, tbl_name FROM sqlite_master WHERE name NOT LIKE 'sqlite_%' ORDER BY name"
+    assert fresh.execute(query).fetchall() == migrated.execute(query).fetchall()
+    fresh.close()
+    migrated.close()
@@ -0,0 +1,105 @@
+import time
+from types import SimpleNamespace
+
+from telegram import Update
+
+from conftest import message_update, run, stop_buffers
+
+import bot
+
+
+def _update(chat_id: int, text: str, reply_to: dict = None) -> Update:
+    data = message_update(1, chat_id, text)
+    if reply_to is not None:
+        data["message"]["reply_to_message"] = {
+            "message_id": 0, "date": 0, "chat": data["message"]["chat"], **reply_to
+        }
+    return Update.de_json(data, None)
+
+
+def _targets(update: Update):
+    context = SimpleNamespace(args=update.message.text.split()[1:])
+    return run(bot.command_targets(update, context))
+
+
+def _user(user_id: int, is_bot: bool = False) -> dict:
+    return {"id": user_id, "is_bot": is_bot, "first_name": f"user{user_id}"}
+
+
+def test_targets_come_from_replies_ids_ranges_and_usernames(schema):
+    chat_id = -4401
+    bot.user_directory._remember(chat_id, 120, "alice", "Alice", int(time.time()))
+
+    # A reply names its author; the arguments are all reason
+    replied = _update(chat_id, "/ban being rude", reply_to={"from": _user(150), "text": "hi"})
+    assert _targets(replied) == ([150], [], ["being", "rude"])
+
+    # A reply to a join message names everyone it added, except bots
+    joined = _update(chat_id, "/kick", reply_to={
+        "from": _user(151), "new_chat_members": [_user(151), _user(152), _user(153, is_bot=True)]
+    })
+    assert _targets(joined) == ([151, 152], [], [])
+
+    update = _update(chat_id, "/mute 101-103 105 101 @Alice @nobody 30m flooding the chat")
+    assert _targets(update) == ([101, 102, 103, 105, 120], ["@nobody"], ["30m", "flooding", "the", "chat"])
+
+
+def test_id_ranges_are_capped(schema):
+    chat_id = -4402
+    assert _targets(_update(chat_id, "/ban 1-100000000")) == ([], ["1-100000000"], [])
+    assert _targets(_update(chat_id, "/ban 9-3")) == ([], ["9-3"], [])
+    wide = _update(chat_id, f"/ban 1-{bot.MODERATION_MAX_TARGETS}")
+    assert len(_targets(wide)[0]) == bot.MODERATION_MAX_TARGETS
+    # Ranges that are each small enough stop expanding once they add up to too many
+    many = _update(chat_id, " ".join(["/ban"] + [f"{i * 100}-{i * 100 + 99}" for i in range(1, 1000)]))
+    assert len(_targets(many)[0]) == 300
+
+
+def _command(app, chat_id: int, texts):
+    async def scenario():
+        await app.initialize()
+        try:
+            for update_id, text in enumerate(texts, 1):
+                await app.process_update(Update.de_json(message_update(update_id, chat_id, text, user_id=7), app.bot))
+        finally:
+            await stop_buffers()
+            await app.shutdown()
+
+    run(scenario())
+
+
+def test_moderation_commands_skip_admins_and_split_duration_from_reason(schema, fake_telegram):
+    chat_id = -4403
+    bot.admin_cache.set_admins(chat_id, frozenset({7, 8}))
+    app = bot.build_application(token="1:test")
+    _command(app, chat_id, ["/mute 8 300-302 30m flooding the chat"])
+
+    mutes = [params for method, params in fake_telegram.calls if method == "restrictChatMember"]
+    assert sorted(int(params["user_id"]) for params in mutes) == [300, 301, 302]
+    assert all(abs(int(params["until_date"]) - (time.time() + 1800)) < 60 for params in mutes)
+    [reply] = [params["text"] for params in fake_telegram.sent() if params["chat_id"] == chat_id]
+    assert "Muted 3 users: `300`, `301`, `302` for 30m" in reply
+    assert "🛡 Skipped admins: `8`" in reply
+    reasons = run(bot.db.fetchall(
+        "SELECT DISTINCT reason FROM audit_log WHERE chat_id = ? AND action = 'mute'", (chat_id,)
+    ))
+    assert reasons == [("flooding the chat",)]
+    # One job lifts all three mutes; remove it so later scheduler tests start clean
+    jobs = run(bot.db.fetchall(
+        "SELECT job_id, payload FROM scheduled_jobs WHERE kind = 'unmute' AND payload LIKE ?",
+        (f'%"chat_id": {chat_id},%',)
+    ))
+    assert len(jobs) == 1 and '"user_ids": [300, 301, 302]' in jobs[0][1]
+    run(bot.db.execute("DELETE FROM scheduled_jobs WHERE job_id = ?", (jobs[0][0],)))
+
+
+def test_oversized_id_ranges_are_rejected(schema, fake_telegram):
+    chat_id = -4404
+    bot.admin_cache.set_admins(chat_id, frozenset({7}))
+    app = bot.build_application(token="1:test")
+    _command(app, chat_id, ["/ban 1-100000000", "/ban 5 10-9 reason"])
+
+    assert not [method for method, _ in fake_telegram.calls if method == "banChatMember"]
+    replies = [params["text"] for params in fake_telegram.sent() if params["chat_id"] == chat_id]
+    assert replies[0].startswith("❌ Invalid ID range: 1-100000000.")
+    assert replies[1].startswith("❌ Invalid ID range: 10-9.")
@@ -0,0 +1,153 @@
+import asyncio
+import time
+
+from conftest import run
+
+import bot
+
+
+class RecordingBot:
+    def __init__(self, delay: float = 0.0):
+        self.delay = delay
+        self.sent = []
+
+    async def send_message(self, chat_id, text, **kwargs):
+        await asyncio.sleep(self.delay)
+        self.sent.append((chat_id, text, time.monotonic()))
+        return text
+
+
+def test_saturated_chat_does_not_block_other_chats():
+    async def scenario():
+        queue = bot.OutboundQueue(global_rate=1000, chat_rate=2, workers=4)
+        fake = RecordingBot()
+        queue.start(fake)
+        try:
+            busy = [queue.send(-1, f"a{i}") for i in range(20)]
+            await asyncio.sleep(0.05)
+            start = time.monotonic()
+            assert await asyncio.wait_for(queue.send(-2, "b"), 1.0) == "b"
+            quiet = time.monotonic() - start
+            notice = queue.send(-3, "notice", bot.PRIORITY_MODERATION)
+            await asyncio.wait_for(notice, 1.0)
+            assert sum(future.done() for future in busy) < 5  # chat -1 is still rate limited
+            for future in busy:
+                future.cancel()
+            return quiet
+        finally:
+            await queue.stop()
+
+    assert run(scenario()) < 0.2
+
+
+def test_chat_rate_and_order_are_kept():
+    async def scenario():
+        queue = bot.OutboundQueue(global_rate=1000, chat_rate=20, workers=4)
+        fake = RecordingBot()
+        queue.start(fake)
+        try:
+            await asyncio.gather(*(queue.send(-1, str(i)) for i in range(5)))
+        finally:
+            await queue.stop()
+        return fake.sent
+
+    sent = run(scenario())
+    assert [text for _, text, _ in sent] == ["0", "1", "2", "3", "4"]
+    gaps = [b[2] - a[2] for a, b in zip(sent, sent[1:])]
+    assert min(gaps) >= 0.04  # 20 per second
+
+
+def test_priority_overtakes_within_a_chat():
+    async def scenario():
+        queue = bot.OutboundQueue(global_rate=1000, chat_rate=20, workers=1)
+        fake = RecordingBot(delay=0.01)
+        queue.start(fake)
+        try:
+            futures = [queue.send(-1, f"chatter{i}", bot.PRIORITY_CHATTER) for i in range(3)]
+            futures.append(queue.send(-1, "notice", bot.PRIORITY_MODERATION))
+            await asyncio.gather(*futures)
+        finally:
+            await queue.stop()
+        return [text for _, text, _ in fake.sent]
+
+    order = run(scenario())
+    assert order.index("notice") <= 1  # only an already-started send can precede it
+
+
+def test_retry_after_resends_to_the_same_chat():
+    class FlakyBot(RecordingBot):
+        calls = 0
+
+        async def send_message(self, chat_id, text, **kwargs):
+            FlakyBot.calls += 1
+            if FlakyBot.calls == 1:
+                raise bot.RetryAfter(0.1)
+            return await super().send_message(chat_id, text, **kwargs)
+
+    async def scenario():
+        queue = bot.OutboundQueue(global_rate=1000, chat_rate=100, workers=2)
+        queue.start(FlakyBot())
+        try:
+            return await asyncio.wait_for(queue.send(-1, "hi"), 2.0)
+        finally:
+            await queue.stop()
+
+    assert run(scenario()) == "hi"
+
+
+def test_retried_upload_resends_the_whole_file():
+    import tempfile
+
+    uploads = []
+
+    class FlakyUploadBot:
+        async def send_document(self, chat_id, document, **kwargs):
+            uploads.append(document.read())
+            if len(uploads) == 1:
+                raise bot.RetryAfter(0.1)
+            return True
+
+    async def scenario():
+        queue = bot.OutboundQueue(global_rate=1000, chat_rate=100, workers=2)
+        queue.start(FlakyUploadBot())
+        with tempfile.TemporaryFile() as out:
+            out.write(b"audit,log\n" * 100)
+
+            def rewound():
+                out.seek(0)
+                return out
+
+            try:
+                return await asyncio.wait_for(queue.submit("send_document", chat_id=-1, document=rewound), 2.0)
+            finally:
+                await queue.stop()
+
+    assert run(scenario()) is True
+    assert uploads == [b"audit,log\n" * 100] * 2
+
+
+def test_chatter_handlers_do_not_wait_for_the_chat_rate_limit(monkeypatch):
+    from types import SimpleNamespace
+
+    async def scenario():
+        queue = bot.OutboundQueue(global_rate=1000, chat_rate=1, workers=2)
+        fake = RecordingBot()
+        queue.start(fake)
+        monkeypatch.setattr(bot, "outbound", queue)
+        update = SimpleNamespace(
+            effective_chat=SimpleNamespace(id=-1), message=SimpleNamespace(message_id=5)
+        )
+        context = SimpleNamespace(args=["@friend"])
+        try:
+            start = time.monotonic()
+            for _ in range(5):
+                await bot.truth_or_dare(update, context)
+            elapsed = time.monotonic() - start
+            await asyncio.sleep(0.1)
+            return elapsed, len(fake.sent)
+        finally:
+            await queue.stop()
+
+    elapsed, sent = run(scenario())
+    assert elapsed < 0.1  # five sends would take four seconds at one per second
+    assert sent == 1
@@ -0,0 +1,106 @@
+import asyncio
+import time
+
+from conftest import run, stop_buffers
+
+import bot
+
+
+class ModerationBot:
+    def __init__(self):
+        self.calls = []
+
+    async def restrict_chat_member(self, chat_id, user_id, permissions=None, until_date=None):
+        muted = not permissions.can_send_messages
+        self.calls.append(("mute" if muted else "unmute", user_id))
+
+    async def ban_chat_member(self, chat_id, user_id, until_date=None):
+        self.calls.append(("ban", user_id))
+
+
+def _job_rows(kind):
+    return run(bot.db.fetchall("SELECT payload FROM scheduled_jobs WHERE kind = ?", (kind,)))
+
+
+def test_jobs_run_once_and_survive_restart(schema):
+    ran = []
+
+    async def handler(_bot, payload):
+        ran.append(payload["n"])
+
+    async def before_restart():
+        first = bot.Scheduler()
+        first.register("test_restart", handler)
+        await first.start(None)
+        await first.schedule("test_restart", time.time() + 0.05, {"n": 1})
+        await first.schedule("test_restart", time.time() + 0.3, {"n": 2})
+        await asyncio.sleep(0.15)
+        await first.stop()
+
+    async def after_restart():
+        second = bot.Scheduler()
+        second.register("test_restart", handler)
+        await second.start(None)
+        await asyncio.sleep(0.4)
+        await second.stop()
+
+    run(before_restart())
+    assert ran == [1]
+    run(after_restart())
+    assert ran == [1, 2]
+    assert _job_rows("test_restart") == []
+
+
+def test_cancelled_job_never_runs(schema):
+    ran = []
+
+    async def handler(_bot, payload):
+        ran.append(payload)
+
+    async def scenario():
+        scheduler = bot.Scheduler()
+        scheduler.register("test_cancel", handler)
+        await scheduler.start(None)
+        job_id = await scheduler.schedule("test_cancel", time.time() + 0.05, {})
+        await scheduler.cancel(job_id)
+        await asyncio.sleep(0.15)
+        assert scheduler.pending() == 0
+        await scheduler.stop()
+
+    run(scenario())
+    assert ran == []
+    assert _job_rows("test_cancel") == []
+
+
+def test_stale_unmute_does_not_lift_later_mutes(schema):
+    fake = ModerationBot()
+
+    async def scenario():
+        chat = -7001
+        # A timed mute followed by a permanent one: the old job must not unmute
+        first = bot.new_lift_tag()
+        await bot.moderate(fake, chat, 1, "mute", until_date=int(time.time()) + 3600, lift_tag=first)
+        await bot.moderate(fake, chat, 1, "mute")
+        await bot._job_unmute(fake, {"chat_id": chat, "user_id": 1, "tag": first})
+        assert ("unmute", 1) not in fake.calls
+
+        # A timed mute replaced by another: only the newer job lifts it
+        old, new = bot.new_lift_tag(), bot.new_lift_tag()
+        await bot.moderate(fake, chat, 2, "mute", until_date=int(time.time()) + 60, lift_tag=old)
+        await bot.moderate(fake, chat, 2, "mute", until_date=int(time.time()) + 120, lift_tag=new)
+        await bot._job_unmute(fake, {"chat_id": chat, "user_id": 2, "tag": old})
+        assert ("unmute", 2) not in fake.calls
+        await bot._job_unmute(fake, {"chat_id": chat, "user_id": 2, "tag": new})
+        assert ("unmute", 2) in fake.calls
+
+        # A raid lift skips members an admin muted by hand, or banned, meanwhile
+        raid = bot.new_lift_tag()
+        await bot.run_moderation_batch(fake, chat, [10, 11, 12], "mute", int(time.time()) + 600, lift_tag=raid)
+        await bot.moderate(fake, chat, 11, "mute", actor_id=99)
+        await bot.moderate(fake, chat, 12, "ban", actor_id=99)
+        fake.calls.clear()
+        await bot._job_lift_raid(fake, {"chat_id": chat, "user_ids": [10, 11, 12], "tag": raid})
+        await stop_buffers()
+
+    run(scenario())
+    assert fake.calls == [("unmute", 10)]
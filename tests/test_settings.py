@@ -0,0 +1,102 @@
+import asyncio
+from types import SimpleNamespace
+
+from conftest import run
+
+import bot
+
+
+class CallbackQuery:
+    def __init__(self, data):
+        self.data = data
+        self.edits = []
+
+    async def answer(self, *args, **kwargs):
+        pass
+
+    async def edit_message_text(self, text, **kwargs):
+        self.edits.append(text)
+
+
+def test_feature_toggles_only_apply_to_the_chat_they_were_pressed_in(schema):
+    chat_id, other_id, admin_id = -4201, -4202, 7
+    schema._timed("test", lambda conn: conn.execute(
+        "INSERT OR REPLACE INTO group_features (group_id, feature, is_active) VALUES (?, 'welcome_message', 1)",
+        (other_id,)
+    ))
+    bot.admin_cache.set_admins(chat_id, frozenset({admin_id}))
+    query = CallbackQuery(f"toggle_welcome_{other_id}")
+    update = SimpleNamespace(
+        callback_query=query,
+        effective_chat=SimpleNamespace(id=chat_id, type="supergroup"),
+        effective_user=SimpleNamespace(id=admin_id),
+    )
+
+    run(bot.toggle_feature(update, SimpleNamespace(bot=None)))
+    assert query.edits == ["❌ This menu belongs to another group."]
+    row = run(bot.db.fetchone(
+        "SELECT is_active FROM group_features WHERE group_id = ? AND feature = 'welcome_message'", (other_id,)
+    ))
+    assert row == (1,)
+
+
+def _counting_loads(monkeypatch) -> list:
+    loads = []
+    load = bot._load_group_settings
+
+    def counting(conn, group_id):
+        loads.append(group_id)
+        return load(conn, group_id)
+
+    monkeypatch.setattr(bot, "_load_group_settings", counting)
+    return loads
+
+
+def test_settings_are_evicted_least_recently_used_first(schema, monkeypatch):
+    loads = _counting_loads(monkeypatch)
+    cache = bot.GroupSettingsCache(maxsize=2)
+
+    async def scenario():
+        for group_id in (-4801, -4802, -4801, -4803, -4801, -4802):
+            await cache.get(group_id)
+
+    run(scenario())
+    # -4801 stayed warm because it was used again; -4802 was evicted and loaded twice
+    assert loads == [-4801, -4802, -4803, -4802]
+    assert list(cache._entries) == [-4801, -4802]
+
+
+def test_writes_go_through_to_warm_entries_and_discard_racing_loads(schema, monkeypatch):
+    chat_id, admin_id = -4804, 7
+    loads = _counting_loads(monkeypatch)
+    cache = bot.GroupSettingsCache()
+    monkeypatch.setattr(bot, "settings_cache", cache)
+    bot.admin_cache.set_admins(chat_id, frozenset({admin_id}))
+    replies = []
+
+    async def reply_text(text, **kwargs):
+        replies.append(text)
+
+    update = SimpleNamespace(
+        effective_chat=SimpleNamespace(id=chat_id, type="supergroup"),
+        effective_user=SimpleNamespace(id=admin_id),
+        message=SimpleNamespace(reply_text=reply_text),
+    )
+
+    async def scenario():
+        before = (await cache.get(chat_id))["anti_spam"]
+        await bot.toggle_antispam(update, SimpleNamespace(args=[]))
+        after = (await cache.get(chat_id))["anti_spam"]
+        # A write that lands while a load is in flight keeps the stale load out of the cache
+        cache.invalidate(chat_id)
+        loading = asyncio.ensure_future(cache.get(chat_id))
+        await asyncio.sleep(0)
+        cache.set_feature(chat_id, "welcome_message", False)
+        await loading
+        return before, after, chat_id in cache._entries
+
+    before, after, cached = run(scenario())
+    assert before is None and after["is_active"] is True
+    assert replies == ["Anti-spam is now ✅ enabled"]
+    assert loads == [chat_id, chat_id]  # the toggle itself needed no reload
+    assert not cached
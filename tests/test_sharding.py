@@ -0,0 +1,114 @@
+import asyncio
+import json
+import queue
+import threading
+import time
+
+from telegram import Update
+
+from conftest import message_update, run
+
+import bot
+
+
+def poll_answer_update(update_id: int, poll_id: str, user_id: int, option: int = 0) -> dict:
+    return {
+        "update_id": update_id,
+        "poll_answer": {
+            "poll_id": poll_id,
+            "user": {"id": user_id, "is_bot": False, "first_name": "voter"},
+            "option_ids": [option],
+        },
+    }
+
+
+def drain(inbox) -> list:
+    items = []
+    while not inbox.empty():
+        items.append(inbox.get_nowait())
+    return items
+
+
+def test_full_worker_queue_does_not_block_the_front():
+    inboxes = [queue.Queue(maxsize=2), queue.Queue(maxsize=2)]
+
+    async def scenario():
+        router = bot.ShardRouter(inboxes)
+        shard = bot.shard_for(-1, 2)
+        started = time.perf_counter()
+        for update_id in range(10):
+            router.submit(Update.de_json(message_update(update_id, -1, "hi"), None))
+        submit_time = time.perf_counter() - started
+        assert router.pending() == 8
+
+        received = []
+
+        def consume():
+            while len(received) < 10:
+                received.append(inboxes[shard].get(timeout=5)["update_id"])
+
+        consumer = threading.Thread(target=consume)
+        consumer.start()
+        await asyncio.wait_for(router.wait_drained(), 5)
+        consumer.join(5)
+        return submit_time, received, router
+
+    submit_time, received, router = run(scenario())
+    assert submit_time < 0.1
+    assert received == list(range(10))
+    assert router.pending() == 0
+
+
+def test_poll_answers_go_to_the_games_chat_shard(schema):
+    chat_id, poll_id = -1001, "sharded-poll"
+    bot.db._timed("test", lambda conn: conn.execute(
+        "INSERT OR REPLACE INTO games (poll_id, chat_id, question, correct_option, created_at, scored)"
+        " VALUES (?, ?, 'q', 0, 0, 0)", (poll_id, chat_id)
+    ))
+    inboxes = [queue.Queue(), queue.Queue(), queue.Queue()]
+    # Voters chosen so that routing by user would scatter them over every shard
+    voters = list(range(1, 30))
+    assert len({bot.shard_for(user_id, 3) for user_id in voters}) == 3
+
+    async def scenario():
+        router = bot.ShardRouter(inboxes)
+        for update_id, user_id in enumerate(voters):
+            router.submit(Update.de_json(poll_answer_update(update_id, poll_id, user_id), None))
+        await router.wait_drained()
+        # Cached after the first lookup
+        router.submit(Update.de_json(poll_answer_update(99, poll_id, 1, 1), None))
+        assert router.pending() == 0
+
+    run(scenario())
+    owner = bot.shard_for(chat_id, 3)
+    delivered = [drain(inbox) for inbox in inboxes]
+    assert [item["update_id"] for item in delivered[owner]] == list(range(len(voters))) + [99]
+    assert sum(map(len, delivered)) == len(voters) + 1
+
+
+def test_jobs_follow_their_chat_when_shard_count_changes(monkeypatch):
+    payloads = [json.dumps({"chat_id": -100 - i}) for i in range(50)]
+    for shard_count in (1, 2, 5):
+        monkeypatch.setattr(bot, "SHARD_COUNT", shard_count)
+        for payload in payloads:
+            assert bot.job_shard(payload) == bot.shard_for(json.loads(payload)["chat_id"])
+        assert bot.job_shard(json.dumps({})) == 0  # housekeeping stays on shard 0
+
+
+def test_fake_update_source_reaches_every_worker(monkeypatch, schema, fake_telegram):
+    # Spawned workers import bot afresh and read their config from the environment
+    monkeypatch.setenv("TELEGRAM_API_URL", fake_telegram.url)
+    monkeypatch.setenv("TELEGRAM_BOT_TOKEN", "1:test")
+    monkeypatch.setattr(bot, "TOKEN", "1:test")
+    chats = [-1, -2, -3, -4, -5, -6]
+    assert len({bot.shard_for(chat_id, 2) for chat_id in chats}) == 2
+
+    async def source():
+        for update_id, chat_id in enumerate(chats):
+            yield Update.de_json(message_update(update_id, chat_id, "/help"), None)
+
+    routed = run(bot.serve_sharded(2, source()))
+    assert sum(routed) == len(chats)
+    assert all(routed)
+    replied = sorted(params["chat_id"] for params in fake_telegram.sent())
+    assert replied == sorted(chats)
@@ -0,0 +1,121 @@
+import asyncio
+import random
+
+from telegram import Update
+
+from conftest import message_update, run, stop_buffers
+
+import bot
+
+
+def test_matcher_finds_overlapping_and_nested_triggers():
+    matcher = bot.SpamMatcher(["he", "she", "his", "hers", "usher"])
+    assert matcher.find_all("ushers") == ["he", "she", "hers", "usher"]
+    assert matcher.find_all("nothing here") == ["he"]
+    assert matcher.find_all("xyz") == []
+
+
+def test_matcher_sees_through_case_homoglyphs_and_zero_width():
+    matcher = bot.SpamMatcher(["Free Crypto", "free crypto", "  "])
+    assert matcher.triggers == ("Free Crypto",)  # normalized duplicates and blanks collapse
+    assert matcher.find_all("FREE CRYPTO now") == ["Free Crypto"]
+    assert matcher.find_all("frее сrурtо") == ["Free Crypto"]  # Cyrillic look-alikes
+    assert matcher.find_all("fr\u200bee cry\u200dpto") == ["Free Crypto"]
+    assert matcher.find_all("ｆｒｅｅ ｃｒｙｐｔｏ") == ["Free Crypto"]  # full-width forms
+
+
+def test_matcher_agrees_with_substring_search():
+    rng = random.Random(5)
+    alphabet = "abc "
+    triggers = ["".join(rng.choice(alphabet) for _ in range(rng.randint(1, 5))) for _ in range(60)]
+    matcher = bot.SpamMatcher(triggers)
+    for _ in range(300):
+        text = "".join(rng.choice(alphabet) for _ in range(rng.randint(0, 40)))
+        expected = [trigger for trigger in matcher.triggers if bot.normalize_text(trigger) in text]
+        assert matcher.find_all(text) == expected
+
+
+def test_regex_guard_rejects_backtracking_constructs():
+    for pattern, problem in [
+        ("(a+)+$", "Nested quantifiers"),
+        ("(\\w*)*x", "Nested quantifiers"),
+        ("(a|aa)+b", None),
+        ("(x)\\1", "Backreferences"),
+        ("(?P<name>spam)", "Named groups"),
+        ("[unclosed", "Invalid regex"),
+        ("a" * (bot.SPAM_RULE_MAX_LENGTH + 1), "Patterns are limited"),
+    ]:
+        verdict = bot.validate_spam_regex(pattern)
+        assert (verdict is None) if problem is None else verdict.startswith(problem), (pattern, verdict)
+    assert bot.validate_spam_regex(r"t\.me/\w+") is None
+    assert bot.validate_spam_regex(r"(ab){3}") is None  # fixed repeats can't backtrack
+
+
+def test_regex_probe_times_out_on_catastrophic_patterns(monkeypatch):
+    monkeypatch.setattr(bot, "SPAM_REGEX_PROBE_TIMEOUT", 0.5)
+    methods = []
+    get_context = bot.multiprocessing.get_context
+
+    def recording_context(method=None):
+        methods.append(method)
+        return get_context(method)
+
+    monkeypatch.setattr(bot.multiprocessing, "get_context", recording_context)
+    assert run(bot.probe_spam_regex(r"t\.me/\w+")) < 0.5
+    assert run(bot.probe_spam_regex("(a|a)*$")) is None
+    assert methods == ["spawn", "spawn"]  # forking a threaded process can deadlock the child
+
+
+def test_rule_set_prefers_keywords_and_reports_regex_rules():
+    rules = bot.SpamRuleSet([
+        (1, "keyword", "buy followers"),
+        (2, "regex", r"promo\.example/\w+"),
+        (3, "regex", r"\d{6,}"),
+    ])
+    assert rules.check("BUY FOLLOWERS at promo.example/deal")[0] == (1, "keyword", "buy followers")
+    assert rules.check("see promo.example/deal")[0] == (2, "regex", r"promo\.example/\w+")
+    assert rules.check("call 5551234567")[0] == (3, "regex", r"\d{6,}")
+    assert rules.check("hello there")[0] is None
+
+
+def test_slow_regex_rules_switch_themselves_off(monkeypatch):
+    monkeypatch.setattr(bot, "SPAM_REGEX_BUDGET_MS", -1)  # every search is over budget
+    rules = bot.SpamRuleSet([(2, "regex", r"promo\.example/\w+")])
+    assert rules.check("see promo.example/deal")[0] == (2, "regex", r"promo\.example/\w+")
+    assert rules.regex_disabled and rules.slow_match_ms is not None
+    assert rules.check("see promo.example/deal")[0] is None
+
+
+def test_spam_notices_escape_user_content(monkeypatch, schema, fake_telegram):
+    chat_id = -3201
+    schema._timed("test", lambda conn: conn.execute(
+        "INSERT OR REPLACE INTO anti_spam_settings (group_id, is_active, ban_instead_of_delete) VALUES (?, 1, 0)",
+        (chat_id,)
+    ))
+    bot.settings_cache.invalidate(chat_id)
+    bot.admin_cache.set_admins(chat_id, frozenset())
+    app = bot.build_application(token="1:test")
+    queue = bot.OutboundQueue(global_rate=1000, chat_rate=100, coalesce_seconds=0.05)
+    monkeypatch.setattr(bot, "outbound", queue)
+
+    async def scenario():
+        await app.initialize()
+        queue.start(app.bot)
+        try:
+            data = message_update(1, chat_id, "join t.me/some_channel *now*", user_id=61)
+            data["message"]["from"]["first_name"] = "spam_bot"
+            await app.process_update(Update.de_json(data, app.bot))
+            for _ in range(50):
+                if fake_telegram.sent():
+                    break
+                await asyncio.sleep(0.02)
+        finally:
+            await queue.stop()
+            await stop_buffers()
+            await app.shutdown()
+
+    run(scenario())
+    [notice] = [params for params in fake_telegram.sent() if params["chat_id"] == chat_id]
+    assert notice["parse_mode"] == "Markdown"
+    assert "[spam\\_bot](tg://user?id=61)" in notice["text"]
+    assert "t.me/some\\_channel \\*now\\*" in notice["text"]
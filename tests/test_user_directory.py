@@ -0,0 +1,96 @@
+import time
+from types import SimpleNamespace
+
+from conftest import run
+
+import bot
+
+
+def _user(user_id: int, username=None, full_name: str = "Someone"):
+    return SimpleNamespace(id=user_id, username=username, full_name=full_name)
+
+
+def _rows(chat_id: int) -> list:
+    return run(bot.db.fetchall(
+        "SELECT user_id, username, full_name FROM chat_users WHERE chat_id = ? ORDER BY user_id", (chat_id,)
+    ))
+
+
+def test_usernames_resolve_case_insensitively_and_follow_renames(schema):
+    chat_id = -4501
+
+    async def scenario():
+        directory = bot.UserDirectory(flush_interval=60)
+        directory.observe(chat_id, _user(1, "Alice", "Alice A"))
+        directory.observe(-4502, _user(2, "bob"))
+        found = [await directory.resolve(chat_id, name) for name in ("@alice", "ALICE", "@bob")]
+        directory.observe(chat_id, _user(1, "alice_new", "Alice A"))
+        renamed = [await directory.resolve(chat_id, name) for name in ("@alice", "@alice_new")]
+        await directory.stop()
+        return found, renamed
+
+    found, renamed = run(scenario())
+    assert found == [(1, "alice", "Alice A"), (1, "alice", "Alice A"), None]  # bob was seen in another chat
+    assert renamed == [None, (1, "alice_new", "Alice A")]
+    assert _rows(chat_id) == [(1, "alice_new", "Alice A")]
+
+
+def test_repeat_sightings_are_not_rewritten(schema):
+    chat_id = -4503
+
+    async def scenario():
+        directory = bot.UserDirectory(flush_interval=60, touch_seconds=3600)
+        directory.observe(chat_id, _user(1, "carol"))
+        first = await directory.flush()
+        for _ in range(5):
+            directory.observe(chat_id, _user(1, "carol"))
+        unchanged = await directory.flush()
+        directory.observe(chat_id, _user(1, "carol", "Carol C"))  # a new display name is written at once
+        changed = await directory.flush()
+        await directory.stop()
+        return first, unchanged, changed
+
+    assert run(scenario()) == (1, 0, 1)
+    assert _rows(chat_id) == [(1, "carol", "Carol C")]
+
+
+def test_cache_misses_fall_back_to_the_table(schema):
+    chat_id = -4504
+    run(bot.db.executemany(bot._CHAT_USER_UPSERT, [
+        (chat_id, 1, "dave", "Dave", int(time.time()) - 60),
+        (chat_id, 2, "erin", "Erin", int(time.time())),
+    ]))
+
+    async def scenario():
+        directory = bot.UserDirectory(maxsize=1, flush_interval=60)
+        by_name = await directory.resolve(chat_id, "@dave")
+        by_id = await directory.get(chat_id, 2)  # evicts dave from the one-entry cache
+        evicted = list(directory._entries), dict(directory._usernames)
+        again = await directory.resolve(chat_id, "@dave")
+        missing = await directory.get(chat_id, 3)
+        await directory.stop()
+        return by_name, by_id, evicted, again, missing
+
+    by_name, by_id, evicted, again, missing = run(scenario())
+    assert by_name == (1, "dave", "Dave") and by_id == (2, "erin", "Erin")
+    assert evicted == ([(chat_id, 2)], {(chat_id, "erin"): 2})
+    assert again == (1, "dave", "Dave")
+    assert missing is None
+
+
+def test_users_not_seen_within_the_retention_window_are_pruned(schema):
+    chat_id = -4505
+    now = int(time.time())
+    stale = now - (bot.USER_DIRECTORY_RETENTION_DAYS + 1) * 86400
+    run(bot.db.executemany(bot._CHAT_USER_UPSERT, [
+        (chat_id, 1, "old", "Old", stale),
+        (chat_id, 2, "recent", "Recent", now),
+    ]))
+    users_cutoff = now - bot.USER_DIRECTORY_RETENTION_DAYS * 86400
+    run(bot.db.run(lambda conn: bot._prune(conn, 0, users_cutoff=users_cutoff), label="test_prune"))
+    assert _rows(chat_id) == [(2, "recent", "Recent")]
+
+    async def resolve():
+        return await bot.UserDirectory().resolve(chat_id, "@old")
+
+    assert run(resolve()) is None
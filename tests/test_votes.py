@@ -0,0 +1,88 @@
+import asyncio
+
+from telegram import PollAnswer, User
+
+from conftest import run, stop_buffers
+
+import bot
+
+
+def _game(schema, poll_id: str, chat_id: int, correct_option: int = 1):
+    schema._timed("test", lambda conn: conn.execute(
+        "INSERT OR REPLACE INTO games (poll_id, chat_id, question, correct_option, created_at, scored)"
+        " VALUES (?, ?, 'q', ?, 0, 0)", (poll_id, chat_id, correct_option)
+    ))
+
+
+def _answer(poll_id: str, user_id: int, *options) -> PollAnswer:
+    user = User(user_id, f"player{user_id}", False, username=f"p{user_id}")
+    return PollAnswer(poll_id=poll_id, user=user, option_ids=list(options))
+
+
+def _votes(poll_id: str) -> list:
+    return run(bot.db.fetchall(
+        "SELECT user_id, option_id FROM votes WHERE poll_id = ? ORDER BY user_id", (poll_id,)
+    ))
+
+
+def _played(user_ids) -> dict:
+    marks = ",".join("?" * len(user_ids))
+    return dict(run(bot.db.fetchall(
+        f"SELECT user_id, games_played FROM players WHERE user_id IN ({marks})", tuple(user_ids)
+    )))
+
+
+def test_only_the_latest_answer_per_voter_is_stored(schema):
+    _game(schema, "vb-latest", -5001)
+
+    async def scenario():
+        buffer = bot.VoteBuffer(flush_interval=60)
+        buffer.add(_answer("vb-latest", 5101, 0))
+        buffer.add(_answer("vb-latest", 5101, 1))  # changed their mind
+        buffer.add(_answer("vb-latest", 5102, 1))
+        buffer.add(_answer("vb-latest", 5102))  # retracted
+        buffer.add(_answer("vb-latest", 5103, 0))
+        buffer.add(_answer("vb-unknown-poll", 5101, 0))
+        stored = await buffer.flush()
+        await buffer.stop()
+        return stored
+
+    assert run(scenario()) == 3  # the unknown poll is dropped
+    assert _votes("vb-latest") == [(5101, 1), (5103, 0)]
+    assert _votes("vb-unknown-poll") == []
+    # A retraction before the first flush never counts as a game played
+    assert _played([5101, 5102, 5103]) == {5101: 1, 5103: 1}
+
+
+def test_a_full_buffer_flushes_without_waiting(schema):
+    _game(schema, "vb-size", -5002)
+
+    async def scenario():
+        buffer = bot.VoteBuffer(flush_interval=60, flush_size=10)
+        for user_id in range(5200, 5210):
+            buffer.add(_answer("vb-size", user_id, 0))
+        for _ in range(50):
+            if buffer.flushed:
+                break
+            await asyncio.sleep(0.01)
+        await buffer.stop()
+        return buffer.flushed
+
+    assert run(scenario()) == 10
+    assert len(_votes("vb-size")) == 10
+
+
+def test_finish_game_scores_votes_still_in_the_buffer(schema):
+    _game(schema, "vb-finish", -5003, correct_option=1)
+
+    async def scenario():
+        bot.vote_buffer.add(_answer("vb-finish", 5301, 1))
+        bot.vote_buffer.add(_answer("vb-finish", 5302, 0))
+        result = await bot.finish_game(None, "vb-finish")  # no message id, so no stop_poll call
+        await stop_buffers()
+        return result
+
+    result = run(scenario())
+    assert "Winners: p5301" in result
+    wins = dict(run(bot.db.fetchall("SELECT user_id, wins FROM players WHERE user_id IN (5301, 5302)")))
+    assert wins == {5301: 1, 5302: 0}
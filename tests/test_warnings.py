@@ -0,0 +1,111 @@
+import time
+
+from telegram import Update
+
+from conftest import message_update, run, stop_buffers
+
+import bot
+
+
+class ModerationBot:
+    def __init__(self):
+        self.calls = []
+
+    async def restrict_chat_member(self, chat_id, user_id, permissions=None, until_date=None):
+        self.calls.append(("mute" if not permissions.can_send_messages else "unmute", user_id, until_date))
+
+    async def ban_chat_member(self, chat_id, user_id, until_date=None):
+        self.calls.append(("ban", user_id, until_date))
+
+
+def test_warnings_escalate_at_the_limit_and_reset(schema):
+    chat_id, user_id = -3101, 55
+    fake = ModerationBot()
+
+    async def scenario():
+        results = [await bot.issue_warning(fake, chat_id, user_id, f"r{i}", 10) for i in range(4)]
+        count_after = bot.warning_ledger.count(chat_id, user_id)
+        await stop_buffers()
+        return results, count_after
+
+    results, count_after = run(scenario())
+    # Default policy: three warnings, then a timed mute that clears the slate
+    assert results == [(1, 3, None), (2, 3, None), (3, 3, "muted"), (1, 3, None)]
+    assert count_after == 1
+    assert [call[:2] for call in fake.calls] == [("mute", user_id)]
+    assert fake.calls[0][2] >= time.time() + bot.WARN_MUTE_SECONDS - 5
+
+    # A fresh ledger reloads the surviving warning from the table
+    async def reload():
+        ledger = bot.WarningLedger()
+        await ledger._ensure_loaded(chat_id)
+        return ledger.count(chat_id, user_id)
+
+    assert run(reload()) == 1
+    unmutes = run(bot.db.fetchall(
+        "SELECT payload FROM scheduled_jobs WHERE kind = 'unmute' AND payload LIKE ?", (f'%"chat_id": {chat_id},%',)
+    ))
+    assert len(unmutes) == 1
+
+
+def test_warn_command_rejects_admin_targets(schema, fake_telegram):
+    chat_id, admin_id, member_id = -3102, 99, 5
+    bot.admin_cache.set_admins(chat_id, frozenset({7, admin_id}))
+    app = bot.build_application(token="1:test")
+
+    async def scenario():
+        await app.initialize()
+        try:
+            for update_id, target in enumerate((admin_id, member_id), 1):
+                update = Update.de_json(message_update(update_id, chat_id, f"/warn {target} spam", user_id=7), app.bot)
+                await app.process_update(update)
+            return bot.warning_ledger.count(chat_id, admin_id), bot.warning_ledger.count(chat_id, member_id)
+        finally:
+            await stop_buffers()
+            await app.shutdown()
+
+    admin_warnings, member_warnings = run(scenario())
+    assert (admin_warnings, member_warnings) == (0, 1)
+    replies = [params["text"] for params in fake_telegram.sent() if params["chat_id"] == chat_id]
+    assert replies[0] == f"🛡 User {admin_id} is an admin and can't be warned."
+    assert replies[1].startswith(f"⚠️ Warned user: {member_id} (1/3)")
+
+
+def test_expired_warnings_stop_counting_whatever_order_they_were_added(schema, monkeypatch):
+    chat_id, user_id = -3103, 56
+    clock = [time.time()]
+    monkeypatch.setattr(bot.time, "time", lambda: clock[0])
+
+    async def scenario():
+        ledger = bot.WarningLedger(flush_interval=60)
+        await ledger.add(chat_id, user_id, ttl=1000)
+        await ledger.add(chat_id, user_id, ttl=10)  # expires before the earlier warning
+        await ledger.add(chat_id, user_id, ttl=500)
+        clock[0] += 20
+        live = ledger.count(chat_id, user_id)
+        await ledger.flush()
+        # Reloaded from the table, still sorted by expiry
+        reloaded = bot.WarningLedger(flush_interval=60)
+        await reloaded._ensure_loaded(chat_id)
+        clock[0] += 600
+        after = reloaded.count(chat_id, user_id)
+        await ledger.stop()
+        return live, after
+
+    assert run(scenario()) == (2, 1)
+
+
+def test_ledger_keeps_a_bounded_number_of_chats(schema):
+    async def scenario():
+        ledger = bot.WarningLedger(flush_interval=60, max_chats=3)
+        for chat_id in range(-3200, -3210, -1):
+            await ledger.add(chat_id, 1)
+        cached = list(ledger._chats)
+        # An evicted chat reloads its warnings, including writes not yet flushed
+        count = await ledger.add(-3200, 1)
+        await ledger.stop()
+        return cached, count
+
+    cached, count = run(scenario())
+    assert cached == [-3207, -3208, -3209]
+    assert count == 2
@@ -0,0 +1,137 @@
+import asyncio
+import json
+import random
+
+from telegram import Update
+from telegram.ext import TypeHandler
+
+from conftest import free_port, message_update, run
+
+import bot
+
+
+async def post(port: int, body: bytes, content_length: int = None, secret: str = None) -> str:
+    """POST to the webhook and return the response status line."""
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    length = len(body) if content_length is None else content_length
+    secret_header = f"X-Telegram-Bot-Api-Secret-Token: {secret}\r\n" if secret is not None else ""
+    writer.write(
+        f"POST {bot.WEBHOOK_PATH} HTTP/1.1\r\nHost: test\r\nContent-Length: {length}\r\n{secret_header}"
+        f"Connection: close\r\n\r\n".encode() + body
+    )
+    await writer.drain()
+    status = (await reader.readline()).decode().strip()
+    writer.close()
+    return status
+
+
+async def serving(port: int, app, scenario):
+    stop = asyncio.Event()
+    server = asyncio.create_task(bot.serve_webhook(app, stop))
+    for _ in range(100):
+        try:
+            _, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.close()
+            break
+        except OSError:
+            await asyncio.sleep(0.05)
+    try:
+        return await scenario()
+    finally:
+        stop.set()
+        await server
+
+
+def _app(monkeypatch, schema):
+    port = free_port()
+    monkeypatch.setattr(bot, "WEBHOOK_PORT", port)
+    monkeypatch.setattr(bot, "WEBHOOK_LISTEN", "127.0.0.1")
+    monkeypatch.setattr(bot, "WEBHOOK_URL", None)
+    return port, bot.build_application(token="1:test")
+
+
+def test_webhook_end_to_end_keeps_per_chat_order(monkeypatch, schema, fake_telegram):
+    port, app = _app(monkeypatch, schema)
+    seen = []
+    rng = random.Random(3)
+
+    async def record(update, context):
+        await asyncio.sleep(rng.random() * 0.02)
+        seen.append((update.effective_chat.id, update.update_id))
+
+    app.add_handler(TypeHandler(Update, record), group=-10)
+
+    async def scenario():
+        updates = [message_update(i, -1 if i % 2 else -2, f"hello {i}") for i in range(1, 41)]
+        updates.append(message_update(100, -3, "/help"))
+        statuses = await asyncio.gather(*(post(port, json.dumps(update).encode()) for update in updates))
+        for _ in range(100):
+            if len(seen) == len(updates) and fake_telegram.sent():
+                break
+            await asyncio.sleep(0.05)
+        return statuses
+
+    statuses = run(serving(port, app, scenario))
+    assert all(status.startswith("HTTP/1.1 200") for status in statuses)
+    for chat in (-1, -2):
+        ids = [update_id for chat_id, update_id in seen if chat_id == chat]
+        assert ids == sorted(ids) and len(ids) == 20
+    # The /help reply went out through the fake API
+    assert any(params.get("chat_id") == -3 for params in fake_telegram.sent())
+
+
+def test_webhook_rejects_oversized_bodies(monkeypatch, schema, fake_telegram):
+    port, app = _app(monkeypatch, schema)
+
+    async def scenario():
+        too_large = await post(port, b"", content_length=bot.WEBHOOK_MAX_BODY + 1)
+        garbage = await post(port, b"not json")
+        return too_large, garbage
+
+    too_large, garbage = run(serving(port, app, scenario))
+    assert too_large.startswith("HTTP/1.1 413")
+    assert garbage.startswith("HTTP/1.1 400")
+
+
+def test_webhook_sheds_load_when_backlogged(monkeypatch, schema, fake_telegram):
+    port, app = _app(monkeypatch, schema)
+    monkeypatch.setattr(bot, "WEBHOOK_MAX_PENDING", 3)
+    release = None
+
+    async def block(update, context):
+        await release.wait()
+
+    app.add_handler(TypeHandler(Update, block), group=-10)
+
+    async def scenario():
+        nonlocal release
+        release = asyncio.Event()
+        statuses = []
+        for i in range(1, 6):
+            statuses.append(await post(port, json.dumps(message_update(i, -5, "spam")).encode()))
+        release.set()
+        await asyncio.sleep(0.1)
+        statuses.append(await post(port, json.dumps(message_update(6, -5, "later")).encode()))
+        return statuses
+
+    statuses = run(serving(port, app, scenario))
+    assert [status.split()[1] for status in statuses] == ["200", "200", "200", "503", "503", "200"]
+
+
+def test_webhook_requires_the_secret_token(monkeypatch, schema, fake_telegram, capsys):
+    port, app = _app(monkeypatch, schema)
+    monkeypatch.setattr(bot, "WEBHOOK_SECRET", "s3cret-token")
+    body = json.dumps(message_update(1, -6, "hello")).encode()
+
+    async def scenario():
+        return [await post(port, body, secret=secret) for secret in (None, "wrong", "s3cret-tokenX", "s3cret-token")]
+
+    statuses = run(serving(port, app, scenario))
+    assert [status.split()[1] for status in statuses] == ["403", "403", "403", "200"]
+    assert "WEBHOOK_SECRET is not set" not in capsys.readouterr().out
+
+    # Without a secret the endpoint still works, but startup says it is open
+    monkeypatch.setattr(bot, "WEBHOOK_SECRET", None)
+    port, app = _app(monkeypatch, schema)
+    assert run(serving(port, app, lambda: post(port, body))).startswith("HTTP/1.1 200")
+    assert "WEBHOOK_SECRET is not set" in capsys.readouterr().out